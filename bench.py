@@ -0,0 +1,415 @@
+"""Benchmark / load test for the bot handlers.
+
+Builds the real Application via bot.build_application() against a stub transport that answers every Bot API
+call locally (no network), preloads stats at the requested user count and replays synthetic update streams.
+
+    python bench.py --users 10000 --active 200 --scenario all --backend sqlite
+
+With --memory the in-memory user table is measured instead: the stats.json layout against UserRecord, at the given
+synthetic user counts, including a lossless round trip of every user:
+
+    python bench.py --memory 100000,1000000
+
+With --workers N the multi-process webhook deployment (cluster.py) is started as a subprocess instead, talking to a
+fake Bot API server over HTTP, and updates are POSTed to its webhook front end:
+
+    python bench.py --users 10000 --active 200 --scenario previews --workers 4
+
+With --group-latency-check S the scenario runs twice, with an instant notification group and with one that takes S
+seconds per call, and the exit status is 1 if handler p50/p99 differ by more than --tolerance-ms (admin logs and
+notifications must not be on the handlers' path):
+
+    python bench.py --scenario all --group-latency-check 0.3
+"""
+import argparse
+import asyncio
+import email
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from telegram.request import BaseRequest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADMIN_ID = 1
+GROUP_ID = -1001234567890
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "Bench", "username": "BenchBot"}
+
+
+class FakeTelegram(BaseRequest):
+    """Answers Bot API calls with plausible fake objects and records what was called."""
+    def __init__(self, group_latency: float = 0.0, latency: float = 0.0):
+        self.calls = Counter(); self.upload_bytes = 0; self.group_latency = group_latency; self.latency = latency
+        self.message_ids = itertools.count(1000); self.file_ids = itertools.count(1); self.pinned_text = None
+
+    @property
+    def read_timeout(self): return None
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
+    def _message(self, params: dict, method: str) -> dict:
+        chat_id = int(params.get("chat_id", 0) or 0)
+        message = {"message_id": int(params.get("message_id") or next(self.message_ids)), "date": int(time.time()), "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}, "from": BOT_USER}
+        if method in ("sendPhoto", "editMessageMedia"):
+            file_id = f"photo_{next(self.file_ids)}"; message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 800}]
+        elif method == "sendDocument":
+            file_id = f"doc_{next(self.file_ids)}"; message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        else: message["text"] = params.get("text", "")
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        params = {}
+        if request_data is not None:
+            params = request_data.parameters
+            if request_data.contains_files: self.upload_bytes += sum(len(part[1]) for part in request_data.multipart_data.values() if isinstance(part, tuple))
+        return await self.answer(url.rsplit("/", 1)[-1], params)
+
+    async def handle_http(self, method: str, path: str, headers: dict, body: bytes):
+        """Same answers for real HTTP requests (form-encoded or multipart, as sent by HTTPXRequest); see cluster.serve_http."""
+        content_type = headers.get("content-type", ""); params = {}
+        if content_type.startswith("multipart/"):
+            for part in email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body).get_payload():
+                if part.get_filename(): self.upload_bytes += len(part.get_payload(decode=True))
+                else: params[part.get_param("name", header="content-disposition")] = part.get_payload()
+        elif body: params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+        status, payload = await self.answer(path.rsplit("/", 1)[-1], params); return status, payload, "application/json"
+
+    async def answer(self, api_method: str, params: dict):
+        self.calls[api_method] += 1
+        delay = self.group_latency if str(params.get("chat_id")) == str(GROUP_ID) else self.latency
+        if delay: await asyncio.sleep(delay)
+        if api_method == "getMe": result = BOT_USER
+        elif api_method in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageMedia"): result = self._message(params, api_method)
+        elif api_method == "getChat":
+            result = {"id": int(params.get("chat_id", 0)), "type": "supergroup", "title": "Bench", "accent_color_id": 0, "max_reaction_count": 11}
+            if self.pinned_text: result["pinned_message"] = {"message_id": 1, "date": int(time.time()), "chat": {"id": GROUP_ID, "type": "supergroup"}, "from": BOT_USER, "text": self.pinned_text}
+        elif api_method == "getFile": result = {"file_id": params.get("file_id"), "file_unique_id": "x", "file_path": "documents/x"}
+        else: result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def total_calls(self) -> int: return sum(self.calls.values())
+
+
+def synthetic_stats(user_count: int) -> dict:
+    now = datetime.now(); users = {}
+    for i in range(user_count):
+        user_id = str(100000 + i); first = now - timedelta(hours=random.randint(1, 24 * 60)); last = min(now, first + timedelta(hours=random.randint(0, 24 * 30)))
+        users[user_id] = {"first_start": first.isoformat(), "last_start": last.isoformat(), "discount_sent": False, "preview_clicks": random.randint(0, 20), "viewed_sisters": random.sample(["ks", "gs"], random.randint(0, 2)),
+                          "payments_initiated": [], "banned": False, "referrer_id": None, "referrals": [], "successful_referrals": 0, "reward_triggered_for_referrer": False}
+        if i % 10 == 0: users[user_id]["discounts"] = {"type": "percent", "value": 20}
+    return {"pinned_message_id": 1, "discount_message_id": None, "users": users, "admin_logs": {uid: {"message_id": 500000 + n} for n, uid in enumerate(list(users)[: user_count // 2])}, "events": {"start_command": user_count}}
+
+
+def synthetic_user(rng: random.Random, index: int, now: datetime) -> dict:
+    """A user the way the handlers leave it: ISO timestamps, sisters in click order, a few payment attempts, some referrers."""
+    first = now - timedelta(seconds=rng.randint(3600, 86400 * 90)); last = min(now, first + timedelta(seconds=rng.randint(0, 86400 * 30)))
+    user = {"first_start": first.isoformat(), "last_start": last.isoformat(), "discount_sent": rng.random() < 0.3, "preview_clicks": rng.randint(0, 25), "viewed_sisters": rng.sample(["ks", "gs"], rng.randint(0, 2)),
+            "payments_initiated": list(dict.fromkeys(f"{rng.choice(['PayPal', 'Gutschein', 'Krypto'])}: {rng.choice([5, 10, 15, 25, 30])}€" for _ in range(rng.choice([0, 0, 0, 1, 2])))), "banned": rng.random() < 0.01,
+            "referrer_id": str(100000 + rng.randrange(index)) if index and rng.random() < 0.05 else None, "referrals": [str(100000 + rng.randrange(10 ** 6)) for _ in range(rng.randint(1, 5))] if rng.random() < 0.02 else [],
+            "successful_referrals": 0, "reward_triggered_for_referrer": False}
+    if rng.random() < 0.1: user["discounts"] = {"type": "percent", "value": 20}
+    return user
+
+
+def memory_benchmark(counts: list) -> list:
+    import gc
+    import tracemalloc
+    import bot
+    now = datetime(2026, 1, 1, 12, 0, 0); results = []
+
+    def users(count: int):
+        rng = random.Random(count)
+        for index in range(count): yield str(100000 + index), synthetic_user(rng, index, now)
+
+    def traced(build):
+        gc.collect(); tracemalloc.start(); t0 = time.perf_counter(); table = build(); elapsed = time.perf_counter() - t0; size = tracemalloc.get_traced_memory()[0]; tracemalloc.stop(); return table, size, elapsed
+
+    def last_start_ns(table) -> float:
+        # What check_user_status does per update: read last_start as datetime, store a datetime (here the same one, so the
+        # round trip below still compares against the generated users).
+        sample = random.Random(0).sample(list(table.values()), min(len(table), 100000)); t0 = time.perf_counter()
+        for user in sample: bot.set_user_time(user, "last_start", bot.user_time(user, "last_start"))
+        return (time.perf_counter() - t0) / len(sample) * 1e9
+
+    for count in counts:
+        plain, plain_bytes, _ = traced(lambda: dict(users(count)))
+        t0 = time.perf_counter(); bot.UserTable.of(plain); convert_s = time.perf_counter() - t0; bot.referral_index.clear()
+        plain_ns = last_start_ns(plain); del plain
+        records, record_bytes, _ = traced(lambda: _user_table(bot, users(count))); record_ns = last_start_ns(records)
+        t0 = time.perf_counter(); mismatches = sum(1 for user_id, user in users(count) if records[user_id].to_json() != user); roundtrip_s = time.perf_counter() - t0
+        with_extra = sum(1 for record in records.values() if record.extra)
+        results.append({"users": count, "json_layout_mb": round(plain_bytes / 2 ** 20, 1), "user_record_mb": round(record_bytes / 2 ** 20, 1), "bytes_per_user": [round(plain_bytes / count), round(record_bytes / count)],
+                        "ratio": round(plain_bytes / record_bytes, 2), "convert_s": round(convert_s, 2), "roundtrip_s": round(roundtrip_s, 2), "roundtrip_mismatches": mismatches, "records_with_extra": with_extra,
+                        "check_last_start_ns": {"json_layout": round(plain_ns), "user_record": round(record_ns)}})
+        del records; bot.referral_index.clear()
+    return results
+
+
+def _user_table(bot, users):
+    # Converted one user at a time, so the JSON-layout dicts never exist all at once.
+    table = bot.UserTable()
+    for user_id, user in users: table[user_id] = user
+    return table
+
+
+class UpdateFactory:
+    """Synthetic updates; Update objects for the in-process run, raw webhook payloads when `app` is None."""
+    def __init__(self, app):
+        self.app = app; self.update_ids = itertools.count(1); self.message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict: return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _wrap(self, payload: dict):
+        from telegram import Update
+        return payload if self.app is None else Update.de_json(payload, self.app.bot)
+
+    def command(self, user_id: int, text: str):
+        command = text.split()[0]
+        return self._wrap({"update_id": next(self.update_ids), "message": {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text,
+                           "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}] if text.startswith("/") else []}})
+
+    def callback(self, user_id: int, data: str):
+        return self._wrap({"update_id": next(self.update_ids), "callback_query": {"id": str(next(self.update_ids)), "from": self._user(user_id), "chat_instance": "bench", "data": data,
+                           "message": {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "x"}}})
+
+
+def user_session(factory: UpdateFactory, user_id: int, scenario: str, next_clicks: int) -> list:
+    updates = [("start", factory.command(user_id, "/start"))]
+    if scenario in ("previews", "all"):
+        sister = random.choice(["ks", "gs"])
+        updates += [("show_preview_options", factory.callback(user_id, "show_preview_options")), ("select_schwester", factory.callback(user_id, f"select_schwester:{sister}:preview"))]
+        updates += [("next_preview", factory.callback(user_id, f"next_preview:{sister}")) for _ in range(next_clicks)]
+    if scenario in ("prices", "payments", "all"):
+        sister = random.choice(["ks", "gs"])
+        updates += [("show_price_options", factory.callback(user_id, "show_price_options")), ("select_schwester", factory.callback(user_id, f"select_schwester:{sister}:prices"))]
+    if scenario in ("payments", "all"):
+        media_type, amount = random.choice(["bilder", "videos"]), random.choice([10, 25, 35])
+        updates += [("select_package", factory.callback(user_id, f"select_package:{media_type}:{amount}")), ("pay", factory.callback(user_id, f"{random.choice(['pay_paypal', 'pay_crypto', 'pay_voucher'])}:{media_type}:{amount}"))]
+    return updates
+
+
+def admin_broadcast_session(factory: UpdateFactory) -> list:
+    return [("admin", factory.command(ADMIN_ID, "/admin")), ("admin_discount_start", factory.callback(ADMIN_ID, "admin_discount_start")),
+            ("admin_discount_set_type", factory.callback(ADMIN_ID, "admin_discount_set_type_percent")), ("admin_discount_target", factory.callback(ADMIN_ID, "admin_discount_target_all")),
+            ("admin_text", factory.command(ADMIN_ID, "10")), ("admin_discount_apply_all", factory.callback(ADMIN_ID, "admin_discount_percent_apply_all"))]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values); return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run(args):
+    import bot
+    transport = FakeTelegram(group_latency=args.group_latency, latency=args.latency)
+    # A dashboard that is ahead of the local stats (more users, more starts), so startup has something to reconcile.
+    transport.pinned_text = f"📊 Bot-Statistik Dashboard\n   • Gesamt: *{args.users * 2}*\n   • Starts: *{args.users * 3}*\n   • PayPal: *7*"
+    app = bot.build_application(request=transport); factory = UpdateFactory(app)
+    t_init = time.perf_counter()
+    await app.initialize(); await bot.post_init(app); await app.start()
+    startup = time.perf_counter() - t_init
+    first = factory.command(100000 + args.users + 1, "/start"); await app.update_processor.process_update(first, app.process_update(first))
+    first_response = time.perf_counter() - t_init
+    if bot.reconcile_task: await bot.reconcile_task
+    reconciled = time.perf_counter() - t_init; users_after_reconcile = len(bot.load_stats()["users"]); calls_after_startup = transport.total_calls()
+
+    latencies = defaultdict(list); semaphore = asyncio.Semaphore(args.concurrency)
+    user_ids = random.sample(range(100000, 100000 + max(args.users, args.active)), args.active)
+    sessions = [user_session(factory, user_id, args.scenario, args.next_clicks) for user_id in user_ids]
+    if args.scenario in ("broadcast", "all"): sessions.append(admin_broadcast_session(factory))
+
+    async def process(kind, update):
+        # Through the application's update processor, so CONCURRENT_UPDATES and per-user ordering apply.
+        t0 = time.perf_counter(); await app.update_processor.process_update(update, app.process_update(update)); latencies[kind].append(time.perf_counter() - t0)
+
+    async def replay(session):
+        async with semaphore:
+            for kind, update in session: await process(kind, update)
+
+    stress_check = None
+    t0 = time.perf_counter()
+    if args.scenario == "stress":
+        # Every click of every user is submitted at once; per-user serialization and the atomic helpers must not lose increments.
+        for user_id in user_ids: bot.set_user_field(user_id, "preview_clicks", 0)
+        events_before = bot.load_stats()["events"].get("next_preview", 0); clicks = min(args.next_clicks, 25)
+        await asyncio.gather(*(process("next_preview", factory.callback(user_id, "next_preview:ks")) for user_id in user_ids for _ in range(clicks)))
+        stats = bot.load_stats(); expected = len(user_ids) * clicks
+        stress_check = {"expected_next_preview_events": expected, "counted_next_preview_events": stats["events"].get("next_preview", 0) - events_before,
+                        "users_with_lost_clicks": sum(1 for user_id in user_ids if stats["users"][str(user_id)].get("preview_clicks") != clicks)}
+    else: await asyncio.gather(*(replay(session) for session in sessions))
+    elapsed = time.perf_counter() - t0
+    while bot.active_broadcast is not None: await asyncio.sleep(0.05)
+    broadcast_done = time.perf_counter() - t0
+    calls_handlers = transport.total_calls() - calls_after_startup
+    await app.stop(); await bot.post_stop(app); await app.shutdown(); await bot.post_shutdown(app)
+
+    all_latencies = [value for values in latencies.values() for value in values]; update_count = len(all_latencies)
+    report = {"backend": bot.STATS_BACKEND, "preloaded_users": args.users, "active_users": args.active, "updates": update_count, "startup_s": round(startup, 4),
+              "time_to_first_response_s": round(first_response, 4), "reconcile_done_s": round(reconciled, 4), "users_after_reconcile": users_after_reconcile,
+              "throughput_updates_per_s": round(update_count / elapsed, 1) if elapsed else 0.0, "p50_ms": round(percentile(all_latencies, 50) * 1000, 3), "p99_ms": round(percentile(all_latencies, 99) * 1000, 3),
+              "telegram_calls_per_update": round(calls_handlers / update_count, 3) if update_count else 0.0, "telegram_calls": dict(transport.calls), "upload_bytes": transport.upload_bytes,
+              "stats_bytes_written": bot.stats_store.bytes_written, "broadcast_completed_s": round(broadcast_done, 3), "stress_check": stress_check,
+              "per_route": {kind: {"n": len(values), "p50_ms": round(percentile(values, 50) * 1000, 3), "p99_ms": round(percentile(values, 99) * 1000, 3), "mean_ms": round(statistics.fmean(values) * 1000, 3)} for kind, values in sorted(latencies.items())}}
+    return report
+
+
+def fake_api_process(conn, group_latency: float, latency: float):
+    """Fake Bot API server in its own process, so it does not compete with the update sender for a core."""
+    from cluster import serve_http
+
+    async def serve():
+        transport = FakeTelegram(group_latency=group_latency, latency=latency); server = await serve_http(transport.handle_http, "127.0.0.1", 0)
+        conn.send(server.sockets[0].getsockname()[1]); loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, conn.recv); conn.send({"calls": dict(transport.calls), "upload_bytes": transport.upload_bytes})
+            if command == "stop": break
+        server.close(); await server.wait_closed()
+    asyncio.run(serve())
+
+
+class HttpConnection:
+    """Keep-alive HTTP/1.1 client connection; much cheaper per request than a pooled httpx client at this rate."""
+    def __init__(self, port: int):
+        self.port = port; self.reader = self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b"") -> tuple:
+        if self.writer is None: self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        status = int((await self.reader.readline()).split()[1]); length = 0
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length": length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    def close(self):
+        if self.writer: self.writer.close()
+
+
+async def run_cluster(args, user_ids: list):
+    """Fake Bot API over HTTP + `python bot.py` with WEBHOOK_WORKERS=N; updates go through the webhook front end."""
+    import multiprocessing
+    loop = asyncio.get_running_loop(); api_conn, child_conn = multiprocessing.Pipe()
+    api_process = multiprocessing.get_context("spawn").Process(target=fake_api_process, args=(child_conn, args.group_latency, args.latency)); api_process.start()
+    api_port = await loop.run_in_executor(None, api_conn.recv)
+
+    async def api_calls(command: str = "calls") -> dict:
+        api_conn.send(command); return await loop.run_in_executor(None, api_conn.recv)
+
+    with socket_reserved() as front_port: pass
+    env = {**os.environ, "WEBHOOK_URL": f"http://127.0.0.1:{front_port}", "WEBHOOK_WORKERS": str(args.workers), "PORT": str(front_port), "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{api_port}"}
+    t_start = time.perf_counter(); front = subprocess.Popen([sys.executable, os.path.join(HERE, "bot.py")], env=env, stderr=subprocess.DEVNULL)
+    factory = UpdateFactory(None); sessions = [user_session(factory, user_id, args.scenario, args.next_clicks) for user_id in user_ids]
+    webhook_path = f"/{os.environ['BOT_TOKEN']}"; monitor = HttpConnection(front_port)
+
+    async def cluster_stats():
+        try: return json.loads((await monitor.request("GET", "/cluster/stats"))[1])
+        except OSError: monitor.writer = None; return None
+
+    try:
+        while (stats := await cluster_stats()) is None or stats["ready"] < args.workers:
+            if front.poll() is not None: raise SystemExit("cluster front end exited during startup")
+            await asyncio.sleep(0.05)
+        startup = time.perf_counter() - t_start; calls_after_startup = sum((await api_calls())["calls"].values())
+        connections = [HttpConnection(front_port) for _ in range(args.concurrency)]
+
+        async def sender(connection: HttpConnection, queue: list):
+            while queue:
+                for _, payload in queue.pop():
+                    status, _ = await connection.request("POST", webhook_path, json.dumps(payload).encode())
+                    if status != 200: raise RuntimeError(f"webhook answered {status}")
+
+        t0 = time.perf_counter(); queue = list(sessions); await asyncio.gather(*(sender(connection, queue) for connection in connections)); posted = sum(len(session) for session in sessions)
+        while sum((stats := await cluster_stats())["processed"]) < posted: await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - t0; api = await api_calls(); calls_handlers = sum(api["calls"].values()) - calls_after_startup
+        for connection in connections: connection.close()
+    finally:
+        monitor.close(); front.send_signal(signal.SIGTERM); await loop.run_in_executor(None, front.wait)
+        api = await api_calls("stop"); api_process.join()
+
+    db = sqlite3.connect("stats.db"); counted = dict(db.execute("SELECT name, count FROM events")).get("next_preview", 0)
+    clicks = {user_id: data for user_id, data in db.execute("SELECT user_id, json_extract(data, '$.preview_clicks') FROM users WHERE user_id IN (%s)" % ",".join("?" * len(user_ids)), [str(user_id) for user_id in user_ids])}
+    expected_clicks = min(args.next_clicks, 25) if args.scenario in ("previews", "all") else 0
+    return {"backend": "sqlite", "workers": args.workers, "preloaded_users": args.users, "active_users": args.active, "updates": posted, "startup_s": round(startup, 4),
+            "throughput_updates_per_s": round(posted / elapsed, 1) if elapsed else 0.0, "telegram_calls_per_update": round(calls_handlers / posted, 3) if posted else 0.0,
+            "telegram_calls": api["calls"], "upload_bytes": api["upload_bytes"], "routed_per_worker": stats["routed"],
+            "cluster_check": {"expected_next_preview_events": len(user_ids) * expected_clicks, "counted_next_preview_events": counted, "users_with_lost_clicks": sum(1 for user_id in user_ids if clicks.get(str(user_id)) != expected_clicks)}}
+
+
+class socket_reserved:
+    """Finds a free local TCP port (closed again on exit, so a subprocess can bind it)."""
+    def __enter__(self):
+        import socket
+        self.sock = socket.socket(); self.sock.bind(("127.0.0.1", 0)); return self.sock.getsockname()[1]
+
+    def __exit__(self, *exc): self.sock.close()
+
+
+def group_latency_check(args) -> dict:
+    runs = []
+    for group_latency in (0.0, args.group_latency_check):
+        command = [sys.executable, os.path.abspath(__file__), "--users", str(args.users), "--active", str(args.active), "--scenario", args.scenario, "--next-clicks", str(args.next_clicks),
+                   "--concurrency", str(args.concurrency), "--backend", args.backend, "--latency", str(args.latency), "--rate-limit", str(args.rate_limit), "--seed", str(args.seed), "--group-latency", str(group_latency)]
+        runs.append(json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout))
+    deltas = {key: round(runs[1][key] - runs[0][key], 3) for key in ("p50_ms", "p99_ms")}
+    return {"group_latency_s": [0.0, args.group_latency_check], "p50_ms": [run["p50_ms"] for run in runs], "p99_ms": [run["p99_ms"] for run in runs],
+            "delta_ms": deltas, "tolerance_ms": args.tolerance_ms, "ok": all(abs(delta) <= args.tolerance_ms for delta in deltas.values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="users preloaded into stats")
+    parser.add_argument("--active", type=int, default=100, help="users replaying a session")
+    parser.add_argument("--scenario", choices=["previews", "prices", "payments", "broadcast", "stress", "all"], default="all")
+    parser.add_argument("--next-clicks", type=int, default=5, help="'Nächstes Bild' clicks per preview session")
+    parser.add_argument("--concurrency", type=int, default=1, help="user sessions replayed in parallel (also CONCURRENT_UPDATES)")
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated API latency for user chats (s)")
+    parser.add_argument("--group-latency", type=float, default=0.0, help="simulated API latency for the notification group (s)")
+    parser.add_argument("--group-latency-check", type=float, help="compare handler latency at group latency 0 and this value (s); exit 1 if it differs")
+    parser.add_argument("--tolerance-ms", type=float, default=25.0, help="allowed p50/p99 difference for --group-latency-check")
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="TELEGRAM_RATE_LIMIT for the run (msgs/s)")
+    parser.add_argument("--workers", type=int, default=1, help="run the multi-process webhook deployment with N workers")
+    parser.add_argument("--memory", help="comma-separated user counts: measure the user table memory instead of replaying updates")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(); random.seed(args.seed)
+    if args.workers > 1 and (args.backend != "sqlite" or args.scenario not in ("previews", "prices", "payments")): parser.error("--workers needs --backend sqlite and a previews/prices/payments scenario")
+    if args.group_latency_check is not None:
+        if args.workers > 1 or args.memory: parser.error("--group-latency-check runs the single-process benchmark")
+        result = group_latency_check(args); print(json.dumps(result, indent=2)); sys.exit(0 if result["ok"] else 1)
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    try:
+        os.symlink(os.path.join(HERE, "image"), os.path.join(workdir, "image"))
+        stats = synthetic_stats(args.users); user_ids = None
+        if args.workers > 1:
+            user_ids = random.sample(range(100000, 100000 + max(args.users, args.active)), args.active)
+            # Fresh preview counters, so the cluster check can expect exactly --next-clicks per active user.
+            for user_id in user_ids: stats["users"].setdefault(str(user_id), {})["preview_clicks"] = 0
+        with open(os.path.join(workdir, "stats.json"), "w") as f: json.dump(stats, f)
+        os.chdir(workdir); sys.path.insert(0, HERE)
+        os.environ.update({"BOT_TOKEN": "123456:BENCH", "ADMIN_USER_ID": str(ADMIN_ID), "NOTIFICATION_GROUP_ID": str(GROUP_ID), "STATS_BACKEND": args.backend, "PAYPAL_USER": "bench", "TELEGRAM_RATE_LIMIT": str(args.rate_limit), "ADMIN_GROUP_RATE_LIMIT": str(args.rate_limit * 60), "CONCURRENT_UPDATES": str(args.concurrency)})
+        os.environ.pop("WEBHOOK_URL", None)
+        import logging
+        logging.disable(logging.WARNING)
+        if args.memory: print(json.dumps(memory_benchmark([int(count) for count in args.memory.split(",")]), indent=2)); return
+        print(json.dumps(asyncio.run(run_cluster(args, user_ids) if args.workers > 1 else run(args)), indent=2))
+    finally:
+        os.chdir(HERE); shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,19 +7,41 @@ from datetime import datetime, timedelta
 from io import BytesIO
 import asyncio
 import re
+import csv
+import hashlib
+import sys
+import gzip
+import tempfile
+import fcntl
+import sqlite3
+import bisect
+import heapq
+import threading
+import socket
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from math import ceil
+from collections import OrderedDict
+from array import array
 
+import httpx
 from fpdf import FPDF
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, error, InputMediaPhoto, User
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, error, InputMediaPhoto, InputMediaDocument, User, Message
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
+    CallbackContext,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
 from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest, HTTPXRequest
 
 # --- Konfiguration ---
 load_dotenv()
@@ -30,72 +52,1509 @@ AGE_ANNA = os.getenv("AGE_ANNA", "18")
 AGE_LUNA = os.getenv("AGE_LUNA", "21")
 ADMIN_USER_ID = os.getenv("ADMIN_USER_ID")
 NOTIFICATION_GROUP_ID = os.getenv("NOTIFICATION_GROUP_ID")
+# Bot-API-Transport: je Lane ein eigener Verbindungspool (media = Uploads/Downloads, control = Antworten an Nutzer,
+# admin = Benachrichtigungsgruppe). Timeouts in Sekunden, Pool-Timeout = maximale Wartezeit auf eine freie Verbindung.
+TELEGRAM_CONTROL_POOL_SIZE = int(os.getenv("TELEGRAM_CONTROL_POOL_SIZE", "64"))
+TELEGRAM_CONTROL_TIMEOUT = float(os.getenv("TELEGRAM_CONTROL_TIMEOUT", "5"))
+TELEGRAM_CONTROL_POOL_TIMEOUT = float(os.getenv("TELEGRAM_CONTROL_POOL_TIMEOUT", "2"))
+TELEGRAM_MEDIA_POOL_SIZE = int(os.getenv("TELEGRAM_MEDIA_POOL_SIZE", "16"))
+TELEGRAM_MEDIA_TIMEOUT = float(os.getenv("TELEGRAM_MEDIA_TIMEOUT", "30"))
+TELEGRAM_MEDIA_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_MEDIA_WRITE_TIMEOUT", "60"))
+TELEGRAM_MEDIA_POOL_TIMEOUT = float(os.getenv("TELEGRAM_MEDIA_POOL_TIMEOUT", "10"))
+TELEGRAM_ADMIN_POOL_SIZE = int(os.getenv("TELEGRAM_ADMIN_POOL_SIZE", "4"))
+TELEGRAM_ADMIN_TIMEOUT = float(os.getenv("TELEGRAM_ADMIN_TIMEOUT", "10"))
+TELEGRAM_ADMIN_POOL_TIMEOUT = float(os.getenv("TELEGRAM_ADMIN_POOL_TIMEOUT", "30"))
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.getenv("TELEGRAM_KEEPALIVE_EXPIRY", "30"))
+TELEGRAM_POOL_WARN_INTERVAL = float(os.getenv("TELEGRAM_POOL_WARN_INTERVAL", "60"))
 
 BTC_WALLET = "1FcgMLNBDLiuDSDip7AStuP19sq47LJB12"
 ETH_WALLET = "0xeeb8FDc4aAe71B53934318707d0e9747C5c66f6e"
 
 PRICES = {"bilder": {10: 5, 25: 10, 35: 15}, "videos": {10: 15, 25: 25, 35: 30}}
 VOUCHER_FILE = "vouchers.json"
+VOUCHER_LEDGER_FILE = os.getenv("VOUCHER_LEDGER_FILE", "vouchers.jsonl")
+VOUCHER_PAGE_SIZE = int(os.getenv("VOUCHER_PAGE_SIZE", "20"))
+VOUCHER_REPORT_DIR = os.getenv("VOUCHER_REPORT_DIR", "reports")
 STATS_FILE = "stats.json"
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+STATS_FLUSH_DELAY = float(os.getenv("STATS_FLUSH_DELAY", "5"))
+STATS_CACHE_ROWS = int(os.getenv("STATS_CACHE_ROWS", "10000"))
+STATS_BACKEND = os.getenv("STATS_BACKEND", "sqlite")
+STATS_DB = os.getenv("STATS_DB", "stats.db")
+SESSION_UPDATE_INTERVAL = float(os.getenv("SESSION_UPDATE_INTERVAL", "10"))
 MEDIA_DIR = "image"
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", "10000"))
+MEDIA_CACHE_FILE = os.getenv("MEDIA_CACHE_FILE", "media_cache.json")
+MEDIA_DERIVED_DIR = os.getenv("MEDIA_DERIVED_DIR", "image_derived")
+MEDIA_MAX_SIDE = int(os.getenv("MEDIA_MAX_SIDE", "1280"))
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "82"))
+PREVIEW_CACHE_CHAT_ID = os.getenv("PREVIEW_CACHE_CHAT_ID")
+PREVIEW_PREFETCH_CACHE_SIZE = int(os.getenv("PREVIEW_PREFETCH_CACHE_SIZE", "64"))
+PREVIEW_PREFETCH_WAIT = float(os.getenv("PREVIEW_PREFETCH_WAIT", "3"))
+TELEGRAM_RATE_LIMIT = float(os.getenv("TELEGRAM_RATE_LIMIT", "25"))
+ADMIN_GROUP_RATE_LIMIT = float(os.getenv("ADMIN_GROUP_RATE_LIMIT", "20"))
+SIDE_EFFECT_QUEUE_SIZE = int(os.getenv("SIDE_EFFECT_QUEUE_SIZE", "1000"))
+SIDE_EFFECT_WORKERS = int(os.getenv("SIDE_EFFECT_WORKERS", "4"))
+SIDE_EFFECT_DRAIN_TIMEOUT = float(os.getenv("SIDE_EFFECT_DRAIN_TIMEOUT", "30"))
+DISCOUNT_BACKUP_INTERVAL = float(os.getenv("DISCOUNT_BACKUP_INTERVAL", "600"))
+INACTIVITY_DISCOUNT_AFTER = float(os.getenv("INACTIVITY_DISCOUNT_AFTER", "2"))  # hours after first_start
+INACTIVITY_DISCOUNT_INTERVAL = float(os.getenv("INACTIVITY_DISCOUNT_INTERVAL", "10"))
+INACTIVITY_DISCOUNT_BATCH = int(os.getenv("INACTIVITY_DISCOUNT_BATCH", "100"))
+ADMIN_LOG_INTERVAL = float(os.getenv("ADMIN_LOG_INTERVAL", "10"))
+ADMIN_LOG_HASH_CACHE = int(os.getenv("ADMIN_LOG_HASH_CACHE", "5000"))
+ADMIN_LOG_SHUTDOWN_TIMEOUT = float(os.getenv("ADMIN_LOG_SHUTDOWN_TIMEOUT", "5"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "3"))
+DASHBOARD_INTERVAL = float(os.getenv("DASHBOARD_INTERVAL", "30"))
+ACTIVITY_BUCKET_SECONDS = int(os.getenv("ACTIVITY_BUCKET_SECONDS", "300"))
+STATS_SNAPSHOTS = int(os.getenv("STATS_SNAPSHOTS", "12"))
+PAYMENT_HISTORY = int(os.getenv("PAYMENT_HISTORY", "20"))
+CLEANUP_CONCURRENCY = int(os.getenv("CLEANUP_CONCURRENCY", "5"))
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast.json")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+STATS_SYNC_INTERVAL = float(os.getenv("STATS_SYNC_INTERVAL", "1"))
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "15"))
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 DISCOUNT_MSG_HEADER = "--- BOT DISCOUNT DATA (DO NOT DELETE) ---"
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Hilfsfunktionen ---
-def load_vouchers():
+def atomic_write_json(path: str, data, **dump_kwargs) -> int:
+    """Writes JSON to a temp file next to `path` and renames it into place. Returns the bytes written."""
+    payload = json.dumps(data, **dump_kwargs).encode("utf-8"); return atomic_write_bytes(path, payload)
+
+def atomic_write_bytes(path: str, payload: bytes) -> int:
+    directory = os.path.dirname(os.path.abspath(path)); fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
     try:
-        with open(VOUCHER_FILE, "r") as f: return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError): return {"amazon": [], "paysafe": []}
+        with os.fdopen(fd, "wb") as f: f.write(payload); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
+    return len(payload)
 
-def save_vouchers(vouchers):
-    with open(VOUCHER_FILE, "w") as f: json.dump(vouchers, f, indent=2)
+# --- Metriken ---
+class Metrics:
+    """Minimal Prometheus-style registry. Counters and histograms are keyed by (name, labels) and recording is a dict
+    update; gauges are callbacks read on scrape. The text exposition is only built when /metrics is requested."""
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
 
-def load_stats():
+    def __init__(self):
+        self.counters = {}; self.histograms = {}; self.gauges = {}; self.descriptions = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self.descriptions[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items()))); self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items()))); histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.BUCKETS, value)] += 1; histogram[1] += value; histogram[2] += 1
+
+    def gauge(self, name: str, kind: str, text: str, read):
+        """`read()` returns a number or a {labels tuple: number} dict."""
+        self.describe(name, kind, text); self.gauges[name] = read
+
+    @staticmethod
+    def _labels(labels, extra: tuple = ()) -> str:
+        pairs = [*labels, *extra]
+        if not pairs: return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        series = {}
+        for (name, labels), value in self.counters.items(): series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in self.histograms.items():
+            lines = series.setdefault(name, []); cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                cumulative += bucket_count; lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf' if bound == float('inf') else repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}"); lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, read in self.gauges.items():
+            try: value = read()
+            except Exception as e: logger.warning(f"Metrik {name} nicht lesbar: {e}"); continue
+            series[name] = [f"{name}{self._labels(labels)} {v}" for labels, v in value.items()] if isinstance(value, dict) else [f"{name} {value}"]
+        out = []
+        for name in sorted(series):
+            kind, text = self.descriptions.get(name, ("untyped", ""))
+            out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}", *series[name]]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Handler latency per route (callback route, command or text).")
+metrics.describe("bot_handler_errors_total", "counter", "Handler exceptions per route.")
+metrics.describe("telegram_api_seconds", "histogram", "Bot API call latency per method.")
+metrics.describe("telegram_api_calls_total", "counter", "Bot API calls per method and HTTP status (or exception).")
+metrics.describe("telegram_upload_bytes_total", "counter", "Bytes uploaded to the Bot API per method.")
+metrics.describe("telegram_retry_after_total", "counter", "RetryAfter (flood control) answers per method.")
+metrics.describe("bot_callback_unmatched_total", "counter", "Callback queries without a matching route or with invalid arguments.")
+metrics.describe("stats_flush_seconds", "histogram", "Time to write the stats store.")
+metrics.describe("stats_flush_errors_total", "counter", "Failed stats store writes.")
+
+def timed_handler(callback, route: str):
+    """Records latency and exceptions of a handler under `route`; also the timing middleware of the callback router."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        started = time.perf_counter()
+        try: return await callback(update, context, *args)
+        except Exception: metrics.inc("bot_handler_errors_total", route=route); raise
+        finally: metrics.observe("bot_handler_seconds", time.perf_counter() - started, route=route)
+    wrapper.__name__ = callback.__name__; return wrapper
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the HTTP transport and records every Bot API call: latency and status per method, upload bytes."""
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self): return self.inner.read_timeout
+
+    async def initialize(self): await self.inner.initialize()
+
+    async def shutdown(self): await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = "file_download" if "/file/bot" in url else url.rsplit("/", 1)[-1]; started = time.perf_counter(); status = "error"
+        if request_data is not None and request_data.contains_files:
+            metrics.inc("telegram_upload_bytes_total", sum(len(part[1]) for part in request_data.multipart_data.values() if isinstance(part, tuple)), method=api_method)
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data=request_data, read_timeout=read_timeout, write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+            status = str(code); return code, payload
+        except Exception as e: status = type(e).__name__; raise
+        finally:
+            metrics.observe("telegram_api_seconds", time.perf_counter() - started, method=api_method); metrics.inc("telegram_api_calls_total", method=api_method, status=status)
+
+async def handle_metrics_request(method: str, path: str, headers: dict, body: bytes):
+    if method == "GET" and path.split("?", 1)[0] == "/metrics": return 200, metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+    return 404, b"", "text/plain"
+
+metrics_server = None
+
+# --- HTTP-Transport ---
+class TransportLane:
+    """One HTTPXRequest with its own connection pool and timeouts. Counts the requests in flight; reaching the pool
+    size means further requests of this lane wait for a connection (logged at most every TELEGRAM_POOL_WARN_INTERVAL)."""
+    def __init__(self, name: str, pool_size: int, timeout: float, pool_timeout: float, media_write_timeout: float = None):
+        self.name = name; self.pool_size = pool_size; self.in_flight = 0; self.peak = 0; self.last_warning = 0.0
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY)
+        self.request = HTTPXRequest(connection_pool_size=pool_size, read_timeout=timeout, write_timeout=timeout, connect_timeout=min(timeout, 10), pool_timeout=pool_timeout,
+                                    media_write_timeout=media_write_timeout or timeout, httpx_kwargs={"limits": limits})
+
+    def enter(self):
+        self.in_flight += 1; self.peak = max(self.peak, self.in_flight)
+        if self.in_flight <= self.pool_size: return
+        metrics.inc("telegram_lane_saturated_total", lane=self.name); now = time.monotonic()
+        if now - self.last_warning >= TELEGRAM_POOL_WARN_INTERVAL:
+            self.last_warning = now; logger.warning(f"Verbindungspool '{self.name}' ausgelastet ({self.in_flight} Anfragen, {self.pool_size} Verbindungen), Anfragen warten.")
+
+class LaneRequest(BaseRequest):
+    """Routes every Bot API call to a lane, so slow uploads cannot take the connections that quick replies need:
+    admin for everything sent to the notification group, media for uploads and file downloads, control for the rest."""
+    def __init__(self, lanes: dict):
+        self.lanes = lanes
+
+    @classmethod
+    def from_env(cls) -> "LaneRequest":
+        return cls({"control": TransportLane("control", TELEGRAM_CONTROL_POOL_SIZE, TELEGRAM_CONTROL_TIMEOUT, TELEGRAM_CONTROL_POOL_TIMEOUT),
+                    "media": TransportLane("media", TELEGRAM_MEDIA_POOL_SIZE, TELEGRAM_MEDIA_TIMEOUT, TELEGRAM_MEDIA_POOL_TIMEOUT, TELEGRAM_MEDIA_WRITE_TIMEOUT),
+                    "admin": TransportLane("admin", TELEGRAM_ADMIN_POOL_SIZE, TELEGRAM_ADMIN_TIMEOUT, TELEGRAM_ADMIN_POOL_TIMEOUT, TELEGRAM_MEDIA_WRITE_TIMEOUT)})
+
+    @staticmethod
+    def lane_for(url: str, request_data) -> str:
+        if "/file/bot" in url: return "media"
+        if request_data is None: return "control"
+        if NOTIFICATION_GROUP_ID and str(request_data.parameters.get("chat_id")) == str(NOTIFICATION_GROUP_ID): return "admin"
+        return "media" if request_data.contains_files else "control"
+
+    @property
+    def read_timeout(self): return self.lanes["control"].request.read_timeout
+
+    async def initialize(self):
+        for lane in self.lanes.values(): await lane.request.initialize()
+
+    async def shutdown(self):
+        for lane in self.lanes.values(): await lane.request.shutdown()
+        logger.info("Verbindungspools (Spitze/Größe): " + ", ".join(f"{lane.name} {lane.peak}/{lane.pool_size}" for lane in self.lanes.values()))
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        lane = self.lanes[self.lane_for(url, request_data)]; lane.enter()
+        try: return await lane.request.do_request(url, method, request_data=request_data, read_timeout=read_timeout, write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+        except error.TimedOut as e:
+            if "pool" in str(e).lower(): metrics.inc("telegram_lane_pool_timeouts_total", lane=lane.name); logger.warning(f"Keine freie Verbindung im Pool '{lane.name}': {e}")
+            raise
+        finally: lane.in_flight -= 1
+
+transport_lanes = None
+metrics.gauge("telegram_lane_in_flight", "gauge", "Bot API requests in flight per transport lane.", lambda: {(("lane", name),): lane.in_flight for name, lane in (transport_lanes.lanes.items() if transport_lanes else ())})
+metrics.gauge("telegram_lane_pool_size", "gauge", "Connection pool size per transport lane.", lambda: {(("lane", name),): lane.pool_size for name, lane in (transport_lanes.lanes.items() if transport_lanes else ())})
+metrics.describe("telegram_lane_saturated_total", "counter", "Requests that found their lane's connection pool fully in use.")
+metrics.describe("telegram_lane_pool_timeouts_total", "counter", "Requests that gave up waiting for a free connection.")
+
+# --- Gutschein-Ledger (Append-Only) ---
+VOUCHER_CODE_SEPARATORS = re.compile(r"[\s-]+")
+
+class VoucherLedger:
+    """Append-only JSONL log of submitted vouchers. Records are kept in memory in submission order (the record id is
+    the position), a hash index over the normalized code rejects duplicates in O(1), and a submission is one appended line.
+    Several worker processes may share the file: every read first takes in the lines appended since the last one, and
+    add() appends under an exclusive lock on `<path>.lock` after doing the same, so duplicates are rejected across workers."""
+    def __init__(self, path: str, legacy_path: str = None):
+        self.path = path; self.legacy_path = legacy_path; self.records = None; self.index = {}; self.offset = 0; self.lines = 0
+
+    @staticmethod
+    def normalize(provider: str, code: str) -> str:
+        return f"{provider}:{VOUCHER_CODE_SEPARATORS.sub('', code).upper()}"
+
+    @contextmanager
+    def _locked(self):
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        if self.records is None:
+            self.records = []; self.index = {}; self.offset = 0; self.lines = 0
+            if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+                with self._locked():
+                    if not os.path.exists(self.path): self._migrate_legacy()
+        self._catch_up()
+
+    def _catch_up(self):
+        try: size = os.path.getsize(self.path)
+        except FileNotFoundError: return
+        if size < self.offset: self.records = []; self.index = {}; self.offset = 0; self.lines = 0  # file was replaced
+        if size == self.offset: return
+        with open(self.path, "rb") as f: f.seek(self.offset); data = f.read(size - self.offset)
+        end = data.rfind(b"\n") + 1  # a line another worker is still writing is taken in next time
+        for line in data[:end].splitlines():
+            self.lines += 1
+            if not line.strip(): continue
+            try: record = json.loads(line)
+            except json.JSONDecodeError: logger.warning(f"Ungültige Zeile {self.lines} in {self.path} übersprungen."); continue
+            self._index_record(record)
+        self.offset += end
+
+    def _index_record(self, record: dict):
+        record["id"] = len(self.records); self.records.append(record); self.index.setdefault(self.normalize(record["provider"], record["code"]), record["id"])
+
+    def _migrate_legacy(self):
+        try:
+            with open(self.legacy_path, "r") as f: legacy = json.load(f)
+        except (OSError, json.JSONDecodeError): return
+        lines = [json.dumps({"provider": provider, "code": code, "user_id": None, "user_name": None, "ts": None, "status": "offen"}, ensure_ascii=False) for provider, codes in legacy.items() for code in codes]
+        atomic_write_bytes(self.path, "".join(f"{line}\n" for line in lines).encode("utf-8"))
+        logger.info(f"{len(lines)} Gutscheine aus {self.legacy_path} in {self.path} übernommen.")
+
+    async def add(self, provider: str, code: str, user_id=None, user_name=None, status: str = "offen"):
+        """Appends a voucher and returns its record, or None if the code was already submitted for this provider. The
+        locked append and fsync run in a worker thread; the in-memory records are only updated on the event loop."""
+        self._load(); normalized = self.normalize(provider, code)
+        if normalized in self.index: return None
+        record = {"provider": provider, "code": code, "user_id": user_id, "user_name": user_name, "ts": int(time.time()), "status": status}
+        if not await asyncio.to_thread(self._append, record, normalized, self.offset): return None
+        self._catch_up(); return self.records[self.index[normalized]]
+
+    def _append(self, record: dict, normalized: str, offset: int) -> bool:
+        # Lines appended since `offset` (by other workers or a concurrent add()) are checked for the code under the lock.
+        with self._locked():
+            try:
+                with open(self.path, "rb") as f: f.seek(offset); appended = f.read()
+            except FileNotFoundError: appended = b""
+            for line in appended.splitlines():
+                try: other = json.loads(line)
+                except json.JSONDecodeError: continue
+                if self.normalize(other["provider"], other["code"]) == normalized: return False
+            with open(self.path, "a", encoding="utf-8") as f: f.write(json.dumps(record, ensure_ascii=False) + "\n"); f.flush(); os.fsync(f.fileno())
+        return True
+
+    def page(self, before: int = None, limit: int = 20):
+        """Newest-first page of records with id < `before`. Returns (records, next_cursor); next_cursor is None on the last page."""
+        self._load(); end = len(self.records) if before is None else max(0, min(before, len(self.records))); start = max(0, end - limit)
+        return list(reversed(self.records[start:end])), (start if start > 0 else None)
+
+    def __len__(self):
+        self._load(); return len(self.records)
+
+    def snapshot(self):
+        """Returns (version, records) for readers running outside the event loop. The version is the record count, the
+        same in every worker for the same records; records are never mutated after append."""
+        self._load(); return len(self.records), self.records[:]
+
+voucher_ledger = VoucherLedger(VOUCHER_LEDGER_FILE, legacy_path=VOUCHER_FILE)
+
+# --- Gutschein-Reports ---
+VOUCHER_REPORT_COLUMNS = (("#", 12), ("Anbieter", 22), ("Code", 62), ("Nutzer", 44), ("Datum", 30), ("Status", 20))
+
+def _latin1(value) -> str:
+    return str(value).encode("latin-1", "ignore").decode("latin-1")
+
+def _voucher_row(record: dict) -> tuple:
+    submitted = datetime.fromtimestamp(record["ts"]).strftime("%d.%m.%Y %H:%M") if record.get("ts") else "unbekannt"
+    submitter = f"{record.get('user_name') or ''} ({record['user_id']})".strip() if record.get("user_id") else "unbekannt"
+    return (record["id"] + 1, record["provider"].capitalize(), record["code"], submitter, submitted, record.get("status", "offen"))
+
+class VoucherReportPDF(FPDF):
+    """Voucher table that repeats its title and column header on every page, so rows can be written one at a time."""
+    def header(self):
+        self.set_font("Helvetica", "B", 14); self.cell(0, 10, "Gutschein Report", new_x="LMARGIN", new_y="NEXT", align="C")
+        self.set_font("Helvetica", "B", 9); self.set_fill_color(230, 230, 230)
+        for title, width in VOUCHER_REPORT_COLUMNS: self.cell(width, 7, title, border=1, fill=True)
+        self.ln(); self.set_font("Helvetica", size=9)
+
+    def footer(self):
+        self.set_y(-12); self.set_font("Helvetica", "I", 8); self.cell(0, 8, f"Seite {self.page_no()}", align="C")
+
+def write_voucher_pdf(records: list, path: str):
+    pdf = VoucherReportPDF(); pdf.set_auto_page_break(True, margin=15); pdf.add_page()
+    if not records: pdf.cell(0, 8, "Keine Gutscheine vorhanden.", new_x="LMARGIN", new_y="NEXT")
+    for record in records:
+        for value, (_, width) in zip(_voucher_row(record), VOUCHER_REPORT_COLUMNS): pdf.cell(width, 6, _latin1(value), border=1)
+        pdf.ln()
+    pdf.output(path)
+
+def write_voucher_csv(records: list, path: str):
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f, delimiter=";"); writer.writerow([title for title, _ in VOUCHER_REPORT_COLUMNS])
+        for record in records: writer.writerow(_voucher_row(record))
+
+VOUCHER_REPORT_WRITERS = {"pdf": write_voucher_pdf, "csv": write_voucher_csv}
+
+class VoucherReports:
+    """Builds voucher reports in a worker thread and keeps them on disk per (format, ledger version). Concurrent requests for
+    the same report share one build, and the Telegram file_id of a sent report is reused until the ledger changes.
+    `name` prefixes the files; every worker process uses its own, so cleaning up never removes another worker's report."""
+    def __init__(self, ledger: VoucherLedger, report_dir: str, name: str = "vouchers"):
+        self.ledger = ledger; self.report_dir = report_dir; self.name = name; self._builds = {}; self.file_ids = {}
+
+    def path(self, fmt: str, version: int) -> str:
+        return os.path.join(self.report_dir, f"{self.name}_v{version}.{fmt}")
+
+    def _build(self, fmt: str, version: int, records: list) -> str:
+        os.makedirs(self.report_dir, exist_ok=True); path = self.path(fmt, version)
+        if os.path.exists(path): return path
+        fd, tmp_path = tempfile.mkstemp(prefix=".report.", suffix=f".{fmt}", dir=self.report_dir); os.close(fd)
+        try: VOUCHER_REPORT_WRITERS[fmt](records, tmp_path); os.replace(tmp_path, path)
+        except BaseException:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+        for filename in os.listdir(self.report_dir):
+            if filename.endswith(f".{fmt}") and filename.startswith(f"{self.name}_v") and filename != os.path.basename(path):
+                try: os.unlink(os.path.join(self.report_dir, filename))
+                except OSError: pass
+        return path
+
+    async def get(self, fmt: str):
+        """Returns (version, path) of the report for the current ledger, building it off the event loop if needed."""
+        version, records = self.ledger.snapshot(); key = (fmt, version); build = self._builds.get(key)
+        if build is None:
+            for old_key in [k for k in self._builds if k[0] == fmt]: del self._builds[old_key]
+            build = self._builds[key] = asyncio.ensure_future(asyncio.to_thread(self._build, fmt, version, records))
+        try: return version, await asyncio.shield(build)
+        except Exception: self._builds.pop(key, None); raise
+
+    async def send(self, bot, chat_id, fmt: str):
+        version, path = await self.get(fmt); today_str = datetime.now().strftime("%Y-%m-%d"); caption = f"Hier ist dein aktueller Gutschein-Report ({len(self.ledger)} Gutscheine)."
+        cached_version, file_id = self.file_ids.get(fmt, (None, None))
+        if file_id and cached_version == version:
+            try: await bot.send_document(chat_id=chat_id, document=file_id, caption=caption); return
+            except error.BadRequest as e: logger.warning(f"file_id des Gutschein-Reports ungültig, lade neu hoch: {e}")
+        with open(path, "rb") as f: message = await bot.send_document(chat_id=chat_id, document=f, filename=f"Gutschein-Report_{today_str}.{fmt}", caption=caption)
+        if message.document: self.file_ids[fmt] = (version, message.document.file_id)
+
+voucher_reports = VoucherReports(voucher_ledger, VOUCHER_REPORT_DIR, name=f"vouchers_w{WORKER_INDEX}" if WORKER_COUNT > 1 else "vouchers")
+
+# --- Nutzer-Modell ---
+SISTER_CODES = ("ks", "gs")
+PAYMENT_METHODS = ("PayPal", "Gutschein", "Krypto")
+PAYMENT_ENTRY = re.compile(r"(PayPal|Gutschein|Krypto): (0|[1-9]\d{0,6})€")
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+referral_index = {}  # referrer user id -> array of referred user ids; most users never refer anyone
+
+def micros_to_datetime(micros: int) -> datetime: return EPOCH + timedelta(0, 0, micros)
+
+def iso_to_micros(value):
+    """Integer microseconds since 1970 (naive, like the stored ISO strings), or None if `value` would not come back
+    unchanged from micros_to_datetime(...).isoformat()."""
+    if not isinstance(value, str): return None
+    try: micros = (datetime.fromisoformat(value) - EPOCH) // MICROSECOND
+    except (ValueError, TypeError): return None
+    return micros if micros_to_datetime(micros).isoformat() == value else None
+
+def _id_array(values):
+    if not isinstance(values, list) or not all(isinstance(value, str) and value.isdigit() and str(int(value)) == value for value in values): return None
+    return array("q", map(int, values))
+
+class UserRecord(MutableMapping):
+    """One entry of stats["users"] in compact form, still usable as the dict it replaces. Timestamps are integer
+    microseconds, the boolean fields one flags int, viewed_sisters a bitmask over SISTER_CODES, payments_initiated
+    packed (method index << 24 | price) ints and referrals live in referral_index. A value that does not fit its encoding
+    (unknown key, odd type, non-canonical order) is kept as is in `extra`, so to_json() returns exactly what from_json()
+    got."""
+    __slots__ = ("user_id", "present", "flags", "first_start", "last_start", "preview_clicks", "successful_referrals", "sisters", "payments", "referrer_id", "discounts", "extra")
+    FIELDS = ("first_start", "last_start", "discount_sent", "preview_clicks", "viewed_sisters", "payments_initiated", "banned", "referrer_id", "referrals", "successful_referrals", "reward_triggered_for_referrer", "blocked", "discounts")
+    FIELD_BITS = {name: 1 << index for index, name in enumerate(FIELDS)}
+    FLAGS = {"discount_sent": 1, "banned": 2, "reward_triggered_for_referrer": 4, "blocked": 8}
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id; self.present = 0; self.flags = 0; self.first_start = self.last_start = self.referrer_id = self.discounts = self.extra = None
+        self.preview_clicks = self.successful_referrals = self.sisters = 0; self.payments = None
+
+    @classmethod
+    def from_json(cls, user_id: str, data: dict) -> "UserRecord":
+        record = cls(user_id)
+        for key, value in data.items(): record[key] = value
+        return record
+
+    def to_json(self) -> dict: return dict(self.items())
+
+    def _store(self, name: str, value) -> bool:
+        if name in self.FLAGS:
+            if type(value) is not bool: return False
+            self.flags = self.flags | self.FLAGS[name] if value else self.flags & ~self.FLAGS[name]
+        elif name in ("first_start", "last_start"):
+            micros = iso_to_micros(value)
+            if micros is None: return False
+            setattr(self, name, micros)
+        elif name in ("preview_clicks", "successful_referrals"):
+            if type(value) is not int: return False
+            setattr(self, name, value)
+        elif name == "viewed_sisters":
+            if not isinstance(value, list) or value != [code for code in SISTER_CODES if code in value]: return False
+            self.sisters = sum(1 << SISTER_CODES.index(code) for code in value)
+        elif name == "payments_initiated":
+            matches = [PAYMENT_ENTRY.fullmatch(entry) if isinstance(entry, str) else None for entry in value] if isinstance(value, list) else [None]
+            if not all(matches): return False
+            self.payments = array("I", (PAYMENT_METHODS.index(match[1]) << 24 | int(match[2]) for match in matches)) if matches else None
+        elif name == "referrer_id":
+            if value is None: self.referrer_id = None
+            elif isinstance(value, str) and value.isdigit() and str(int(value)) == value: self.referrer_id = int(value)
+            else: return False
+        elif name == "referrals":
+            ids = _id_array(value)
+            if ids is None: return False
+            if ids: referral_index[self.user_id] = ids
+            else: referral_index.pop(self.user_id, None)
+        elif name == "discounts": self.discounts = value
+        else: return False
+        return True
+
+    def _load(self, name: str):
+        if name in self.FLAGS: return bool(self.flags & self.FLAGS[name])
+        if name in ("first_start", "last_start"): return micros_to_datetime(getattr(self, name)).isoformat()
+        if name in ("preview_clicks", "successful_referrals"): return getattr(self, name)
+        if name == "viewed_sisters": return [code for index, code in enumerate(SISTER_CODES) if self.sisters >> index & 1]
+        if name == "payments_initiated": return [f"{PAYMENT_METHODS[code >> 24]}: {code & 0xFFFFFF}€" for code in self.payments or ()]
+        if name == "referrer_id": return None if self.referrer_id is None else str(self.referrer_id)
+        if name == "referrals": return [str(user_id) for user_id in referral_index.get(self.user_id, ())]
+        return self.discounts
+
+    def _clear(self, name: str):
+        if name == "referrals": referral_index.pop(self.user_id, None)
+        elif name == "discounts": self.discounts = None
+        elif name == "payments_initiated": self.payments = None
+        self.present &= ~self.FIELD_BITS[name]
+
+    def _drop_extra(self, key: str):
+        if self.extra is not None:
+            self.extra.pop(key, None)
+            if not self.extra: self.extra = None
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra: return self.extra[key]
+        if not self.present & self.FIELD_BITS.get(key, 0): raise KeyError(key)
+        return self._load(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELD_BITS and self._store(key, value):
+            self.present |= self.FIELD_BITS[key]; self._drop_extra(key); return
+        if self.present & self.FIELD_BITS.get(key, 0): self._clear(key)
+        if self.extra is None: self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if self.extra is not None and key in self.extra: self._drop_extra(key)
+        elif self.present & self.FIELD_BITS.get(key, 0): self._clear(key)
+        else: raise KeyError(key)
+
+    def __iter__(self):
+        yield from (name for name in self.FIELDS if self.present & self.FIELD_BITS[name] and not (self.extra and name in self.extra))
+        if self.extra: yield from self.extra
+
+    def __len__(self): return sum(1 for _ in self)
+
+    def time(self, key: str):
+        """first_start/last_start as datetime, without parsing a string. None for a value kept in `extra` that is not
+        an ISO timestamp (e.g. a number from a hand-edited stats file)."""
+        if self.extra is None or key not in self.extra: return EPOCH + timedelta(0, 0, getattr(self, key)) if self.present & self.FIELD_BITS[key] else None
+        value = self.extra[key]
+        if not value or not isinstance(value, str): return None
+        try: return datetime.fromisoformat(value)
+        except ValueError: return None
+
+    def set_time(self, key: str, when: datetime):
+        setattr(self, key, (when - EPOCH) // MICROSECOND); self.present |= self.FIELD_BITS[key]; self._drop_extra(key)
+
+class TrackedUserRecord(UserRecord):
+    """UserRecord loaded by a SqliteTable: every change marks its row for write-back, so in-place edits such as
+    stats["users"][user_id]["banned"] = True need no extra call. Values changed inside a nested dict or list are not
+    seen; assign a new value instead."""
+    __slots__ = ("table",)
+
+    def __init__(self, user_id: str):
+        super().__init__(user_id); self.table = None
+
+    def __setitem__(self, key, value):
+        if self.table is not None: self.table.mark(self.user_id, self)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if self.table is not None and key in self: self.table.mark(self.user_id, self)
+        super().__delitem__(key)
+
+    def set_time(self, key: str, when: datetime):
+        if self.table is not None: self.table.mark(self.user_id, self)
+        super().set_time(key, when)
+
+class UserTable(dict):
+    """stats["users"] of the JSON backend: user dicts are stored as UserRecords."""
+    @classmethod
+    def of(cls, users: dict) -> "UserTable":
+        table = cls()
+        for user_id, user in users.items(): table[user_id] = user
+        return table
+
+    def __setitem__(self, user_id, user):
+        super().__setitem__(user_id, user if isinstance(user, UserRecord) else UserRecord.from_json(user_id, user))
+
+    def setdefault(self, user_id, default=None):
+        if user_id not in self: self[user_id] = {} if default is None else default
+        return self[user_id]
+
+def user_time(user_data, key: str):
+    if isinstance(user_data, UserRecord): return user_data.time(key)
+    value = user_data.get(key); return datetime.fromisoformat(value) if value else None
+
+def set_user_time(user_data, key: str, when: datetime):
+    if isinstance(user_data, UserRecord): user_data.set_time(key, when)
+    else: user_data[key] = when.isoformat()
+
+def json_default(value):
+    if isinstance(value, UserRecord): return value.to_json()
+    raise TypeError(f"{type(value).__name__} ist nicht JSON-serialisierbar")
+
+# --- Statistik-Speicher (In-Memory, Write-Behind) ---
+class StatsStore:
+    """Holds stats.json in memory. Mutations mark the store dirty; a debounced timer writes it back atomically."""
+    def __init__(self, path: str, flush_delay: float):
+        self.path = path; self.flush_delay = flush_delay; self.data = None; self.dirty = False; self.bytes_written = 0
+        self._flush_handle = None; self._write_lock = asyncio.Lock()
+
+    @staticmethod
+    def empty() -> dict: return {"pinned_message_id": None, "discount_message_id": None, "users": {}, "admin_logs": {}, "events": {}, "sessions": {}}
+
+    def get(self) -> dict:
+        if self.data is None:
+            try:
+                with open(self.path, "r") as f: self.data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError): self.data = self.empty()
+            for key, default in self.empty().items(): self.data.setdefault(key, default)
+            self.data["users"] = UserTable.of(self.data["users"])
+        return self.data
+
+    def save(self, stats: dict):
+        if stats is not self.data: self.data = stats
+        if type(stats["users"]) is dict: stats["users"] = UserTable.of(stats["users"])  # a plain dict put in by a handler, not the lazy SQLite table
+        self.dirty = True
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: self.flush(); return
+        if self._flush_handle is None: self._flush_handle = loop.call_later(self.flush_delay, lambda: asyncio.ensure_future(self.flush_async()))
+
+    def users_active_since(self, since: datetime) -> list:
+        return [(user_id, user_data["last_start"]) for user_id, user_data in self.get().get("users", {}).items() if user_data.get("last_start", "") >= since.isoformat()]
+
+    def count_active_since(self, since: datetime) -> int:
+        return len(self.users_active_since(since))
+
+    def all_discounts(self) -> dict:
+        return {user_id: user_data["discounts"] for user_id, user_data in self.get().get("users", {}).items() if user_data.get("discounts") is not None}
+
+    def inactivity_candidates(self) -> list:
+        """(user id, first_start) of every user that may still get the inactivity discount."""
+        return [(user_id, user_time(user_data, "first_start")) for user_id, user_data in self.get().get("users", {}).items() if inactivity_discount_open(user_data) and user_data.get("first_start")]
+
+    def sync(self):
+        """Picks up changes other processes made to the store. Returns (changed user ids, events changed)."""
+        return set(), False
+
+    def clear_all_discounts(self) -> list:
+        """Removes every discount; returns the ids of the users that had one. The caller saves the stats."""
+        return [user_id for user_id, user_data in self.get()["users"].items() if user_data.pop("discounts", None) is not None]
+
+    def grant_discount_to_all(self, discount: dict) -> list:
+        """Gives `discount` to every user that is neither banned nor blocked; returns their ids. The caller saves the stats."""
+        users = self.get()["users"]; user_ids = [user_id for user_id, user_data in users.items() if not user_data.get("blocked") and not user_data.get("banned")]
+        for user_id in user_ids: users[user_id]["discounts"] = discount
+        return user_ids
+
+    def push_admin_logs(self, pending: dict):
+        """Keeps admin logs that were not delivered (other worker, shutdown) for the next flush_admin_logs()."""
+        if pending: self.get().setdefault("admin_log_outbox", {}).update(pending); self.dirty = True
+
+    def pop_admin_logs(self) -> dict:
+        pending = self.get().pop("admin_log_outbox", None) or {}
+        if pending: self.dirty = True
+        return pending
+
+    def forget(self, key: str):
+        """Drops a top-level key from memory without writing it."""
+        self.get().pop(key, None)
+
+    def reset_analytics(self):
+        """Deletes the stored click history of all workers."""
+
+    def take_analytics_reset(self) -> bool:
+        """True once after another process reset the click history."""
+        return False
+
+    def _serialize(self) -> bytes:
+        self.dirty = False; payload = json.dumps(self.data, ensure_ascii=False, separators=(",", ":"), default=json_default).encode("utf-8"); self.bytes_written += len(payload); return payload
+
+    async def flush_async(self):
+        self._flush_handle = None
+        if not self.dirty: return
+        async with self._write_lock:
+            started = time.perf_counter(); payload = self._serialize()
+            try: await asyncio.get_running_loop().run_in_executor(None, atomic_write_bytes, self.path, payload)
+            except OSError as e: self.dirty = True; metrics.inc("stats_flush_errors_total", backend="json"); logger.error(f"Konnte {self.path} nicht schreiben: {e}")
+            metrics.observe("stats_flush_seconds", time.perf_counter() - started, backend="json")
+
+    def flush(self):
+        if self._flush_handle is not None: self._flush_handle.cancel(); self._flush_handle = None
+        if not self.dirty: return
+        started = time.perf_counter(); atomic_write_bytes(self.path, self._serialize()); metrics.observe("stats_flush_seconds", time.perf_counter() - started, backend="json")
+
+def row_values(row) -> dict:
+    return row.to_json() if isinstance(row, UserRecord) else dict(row)
+
+def merge_row(fresh: dict, base: dict, local: dict) -> dict:
+    """Three-way merge of one row: the fields changed between `base` and `local` applied on top of `fresh`."""
+    merged = dict(fresh or {}); base = base or {}
+    for key, value in local.items():
+        if key not in base or base[key] != value: merged[key] = value
+    for key in base:
+        if key not in local: merged.pop(key, None)
+    return merged
+
+def refill_row(row, values: dict):
+    """Replaces the contents of a cached row in place, so a handler still holding the object sees the new values."""
+    table = row.table if isinstance(row, TrackedUserRecord) else None
+    if table is not None: row.table = None
+    try:
+        for key in [key for key in row if key not in values]: del row[key]
+        for key, value in values.items(): row[key] = value
+    finally:
+        if table is not None: row.table = table
+
+class SqliteTable(MutableMapping):
+    """Lazy, write-behind view of one keyed SQLite table. Rows are loaded on first access by primary key; only rows
+    in `dirty` (assigned, deleted or marked since the last flush) are written back when the store flushes. User rows
+    mark themselves (TrackedUserRecord); a plain dict row changed in place needs mark(key), which counts the whole row
+    as changed. In shared mode `base` keeps each dirty row as it was before its first change, so flush() can apply just
+    this worker's changes on top of what another worker wrote in the meantime (`conflicts`). `cache` is in least
+    recently used order; the store evicts clean rows beyond STATS_CACHE_ROWS after each flush. `replacing` is set while
+    the table replaces all stored rows (a handler assigned a plain dict) until that is committed."""
+    def __init__(self, store: "SqliteStatsStore", name: str):
+        self.store = store; self.name = name; self.cache = {}; self.dirty = set(); self.deleted = set(); self.count = None
+        self.base = {}; self.conflicts = set(); self.replacing = False
+
+    def _load(self, key):
+        if key in self.deleted: return None
+        row = self.cache.pop(key, None)
+        if row is None:
+            if self.replacing: return None
+            row = self.store.load_row(self.name, key)
+            if row is None: return None
+            if self.name == "users": row.table = self
+        self.cache[key] = row; return row
+
+    def __getitem__(self, key):
+        key = str(key); value = self._load(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        key = str(key)
+        if self.name == "users" and not (isinstance(value, TrackedUserRecord) and value.table is self):
+            value = TrackedUserRecord.from_json(key, value); value.table = self
+        old = self._load(key)
+        if old is None: self.count = len(self) + 1
+        self._remember_base(key, old); self.deleted.discard(key); self.cache[key] = value; self.dirty.add(key)
+
+    def __delitem__(self, key):
+        key = str(key)
+        if self._load(key) is None: raise KeyError(key)
+        self.count = len(self) - 1; self.cache.pop(key, None); self.dirty.discard(key); self.deleted.add(key); self.base.pop(key, None); self.conflicts.discard(key)
+
+    def mark(self, key, row=None):
+        """Writes the row back with the next flush. `row` is the object about to be changed; it becomes the cached row
+        again if the store dropped it in the meantime."""
+        key = str(key)
+        self._remember_base(key, row if row is not None else {})
+        if row is not None and key not in self.deleted and self.cache.get(key) is not row:
+            # Evicted or dropped while a handler still held it: merge it with the stored row like a conflict.
+            if self.store.shared: self.conflicts.add(key)
+            self.cache[key] = row
+        self.dirty.add(key); self.store.dirty = True
+
+    def _remember_base(self, key: str, row):
+        if self.store.shared and key not in self.base: self.base[key] = None if row is None else row_values(row)
+
+    def __contains__(self, key): return self._load(str(key)) is not None
+
+    def setdefault(self, key, default=None):
+        if key not in self: self[key] = {} if default is None else default
+        return self[key]
+
+    def __len__(self):
+        if self.count is None: self.count = self.store.count_rows(self.name)
+        return self.count
+
+    def __iter__(self):
+        stored = set() if self.replacing else self.store.row_keys(self.name)
+        for key in stored:
+            if key not in self.deleted: yield key
+        yield from [key for key in self.cache if key not in stored]
+
+class SqliteStatsStore(StatsStore):
+    """stats.json layout backed by SQLite (WAL). users/admin_logs/sessions are lazy per-row tables, discounts live in
+    their own table, events and the remaining top-level keys are small and written as a whole."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, first_start TEXT, last_start TEXT, banned INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL DEFAULT '{}');
+        CREATE INDEX IF NOT EXISTS idx_users_last_start ON users(last_start);
+        CREATE TABLE IF NOT EXISTS discounts (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS admin_logs (user_id TEXT PRIMARY KEY, message_id INTEGER);
+        CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS events (name TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS row_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, user_id TEXT NOT NULL, writer INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS admin_log_outbox (user_id TEXT PRIMARY KEY, text TEXT NOT NULL);
+    """
+    USER_COLUMNS = ("first_start", "last_start", "banned")
+
+    def __init__(self, path: str, flush_delay: float, legacy_json_path: str = None, shared: bool = False, writer_id: int = 0, owns=None, cache_rows: int = 10000):
+        super().__init__(path, flush_delay); self.legacy_json_path = legacy_json_path; self.db = None; self.cache_rows = cache_rows
+        # flush_async() writes through its own connection in a worker thread; the guard keeps writes in flush order.
+        self._writer = None; self._write_guard = threading.Lock()
+        # Shared mode: several worker processes use the same database. Every row write is logged in row_changes so the
+        # other workers can drop their cached copy, events are written as deltas and meta only key by key.
+        self.shared = shared; self.writer_id = writer_id; self.owns = owns or (lambda user_id: True); self._change_seq = 0; self._events_base = {}; self._meta_base = {}
+        self._changed_users = set(); self._analytics_generation = 0
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL"); self.db.execute("PRAGMA synchronous=NORMAL"); self.db.executescript(self.SCHEMA)
+            if self.legacy_json_path: migrate_json_stats_to_sqlite(self.legacy_json_path, self.db)
+        return self.db
+
+    def get(self) -> dict:
+        if self.data is None:
+            db = self.connect(); self.data = self.empty()
+            for key, value in db.execute("SELECT key, value FROM meta WHERE substr(key, 1, 1) != '_'"): self.data[key] = json.loads(value); self._meta_base[key] = value
+            self.data["events"] = dict(db.execute("SELECT name, count FROM events")); self._events_base = dict(self.data["events"])
+            self.data["users"] = SqliteTable(self, "users"); self.data["admin_logs"] = SqliteTable(self, "admin_logs"); self.data["sessions"] = SqliteTable(self, "sessions")
+            self._change_seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM row_changes").fetchone()[0]; self._analytics_generation = self._read_analytics_generation()
+        return self.data
+
+    def load_row(self, table: str, key: str):
+        if table == "sessions":
+            row = self.db.execute("SELECT data FROM sessions WHERE user_id = ?", (key,)).fetchone()
+            return None if row is None else json.loads(row[0])
+        if table == "admin_logs":
+            row = self.db.execute("SELECT message_id FROM admin_logs WHERE user_id = ?", (key,)).fetchone()
+            return None if row is None else ({"message_id": row[0]} if row[0] is not None else {})
+        row = self.db.execute("SELECT u.first_start, u.last_start, u.banned, u.data, d.data FROM users u LEFT JOIN discounts d ON d.user_id = u.user_id WHERE u.user_id = ?", (key,)).fetchone()
+        if row is None: return None
+        user = json.loads(row[3]); user["banned"] = bool(row[2])
+        if row[0] is not None: user["first_start"] = row[0]
+        if row[1] is not None: user["last_start"] = row[1]
+        if row[4] is not None: user["discounts"] = json.loads(row[4])
+        return TrackedUserRecord.from_json(key, user)
+
+    def count_rows(self, table: str) -> int: return self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def row_keys(self, table: str) -> set: return {row[0] for row in self.db.execute(f"SELECT user_id FROM {table}")}
+
+    def users_active_since(self, since: datetime) -> list:
+        self.get(); return self.db.execute("SELECT user_id, last_start FROM users WHERE last_start >= ?", (since.isoformat(),)).fetchall()
+
+    def count_active_since(self, since: datetime) -> int:
+        self.get(); self.flush(); return self.db.execute("SELECT COUNT(*) FROM users WHERE last_start >= ?", (since.isoformat(),)).fetchone()[0]
+
+    def all_discounts(self) -> dict:
+        self.get(); self.flush(); return {user_id: json.loads(data) for user_id, data in self.db.execute("SELECT user_id, data FROM discounts")}
+
+    def inactivity_candidates(self) -> list:
+        self.get(); self.flush()
+        rows = self.db.execute("SELECT u.user_id, u.first_start FROM users u LEFT JOIN discounts d ON d.user_id = u.user_id WHERE d.user_id IS NULL AND u.banned = 0 AND u.first_start IS NOT NULL AND NOT COALESCE(json_extract(u.data, '$.discount_sent'), 0)")
+        # Shared mode: every worker grants the discount to the users it owns, so no row is written by two processes.
+        return [(user_id, datetime.fromisoformat(first_start)) for user_id, first_start in rows if self.owns(user_id)]
+
+    def clear_all_discounts(self) -> list:
+        return self._change_all_discounts("SELECT user_id FROM discounts", "DELETE FROM discounts", (), None)
+
+    def grant_discount_to_all(self, discount: dict) -> list:
+        active = "banned = 0 AND NOT COALESCE(json_extract(data, '$.blocked'), 0)"
+        return self._change_all_discounts(f"SELECT user_id FROM users WHERE {active}", f"INSERT OR REPLACE INTO discounts (user_id, data) SELECT user_id, ? FROM users WHERE {active}", (json.dumps(discount),), discount)
+
+    def _change_all_discounts(self, select: str, change: str, params: tuple, discount) -> list:
+        # One set-based statement instead of loading every user row; cached rows are updated in place, unmarked.
+        self.get(); self.flush(); db = self.db
+        with self._write_guard:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                user_ids = [row[0] for row in db.execute(select)]; db.execute(change, params)
+                if self.shared: db.execute("INSERT INTO row_changes (table_name, user_id, writer) VALUES ('users', '*', ?)", (self.writer_id,))
+                db.execute("COMMIT")
+            except sqlite3.Error: db.execute("ROLLBACK"); raise
+        users = self.data["users"]
+        for user_id in user_ids:
+            row = users.cache.get(user_id)
+            if row is None: continue
+            values = row_values(row); values.pop("discounts", None)
+            refill_row(row, values if discount is None else {**values, "discounts": discount})
+        return user_ids
+
+    def _adopt_plain_tables(self) -> list:
+        # Handlers may replace a table with a plain dict (e.g. "Statistiken zurücksetzen"); that means: replace all rows.
+        statements = []
+        for name in ("users", "admin_logs", "sessions"):
+            table = self.data.get(name)
+            if not isinstance(table, SqliteTable):
+                fresh = SqliteTable(self, name); fresh.count = 0; fresh.replacing = True; self.data[name] = fresh
+                for key, value in (table or {}).items(): fresh[key] = value
+                table = fresh
+            if table.replacing:
+                statements.append((f"DELETE FROM {name}", [()]))
+                if name == "users": statements.append(("DELETE FROM discounts", [()]))
+                if self.shared: statements.append(("INSERT INTO row_changes (table_name, user_id, writer) VALUES (?, '*', ?)", [(name, self.writer_id)]))
+        return statements
+
+    def _encode_users(self, rows: dict, deleted: set) -> list:
+        user_rows = []; discount_rows = []; discount_deletes = []
+        for key, user in rows.items():
+            extra = {k: v for k, v in user.items() if k not in self.USER_COLUMNS and k != "discounts"}
+            user_rows.append((key, user.get("first_start"), user.get("last_start"), int(bool(user.get("banned"))), json.dumps(extra, ensure_ascii=False)))
+            if user.get("discounts") is not None: discount_rows.append((key, json.dumps(user["discounts"])))
+            else: discount_deletes.append((key,))
+        self.bytes_written += sum(len(str(value)) for row in user_rows + discount_rows for value in row)
+        return [("DELETE FROM users WHERE user_id = ?", [(key,) for key in deleted]), ("DELETE FROM discounts WHERE user_id = ?", [(key,) for key in deleted]),
+                ("INSERT OR REPLACE INTO users (user_id, first_start, last_start, banned, data) VALUES (?, ?, ?, ?, ?)", user_rows),
+                ("INSERT OR REPLACE INTO discounts (user_id, data) VALUES (?, ?)", discount_rows), ("DELETE FROM discounts WHERE user_id = ?", discount_deletes)]
+
+    def _encode_admin_logs(self, rows: dict, deleted: set) -> list:
+        return [("DELETE FROM admin_logs WHERE user_id = ?", [(key,) for key in deleted]), ("INSERT OR REPLACE INTO admin_logs (user_id, message_id) VALUES (?, ?)", [(key, row.get("message_id")) for key, row in rows.items()])]
+
+    def _encode_sessions(self, rows: dict, deleted: set) -> list:
+        session_rows = [(key, json.dumps(row, ensure_ascii=False, separators=(",", ":"))) for key, row in rows.items()]; self.bytes_written += sum(len(data) for _, data in session_rows)
+        return [("DELETE FROM sessions WHERE user_id = ?", [(key,) for key in deleted]), ("INSERT OR REPLACE INTO sessions (user_id, data) VALUES (?, ?)", session_rows)]
+
+    def _collect(self) -> dict:
+        """Turns everything changed since the last flush into SQL statements and marks the rows clean. Runs on the event
+        loop; the statements are executed by flush() or, off the loop, by flush_async()."""
+        statements = self._adopt_plain_tables(); written = []
+        for name, encode in (("users", self._encode_users), ("admin_logs", self._encode_admin_logs), ("sessions", self._encode_sessions)):
+            table = self.data[name]
+            if self.shared: self._merge_dirty_rows(table)
+            rows = {key: table.cache[key] for key in table.dirty if key in table.cache}; deleted = set(table.deleted); statements += encode(rows, deleted)
+            if self.shared: statements.append(("INSERT INTO row_changes (table_name, user_id, writer) VALUES (?, ?, ?)", [(name, key, self.writer_id) for key in [*rows, *deleted]]))
+            written.append((table, set(rows), deleted, table.replacing)); table.dirty = set(); table.base.clear(); table.conflicts.clear()
+        meta = {key: json.dumps(value) for key, value in self.data.items() if key not in ("users", "admin_logs", "events", "sessions")}
+        if self.shared:
+            events = self.data["events"]; deltas = [(name, count - self._events_base.get(name, 0)) for name, count in events.items()] + [(name, -count) for name, count in self._events_base.items() if name not in events]
+            statements.append(("INSERT INTO events (name, count) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET count = count + excluded.count", [row for row in deltas if row[1]]))
+        else: statements += [("DELETE FROM events", [()]), ("INSERT INTO events (name, count) VALUES (?, ?)", list(self.data["events"].items()))]
+        # Only keys whose value changed: the click history and the reset snapshots are larger than the rest together.
+        meta = {key: value for key, value in meta.items() if self._meta_base.get(key) != value}
+        statements.append(("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", list(meta.items())))
+        return {"statements": statements, "written": written, "meta": meta}
+
+    @staticmethod
+    def _apply(db: sqlite3.Connection, batch: dict):
+        for sql, params in batch["statements"]: db.executemany(sql, params)
+
+    def _committed(self, batch: dict, started: float):
+        for table, _, deleted, replaced in batch["written"]:
+            table.deleted -= deleted
+            if replaced: table.replacing = False
+        self._meta_base.update(batch["meta"]); metrics.observe("stats_flush_seconds", time.perf_counter() - started, backend="sqlite")
+        for name in ("users", "admin_logs", "sessions"):
+            table = self.data[name]; excess = len(table.cache) - self.cache_rows
+            if excess > 0:
+                for key in [key for key in table.cache if key not in table.dirty][:excess]: del table.cache[key]
+
+    def _failed(self, batch: dict, e: Exception):
+        self.dirty = True; metrics.inc("stats_flush_errors_total", backend="sqlite"); logger.error(f"Konnte Statistiken nicht in {self.path} schreiben: {e}")
+        for table, rows, _, _ in (batch or {}).get("written", ()): table.dirty |= {key for key in rows if key in table.cache}
+
+    def flush(self):
+        if self._flush_handle is not None: self._flush_handle.cancel(); self._flush_handle = None
+        if not self.dirty or self.data is None: return
+        db = self.connect(); started = time.perf_counter(); batch = None
+        with self._write_guard:
+            self.dirty = False
+            try:
+                db.execute("BEGIN IMMEDIATE" if self.shared else "BEGIN")
+                # Shared mode: under the write lock, first take in what the other workers wrote since the last sync.
+                if self.shared: self._pull_row_changes()
+                batch = self._collect(); self._apply(db, batch); db.execute("COMMIT")
+            except sqlite3.Error as e: db.execute("ROLLBACK"); self._failed(batch, e); return
+        self._committed(batch, started)
+        if self.shared:
+            fresh = dict(db.execute("SELECT name, count FROM events")); self.data["events"].clear(); self.data["events"].update(fresh); self._events_base = dict(fresh)
+            # Rows of users another worker owns are only borrowed (admin actions, referral rewards): reload them next time.
+            users = self.data["users"]
+            for key in [key for key in users.cache if not self.owns(key)]: del users.cache[key]
+
+    def _write_batch(self, batch: dict):
+        """Worker-thread side of flush_async(), on a connection of its own. Releases the write guard."""
+        try:
+            if self._writer is None:
+                self._writer = sqlite3.connect(self.path, isolation_level=None, timeout=30, check_same_thread=False); self._writer.execute("PRAGMA synchronous=NORMAL")
+            self._writer.execute("BEGIN")
+            try: self._apply(self._writer, batch); self._writer.execute("COMMIT")
+            except sqlite3.Error: self._writer.execute("ROLLBACK"); raise
+        finally: self._write_guard.release()
+
+    def _pull_row_changes(self):
+        """Applies the rows other workers wrote since the last call to the cached copies, in place. A row this worker
+        has changed meanwhile is only noted in `conflicts`; flush() merges it."""
+        changes = self.db.execute("SELECT seq, table_name, user_id, writer FROM row_changes WHERE seq > ? ORDER BY seq", (self._change_seq,)).fetchall()
+        if not changes: return
+        self._change_seq = changes[-1][0]; touched = {}
+        for _, table_name, user_id, writer in changes:
+            if writer != self.writer_id: touched.setdefault(table_name, set()).add(user_id)
+        for table_name, keys in touched.items():
+            table = self.data.get(table_name)
+            if not isinstance(table, SqliteTable): continue
+            if "*" in keys:
+                keys = (keys - {"*"}) | set(table.cache)
+                if table_name == "users": referral_index.clear()  # all users replaced; the cached rows that remain set theirs again
+            for key in keys:
+                if table_name == "users": self._changed_users.add(key)
+                if key in table.dirty: table.conflicts.add(key); continue
+                table.deleted.discard(key)
+                if key not in table.cache: continue
+                fresh = self.load_row(table_name, key)
+                if fresh is None: del table.cache[key]
+                else: refill_row(table.cache[key], row_values(fresh))
+            table.count = None
+
+    def _merge_dirty_rows(self, table: SqliteTable):
+        # Conflicting rows, and user rows borrowed from another worker (dropped after every flush, so a handler may
+        # still hold a stale copy), are written as the stored row plus the fields this worker changed.
+        for key in [key for key in table.dirty if key in table.conflicts or (table.name == "users" and not self.owns(key))]:
+            row = table.cache.get(key)
+            if row is None: continue
+            fresh = self.load_row(table.name, key)
+            if key in table.conflicts: logger.info(f"{table.name}/{key} wurde parallel geändert, Änderungen werden zusammengeführt.")
+            refill_row(row, merge_row(None if fresh is None else row_values(fresh), table.base.get(key), row_values(row)))
+
+    def sync(self):
+        if not self.shared or self.data is None: return set(), False
+        db = self.connect(); self._pull_row_changes(); changed = self._changed_users; self._changed_users = set()
+        events = self.data["events"]; fresh = dict(db.execute("SELECT name, count FROM events")); events_changed = fresh != self._events_base
+        if events_changed:
+            local = {name: count - self._events_base.get(name, 0) for name, count in events.items()}
+            events.clear(); events.update({name: fresh.get(name, 0) + local.get(name, 0) for name in {*fresh, *local}}); self._events_base = fresh
+        for key, value in db.execute("SELECT key, value FROM meta WHERE substr(key, 1, 1) != '_'"):
+            if value != self._meta_base.get(key) and json.dumps(self.data.get(key)) == self._meta_base.get(key, json.dumps(None)): self.data[key] = json.loads(value); self._meta_base[key] = value
+        return changed, events_changed
+
+    def forget(self, key: str):
+        super().forget(key); self._meta_base.pop(key, None)
+
+    def _read_analytics_generation(self) -> int:
+        row = self.db.execute("SELECT value FROM meta WHERE key = '_analytics_generation'").fetchone(); return int(row[0]) if row else 0
+
+    def reset_analytics(self):
+        # The generation tells the other workers to drop their in-memory rings, which they would write back otherwise.
+        db = self.connect(); db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM meta WHERE key = 'analytics' OR key LIKE 'analytics!_%' ESCAPE '!'")
+            db.execute("INSERT INTO meta (key, value) VALUES ('_analytics_generation', '1') ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+            self._analytics_generation = self._read_analytics_generation(); db.execute("COMMIT")
+        except sqlite3.Error: db.execute("ROLLBACK"); raise
+
+    def take_analytics_reset(self) -> bool:
+        if not self.shared or self.data is None: return False
+        generation = self._read_analytics_generation()
+        if generation == self._analytics_generation: return False
+        self._analytics_generation = generation; return True
+
+    def mark(self, flag: str):
+        self.connect().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, 'true')", (f"_{flag}",))
+
+    def take_mark(self, flag: str) -> bool:
+        return self.connect().execute("DELETE FROM meta WHERE key = ?", (f"_{flag}",)).rowcount > 0
+
+    def push_admin_logs(self, pending: dict):
+        if pending: self.connect().executemany("INSERT OR REPLACE INTO admin_log_outbox (user_id, text) VALUES (?, ?)", pending.items())
+
+    def pop_admin_logs(self) -> dict:
+        db = self.connect(); db.execute("BEGIN IMMEDIATE")
+        try: pending = dict(db.execute("SELECT user_id, text FROM admin_log_outbox")); db.execute("DELETE FROM admin_log_outbox"); db.execute("COMMIT")
+        except sqlite3.Error: db.execute("ROLLBACK"); raise
+        return pending
+
+    def prune_row_changes(self, keep: int = 100000):
+        self.connect().execute("DELETE FROM row_changes WHERE seq <= (SELECT MAX(seq) FROM row_changes) - ?", (keep,))
+
+    async def flush_async(self):
+        self._flush_handle = None
+        # Shared mode merges with the other workers' rows under the write lock, which reads and refills cached rows.
+        if self.shared: self.flush(); return
+        async with self._write_lock:
+            if not self.dirty or self.data is None: return
+            self.connect(); started = time.perf_counter(); self._write_guard.acquire(); self.dirty = False
+            try: batch = self._collect()
+            except BaseException: self._write_guard.release(); self.dirty = True; raise
+            try: await asyncio.to_thread(self._write_batch, batch)
+            except sqlite3.Error as e: self._failed(batch, e); return
+            self._committed(batch, started)
+
+def migrate_json_stats_to_sqlite(json_path: str, db: sqlite3.Connection) -> bool:
+    """One-shot import of a legacy stats.json into an empty database. Returns True if something was imported."""
+    if db.execute("SELECT 1 FROM meta WHERE key = '_migrated_from_json'").fetchone() or db.execute("SELECT 1 FROM users LIMIT 1").fetchone() or not os.path.exists(json_path): return False
     try:
-        with open(STATS_FILE, "r") as f: return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {"pinned_message_id": None, "discount_message_id": None, "users": {}, "admin_logs": {}, "events": {}}
+        with open(json_path, "r") as f: legacy = json.load(f)
+    except json.JSONDecodeError as e: logger.error(f"Migration von {json_path} fehlgeschlagen: {e}"); return False
+    migrator = SqliteStatsStore(":memory:", 0); migrator.db = db; migrator.data = {**StatsStore.empty(), **legacy}; migrator.data["users"] = dict(legacy.get("users", {})); migrator.data["admin_logs"] = dict(legacy.get("admin_logs", {})); migrator.dirty = True
+    migrator.flush()
+    if migrator.dirty: return False
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('_migrated_from_json', ?)", (json.dumps(datetime.now().isoformat()),))
+    logger.info(f"{len(legacy.get('users', {}))} Nutzer aus {json_path} nach SQLite migriert."); return True
+
+def worker_for_user(user_id, worker_count: int) -> int:
+    """The worker process that owns `user_id`; the webhook front end routes every update of that user there."""
+    return int(user_id) % worker_count if worker_count > 1 else 0
+
+if STATS_BACKEND == "sqlite": stats_store = SqliteStatsStore(STATS_DB, STATS_FLUSH_DELAY, legacy_json_path=STATS_FILE, shared=WORKER_COUNT > 1, writer_id=WORKER_INDEX, owns=lambda user_id: worker_for_user(user_id, WORKER_COUNT) == WORKER_INDEX, cache_rows=STATS_CACHE_ROWS)
+else: stats_store = StatsStore(STATS_FILE, STATS_FLUSH_DELAY)
+metrics.gauge("stats_bytes_written_total", "counter", "Bytes written by the stats store since start.", lambda: stats_store.bytes_written)
+
+def load_stats():
+    return stats_store.get()
+
+# --- Sitzungsdaten ---
+class StatsSessionPersistence(BasePersistence):
+    """Keeps context.user_data (preview position, messages to delete, pending inputs, the discount wizard) in the
+    `sessions` part of the stats store, so it survives restarts. Nothing is loaded at startup: a user's session is read
+    when their first update is processed (refresh_user_data). PTB hands over the sessions used since its last run every
+    SESSION_UPDATE_INTERVAL; only changed ones are put into the store, which writes them with its next batched flush."""
+    def __init__(self, update_interval: float):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self.loaded = set()
+
+    async def get_user_data(self) -> dict: return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self.loaded: return
+        self.loaded.add(user_id); stored = load_stats()["sessions"].get(str(user_id))
+        for key, value in (stored or {}).items(): user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        if user_id not in self.loaded: return  # never read, so `data` would overwrite the stored session
+        stats = load_stats(); sessions = stats["sessions"]; key = str(user_id); stored = sessions.get(key)
+        if data and data != stored: sessions[key] = data; save_stats(stats)
+        elif not data and stored is not None: del sessions[key]; save_stats(stats)
+
+    async def drop_user_data(self, user_id: int):
+        stats = load_stats(); sessions = stats["sessions"]
+        if str(user_id) in sessions: del sessions[str(user_id)]; save_stats(stats)
+
+    async def flush(self): stats_store.flush()
+
+    async def get_chat_data(self) -> dict: return {}
+
+    async def get_bot_data(self) -> dict: return {}
+
+    async def get_callback_data(self): return None
+
+    async def get_conversations(self, name: str) -> dict: return {}
+
+    async def update_conversation(self, name: str, key, new_state): pass
+
+    async def update_chat_data(self, chat_id: int, data: dict): pass
+
+    async def update_bot_data(self, data: dict): pass
+
+    async def update_callback_data(self, data): pass
+
+    async def drop_chat_data(self, chat_id: int): pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict): pass
+
+    async def refresh_bot_data(self, bot_data: dict): pass
+
+# --- Worker-Cluster ---
+class LeaderLease:
+    """Single-writer election between the worker processes of one deployment: a row in the shared `leases` table that
+    its owner renews every STATS_SYNC_INTERVAL and that anyone may take over once it is older than `ttl`."""
+    def __init__(self, store: SqliteStatsStore, name: str, ttl: float):
+        self.store = store; self.name = name; self.ttl = ttl; self.owner = f"{socket.gethostname()}:{os.getpid()}"; self.held = False
+
+    def renew(self) -> bool:
+        now = time.time(); db = self.store.connect()
+        try:
+            db.execute("INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires WHERE leases.owner = excluded.owner OR leases.expires < ?", (self.name, self.owner, now + self.ttl, now))
+            held = db.execute("SELECT owner FROM leases WHERE name = ?", (self.name,)).fetchone()[0] == self.owner
+        except sqlite3.Error as e: logger.warning(f"Lease '{self.name}' konnte nicht erneuert werden: {e}"); held = False
+        if held != self.held: logger.info(f"Worker {WORKER_INDEX} {'ist jetzt' if held else 'ist nicht mehr'} Leader ({self.name}).")
+        self.held = held; return held
+
+    def release(self):
+        if self.held: self.store.connect().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner)); self.held = False
+
+leader_lease = LeaderLease(stats_store, "leader", LEADER_LEASE_TTL) if isinstance(stats_store, SqliteStatsStore) and stats_store.shared else None
+
+def is_leader() -> bool:
+    """Dashboard, admin logs, the discount backup and startup restores run in exactly one process."""
+    return leader_lease is None or leader_lease.held
+
+async def sync_shared_state(context: ContextTypes.DEFAULT_TYPE):
+    changed_users, events_changed = stats_store.sync()
+    if stats_store.take_analytics_reset(): stats = load_stats(); drop_local_analytics(stats); save_stats(stats)
+    stats_store.flush(); leader_lease.renew()
+    for user_id in changed_users: price_service.invalidate(user_id)
+    if events_changed or changed_users: request_dashboard_update()
+    if leader_lease.held: stats_store.prune_row_changes()
 
 def save_stats(stats):
-    with open(STATS_FILE, "w") as f: json.dump(stats, f, indent=4)
+    stats_store.save(stats)
+
+# --- Rate-Limit & Broadcasts ---
+class TokenBucket:
+    """Global send budget for the Bot API. `pause()` blocks every caller, e.g. after a RetryAfter."""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate; self.capacity = capacity or rate; self.tokens = self.capacity; self.updated = time.monotonic(); self.blocked_until = 0.0; self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until: await asyncio.sleep(self.blocked_until - now); continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+                if self.tokens >= 1: self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# The limits apply to the bot as a whole, so in the multi-process mode every worker gets an equal share of them.
+telegram_limiter = TokenBucket(TELEGRAM_RATE_LIMIT / WORKER_COUNT)
+admin_group_limiter = TokenBucket(ADMIN_GROUP_RATE_LIMIT / 60 / WORKER_COUNT, capacity=max(5 / WORKER_COUNT, 1))
+
+def retry_after_seconds(e: error.RetryAfter) -> float:
+    return e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+
+async def call_rate_limited(func, *args, limiter: TokenBucket = None, retries: int = 3, **kwargs):
+    limiter = limiter or telegram_limiter
+    for attempt in range(retries + 1):
+        await limiter.acquire()
+        try: return await func(*args, **kwargs)
+        except error.RetryAfter as e:
+            wait = retry_after_seconds(e); metrics.inc("telegram_retry_after_total", method=func.__name__); logger.warning(f"Flood-Limit erreicht, pausiere {wait:.0f}s ({func.__name__})"); limiter.pause(wait)
+            if attempt == retries: raise
+
+class Broadcast:
+    """Background fan-out of one message to many users. The job spec (including the target list) is written once to
+    BROADCAST_FILE, progress is checkpointed to a small sidecar file, so a restart resumes where it stopped."""
+    def __init__(self, application: Application, job: dict, progress: dict = None):
+        self.application = application; self.job = job
+        self.progress = progress or {"id": job["id"], "cursor": 0, "sent": 0, "failed": 0, "blocked": 0}
+        self.next_index = self.progress["cursor"]; self.in_flight = set(); self.last_report = 0.0
+
+    @staticmethod
+    def progress_path() -> str: return f"{BROADCAST_FILE}.progress"
+
+    @classmethod
+    def create(cls, application: Application, target_ids: list, text: str, reply_markup: InlineKeyboardMarkup, admin_chat_id: int, admin_message_id: int) -> "Broadcast":
+        job = {"id": datetime.now().strftime("%Y%m%d%H%M%S"), "targets": target_ids, "text": text, "reply_markup": reply_markup.to_dict() if reply_markup else None, "admin_chat_id": admin_chat_id, "admin_message_id": admin_message_id}
+        atomic_write_json(BROADCAST_FILE, job); broadcast = cls(application, job); broadcast.checkpoint(); return broadcast
+
+    @classmethod
+    def resume(cls, application: Application):
+        try:
+            with open(BROADCAST_FILE, "r") as f: job = json.load(f)
+            with open(cls.progress_path(), "r") as f: progress = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError): return None
+        if progress.get("id") != job.get("id") or progress["cursor"] >= len(job["targets"]): return None
+        return cls(application, job, progress)
+
+    def checkpoint(self):
+        self.progress["cursor"] = min(self.in_flight) if self.in_flight else self.next_index
+        atomic_write_json(self.progress_path(), self.progress)
+
+    def status_text(self, done: bool) -> str:
+        counts = self.progress; failed = counts["failed"] + counts["blocked"]
+        if done: return f"✅ Rabatt-Aktion abgeschlossen!\n\n- Erfolgreich gesendet an: *{counts['sent']} Nutzer*\n- Fehlgeschlagen/Blockiert: *{failed} Nutzer*"
+        return f"📢 *Rabatt-Aktion läuft...*\n\n- Gesendet: *{counts['sent']}*\n- Fehlgeschlagen/Blockiert: *{failed}*\n- Offen: *{len(self.job['targets']) - self.next_index + len(self.in_flight)}*"
+
+    async def report(self, done: bool = False):
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]) if done else None
+        try: await call_rate_limited(self.application.bot.edit_message_text, chat_id=self.job["admin_chat_id"], message_id=self.job["admin_message_id"], text=self.status_text(done), reply_markup=keyboard, parse_mode='Markdown')
+        except error.TelegramError as e:
+            if 'message is not modified' not in str(e): logger.warning(f"Broadcast-Fortschritt konnte nicht angezeigt werden: {e}")
+
+    async def send_one(self, user_id: str, reply_markup):
+        try:
+            await call_rate_limited(self.application.bot.send_message, chat_id=user_id, text=self.job["text"], reply_markup=reply_markup); self.progress["sent"] += 1
+        except error.Forbidden:
+            self.progress["blocked"] += 1; stats = load_stats()
+            if user_id in stats["users"]: stats["users"][user_id]["blocked"] = True; save_stats(stats)
+        except error.TelegramError: self.progress["failed"] += 1
+
+    async def worker(self, reply_markup):
+        targets = self.job["targets"]
+        while self.next_index < len(targets):
+            index = self.next_index; self.next_index += 1; self.in_flight.add(index)
+            try: await self.send_one(targets[index], reply_markup)
+            finally: self.in_flight.discard(index)
+            if time.monotonic() - self.last_report >= BROADCAST_REPORT_INTERVAL:
+                self.last_report = time.monotonic(); self.checkpoint(); await self.report()
+
+    async def run(self):
+        global active_broadcast
+        try:
+            reply_markup = InlineKeyboardMarkup.de_json(self.job["reply_markup"], self.application.bot) if self.job.get("reply_markup") else None
+            logger.info(f"Broadcast {self.job['id']}: {len(self.job['targets']) - self.next_index} Empfänger offen.")
+            await asyncio.gather(*(self.worker(reply_markup) for _ in range(BROADCAST_CONCURRENCY)))
+            self.checkpoint(); await self.report(done=True); logger.info(f"Broadcast {self.job['id']} abgeschlossen: {self.progress}")
+        finally: active_broadcast = None
+
+def start_broadcast(application: Application, broadcast: Broadcast):
+    global active_broadcast
+    # Not Application.create_task: resumed broadcasts start from post_init, before the application is running.
+    active_broadcast = broadcast; broadcast.task = asyncio.get_running_loop().create_task(broadcast.run(), name=f"broadcast_{broadcast.job['id']}")
+
+active_broadcast = None
+
+# --- Hintergrund-Aufgaben ---
+class SideEffectQueue:
+    """Bounded queue for work the user doesn't have to wait for (Telegram backups, group notifications, ...).
+    A few worker tasks run the jobs in order; drain() waits for the backlog on shutdown."""
+    def __init__(self, maxsize: int, workers: int):
+        self.maxsize = maxsize; self.worker_count = workers; self.queue = None; self.workers = []
+        self.processed = 0; self.failed = 0; self.latency_total = 0.0; self.latency_max = 0.0
+
+    def start(self, application: Application):
+        self.queue = asyncio.Queue(self.maxsize)
+        loop = asyncio.get_running_loop(); self.workers = [loop.create_task(self._worker(), name=f"side_effects_{i}") for i in range(self.worker_count)]
+
+    async def submit(self, func, *args, **kwargs):
+        # Without running workers (e.g. during startup) the job runs inline; a full queue applies backpressure.
+        if self.queue is None: await self._run(time.monotonic(), func, args, kwargs); return
+        await self.queue.put((time.monotonic(), func, args, kwargs))
+
+    def try_submit(self, func, *args, **kwargs) -> bool:
+        """Queues optional work without waiting; returns False (work dropped) if the queue is not running or full."""
+        if self.queue is None: return False
+        try: self.queue.put_nowait((time.monotonic(), func, args, kwargs)); return True
+        except asyncio.QueueFull: return False
+
+    async def _run(self, enqueued_at: float, func, args, kwargs):
+        try: await func(*args, **kwargs)
+        except Exception as e: self.failed += 1; logger.error(f"Hintergrund-Aufgabe {func.__name__} fehlgeschlagen: {e}")
+        latency = time.monotonic() - enqueued_at; self.processed += 1; self.latency_total += latency; self.latency_max = max(self.latency_max, latency)
+
+    async def _worker(self):
+        while True:
+            enqueued_at, func, args, kwargs = await self.queue.get()
+            try: await self._run(enqueued_at, func, args, kwargs)
+            finally: self.queue.task_done()
+
+    def metrics(self) -> dict:
+        return {"depth": self.queue.qsize() if self.queue else 0, "processed": self.processed, "failed": self.failed,
+                "latency_avg": self.latency_total / self.processed if self.processed else 0.0, "latency_max": self.latency_max}
+
+    async def drain(self, timeout: float):
+        if self.queue is None: return
+        try: await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError: logger.warning(f"{self.queue.qsize()} Hintergrund-Aufgaben beim Beenden verworfen.")
+        for worker in self.workers: worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True); self.queue = None; self.workers = []
+        logger.info(f"Hintergrund-Aufgaben: {self.metrics()}")
+
+side_effects = SideEffectQueue(SIDE_EFFECT_QUEUE_SIZE, SIDE_EFFECT_WORKERS)
+metrics.gauge("side_effects", "gauge", "Background side-effect queue (depth, processed, failed, latency_avg, latency_max).", lambda: {(("stat", key),): value for key, value in side_effects.metrics().items()})
+
+async def send_permanent_admin_notification(context: ContextTypes.DEFAULT_TYPE, text: str):
+    if not NOTIFICATION_GROUP_ID: return
+    try: await call_rate_limited(context.bot.send_message, chat_id=NOTIFICATION_GROUP_ID, text=text, parse_mode='Markdown', limiter=admin_group_limiter)
+    except error.TelegramError as e: logger.error(f"Konnte Admin-Benachrichtigung nicht senden: {e}")
+
+async def notify_user(context: ContextTypes.DEFAULT_TYPE, chat_id: str, text: str, **kwargs):
+    try: await call_rate_limited(context.bot.send_message, chat_id=chat_id, text=text, **kwargs)
+    except (error.Forbidden, error.BadRequest): logger.warning(f"Could not send notification to user {chat_id}")
 
 # --- Rabatt-Persistenz ---
+# Rabatte leben lokal im Statistik-Speicher (SQLite: eigene Tabelle, Delta-Writes). Telegram bekommt nur ein
+# komprimiertes Snapshot-Dokument, höchstens alle DISCOUNT_BACKUP_INTERVAL Sekunden und nur nach Änderungen.
+discount_backup_dirty = False
+
+def request_discount_backup():
+    global discount_backup_dirty
+    if leader_lease: stats_store.mark("discount_backup_dirty"); return
+    discount_backup_dirty = True
+
+def collect_discounts() -> dict:
+    return stats_store.all_discounts()
+
+def build_discount_snapshot(discounts: dict) -> bytes:
+    return gzip.compress(json.dumps({"version": 1, "created": datetime.now().isoformat(), "discounts": discounts}, separators=(",", ":")).encode("utf-8"))
+
 async def save_discounts_to_telegram(context: ContextTypes.DEFAULT_TYPE):
-    if not NOTIFICATION_GROUP_ID: return
-    stats = load_stats(); discounts_to_save = {}
-    for user_id, user_data in stats.get("users", {}).items():
-        if "discounts" in user_data: discounts_to_save[user_id] = user_data["discounts"]
-    json_string = json.dumps(discounts_to_save, indent=2); message_text = f"{DISCOUNT_MSG_HEADER}\n<tg-spoiler>{json_string}</tg-spoiler>"; discount_message_id = stats.get("discount_message_id")
+    global discount_backup_dirty
+    if not NOTIFICATION_GROUP_ID or not is_leader(): return
+    if leader_lease and stats_store.take_mark("discount_backup_dirty"): discount_backup_dirty = True
+    if not discount_backup_dirty: return
+    discount_backup_dirty = False; stats = load_stats(); discounts = collect_discounts(); discount_message_id = stats.get("discount_message_id")
+    snapshot = build_discount_snapshot(discounts); filename = f"discounts_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json.gz"; caption = f"{DISCOUNT_MSG_HEADER}\n{len(discounts)} Nutzer mit Rabatt"
     try:
-        if discount_message_id: await context.bot.edit_message_text(chat_id=NOTIFICATION_GROUP_ID, message_id=discount_message_id, text=message_text, parse_mode='HTML')
-        else: raise error.BadRequest("No discount message ID found")
+        if not discount_message_id: raise error.BadRequest("No discount message ID found")
+        message = await call_rate_limited(context.bot.edit_message_media, chat_id=NOTIFICATION_GROUP_ID, message_id=discount_message_id, media=InputMediaDocument(BytesIO(snapshot), filename=filename, caption=caption), limiter=admin_group_limiter)
     except error.BadRequest:
-        logger.warning("Discount message not found or invalid, creating a new one.")
-        try:
-            sent_message = await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=message_text, parse_mode='HTML')
-            stats["discount_message_id"] = sent_message.message_id; save_stats(stats)
-        except Exception as e: logger.error(f"Could not create a new discount persistence message: {e}")
+        logger.warning("Discount backup message not found or invalid, creating a new one.")
+        try: message = await call_rate_limited(context.bot.send_document, chat_id=NOTIFICATION_GROUP_ID, document=BytesIO(snapshot), filename=filename, caption=caption, disable_notification=True, limiter=admin_group_limiter)
+        except Exception as e: logger.error(f"Could not create a new discount backup message: {e}"); discount_backup_dirty = True; return
+    except error.TelegramError as e: logger.warning(f"Discount backup failed, retrying later: {e}"); discount_backup_dirty = True; return
+    stats["discount_message_id"] = message.message_id; stats["discount_backup_file_id"] = message.document.file_id; save_stats(stats)
+    logger.info(f"Rabatt-Backup gesendet ({len(discounts)} Nutzer, {len(snapshot)} Bytes).")
 
 async def load_discounts_from_telegram(application: Application):
     if not NOTIFICATION_GROUP_ID: logger.info("No notification group ID, skipping discount restore."); return
-    logger.info("Attempting to restore discounts from Telegram message..."); stats = load_stats(); discount_message_id = stats.get("discount_message_id")
-    if not discount_message_id: logger.warning("No discount message ID in stats.json. Cannot restore discounts."); return
+    stats = load_stats(); file_id = stats.get("discount_backup_file_id")
+    if not file_id: logger.warning("No discount backup file ID in stats. Cannot restore discounts."); return
+    if collect_discounts(): logger.info("Lokale Rabatte vorhanden, Telegram-Backup wird nicht benötigt."); return
+    logger.info("Attempting to restore discounts from Telegram backup...")
     try:
-        message = await application.bot.get_message(chat_id=NOTIFICATION_GROUP_ID, message_id=discount_message_id)
-        json_match = re.search(r'<tg-spoiler>(.*)</tg-spoiler>', message.text_html, re.DOTALL)
-        if not json_match: logger.error("Could not find spoiler tag in discount message."); return
-        discounts_data = json.loads(json_match.group(1)); users_updated = 0
+        backup_file = await application.bot.get_file(file_id); discounts_data = json.loads(gzip.decompress(bytes(await backup_file.download_as_bytearray())))["discounts"]; users_updated = 0
         for user_id, discounts in discounts_data.items():
-            if user_id in stats["users"]: stats["users"][user_id]["discounts"] = discounts; users_updated += 1
+            if user_id in stats["users"]: set_user_discount(stats, user_id, discounts); users_updated += 1
         if users_updated > 0: save_stats(stats); logger.info(f"Successfully restored discounts for {users_updated} users.")
-        else: logger.info("No discounts found in the persistence message to restore.")
+        else: logger.info("No discounts found in the backup to restore.")
     except Exception as e: logger.error(f"An unexpected error occurred during discount restore: {e}")
 
+# --- Funnel-Analytics ---
+class EventHistory:
+    """Per-event counts in fixed-size ring buffers (168 hourly and 90 daily buckets) stored in the stats. A ring is
+    [newest bucket number, counts] with slot = bucket % size, so recording is O(1) and a window such as "last 24h" is
+    a sum over at most `size` buckets, independent of the number of users. `sources` are the history dicts of all
+    workers (one per worker in the multi-process mode, see ANALYTICS_KEY)."""
+    RESOLUTIONS = {"hour": (3600, 168), "day": (86400, 90)}
+    FUNNEL = (("preview", "Vorschau"), ("prices", "Preise"), ("package_selected", "Paket gewählt"), ("payment", "Bezahlmethode"))
+
+    def record(self, data: dict, event: str, when: float, by: int = 1):
+        for resolution, (seconds, size) in self.RESOLUTIONS.items():
+            bucket = int(when // seconds); rings = data.setdefault(resolution, {}); ring = rings.get(event)
+            if ring is None: ring = rings[event] = [bucket, [0] * size]
+            if bucket > ring[0]:
+                for step in range(1, min(bucket - ring[0], size) + 1): ring[1][(ring[0] + step) % size] = 0
+                ring[0] = bucket
+            if bucket > ring[0] - size: ring[1][bucket % size] += by
+
+    def count(self, sources: list, event: str, window: timedelta, now: float) -> int:
+        resolution = "hour" if window <= timedelta(hours=self.RESOLUTIONS["hour"][1]) else "day"; seconds, size = self.RESOLUTIONS[resolution]
+        newest = int(now // seconds); oldest = newest - min(size, ceil(window.total_seconds() / seconds)) + 1; total = 0
+        for data in sources:
+            ring = data.get(resolution, {}).get(event)
+            if ring is None: continue
+            last, counts = ring
+            for bucket in range(max(oldest, last - size + 1), min(newest, last) + 1): total += counts[bucket % size]
+        return total
+
+    @staticmethod
+    def events(sources: list) -> set:
+        return {event for data in sources for event in data.get("hour", {})}
+
+    def step_count(self, sources: list, step: str, window: timedelta, now: float) -> int:
+        """A funnel step is the event of that name or all its variants (preview_ks + preview_gs, payment_*)."""
+        return sum(self.count(sources, event, window, now) for event in self.events(sources) if event == step or event.startswith(f"{step}_"))
+
+    def funnel(self, sources: list, window: timedelta, now: float) -> list:
+        """[(label, count, conversion from the previous step or None)]"""
+        rows = []; previous = None
+        for step, label in self.FUNNEL:
+            count = self.step_count(sources, step, window, now); rows.append((label, count, count / previous if previous else None)); previous = count
+        return rows
+
+event_history = EventHistory()
+ANALYTICS_KEY = "analytics" if WORKER_COUNT <= 1 else f"analytics_{WORKER_INDEX}"
+
+def analytics_sources(stats: dict) -> list:
+    return [value for key, value in stats.items() if key == "analytics" or key.startswith("analytics_")]
+
+def snapshot_and_reset_stats(stats: dict):
+    """"Statistiken zurücksetzen": users and lifetime counters start from zero, the click history moves into
+    stats_snapshots (the last STATS_SNAPSHOTS resets are kept)."""
+    snapshot = {"reset_at": datetime.now().isoformat(), "users": len(stats.get("users", {})), "events": dict(stats["events"]), "analytics": analytics_sources(stats)}
+    stats["stats_snapshots"] = ((stats.get("stats_snapshots") or []) + [snapshot])[-STATS_SNAPSHOTS:] if STATS_SNAPSHOTS > 0 else []
+    stats_store.reset_analytics(); drop_local_analytics(stats)
+    stats["users"] = {}; stats["admin_logs"] = {}; stats["events"] = {key: 0 for key in stats["events"]}; referral_index.clear()
+
+def drop_local_analytics(stats: dict):
+    """Forgets this process's click history and activity window after a reset, made here or on another worker. The own
+    ring starts empty and is written as such; the other workers' rings are read again from the store."""
+    for key in [key for key in stats if key == "analytics" or key.startswith("analytics_")]: stats_store.forget(key)
+    stats[ANALYTICS_KEY] = {}; activity_window.reset()
+
+# --- Atomare Statistik-Änderungen ---
+# Updates verschiedener Nutzer laufen parallel. Diese Helfer lesen und schreiben ohne await dazwischen, damit
+# keine Änderung eines anderen Updates überschrieben wird.
+def increment_event(event_name: str, by: int = 1) -> int:
+    stats = load_stats(); stats["events"][event_name] = stats["events"].get(event_name, 0) + by; save_stats(stats); return stats["events"][event_name]
+
+def increment_user_counter(user_id, key: str, by: int = 1) -> int:
+    stats = load_stats(); user_data = stats["users"].setdefault(str(user_id), {}); user_data[key] = user_data.get(key, 0) + by; save_stats(stats); return user_data[key]
+
+def set_user_field(user_id, key: str, value) -> bool:
+    stats = load_stats()
+    if str(user_id) not in stats["users"]: return False
+    stats["users"][str(user_id)][key] = value; save_stats(stats); return True
+
+def add_to_user_list(user_id, key: str, value, limit: int = None) -> bool:
+    """Appends `value` once; with `limit` only the newest entries are kept."""
+    stats = load_stats(); user_data = stats["users"].setdefault(str(user_id), {}); values = user_data.get(key, [])
+    if value in values: return False
+    user_data[key] = (values + [value])[-limit:] if limit else values + [value]; save_stats(stats); return True
+
+def mark_sister_viewed(user_id, schwester_code: str):
+    stats = load_stats(); user_data = stats["users"].setdefault(str(user_id), {}); viewed = user_data.get("viewed_sisters", [])
+    if schwester_code in viewed: return
+    # Stored in SISTER_CODES order, which is what the bitmask of a UserRecord can represent.
+    user_data["viewed_sisters"] = [code for code in SISTER_CODES if code in viewed or code == schwester_code] + [code for code in viewed if code not in SISTER_CODES] + ([schwester_code] if schwester_code not in SISTER_CODES else []); save_stats(stats)
+
+def record_event(event_name: str, by: int = 1):
+    """Lifetime counter and time-bucketed history of an event in one step."""
+    stats = load_stats(); stats["events"][event_name] = stats["events"].get(event_name, 0) + by
+    event_history.record(stats.setdefault(ANALYTICS_KEY, {}), event_name, time.time(), by); save_stats(stats)
+
 async def track_event(event_name: str, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     if str(user_id) == ADMIN_USER_ID: return
-    stats = load_stats(); stats["events"][event_name] = stats["events"].get(event_name, 0) + 1; save_stats(stats); await update_pinned_summary(context)
+    record_event(event_name); request_dashboard_update()
 
 def is_user_banned(user_id: int) -> bool:
     stats = load_stats(); user_data = stats.get("users", {}).get(str(user_id), {}); return user_data.get("banned", False)
@@ -124,15 +1583,43 @@ def get_discounted_price(base_price: int, discount_data: dict, package_key: str)
             
     return -1
 
-def get_package_button_text(media_type: str, amount: int, user_id: int) -> str:
-    stats = load_stats(); user_data = stats.get("users", {}).get(str(user_id), {})
-    base_price = PRICES[media_type][amount]; package_key = f"{media_type}_{amount}"
-    label = f"{amount} {media_type.capitalize()}"
-    
-    discount_price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-    
-    if discount_price != -1: return f"{label} ~{base_price}~{discount_price}€ ✨"
-    else: return f"{label} {base_price}€"
+# --- Preise ---
+class PriceService:
+    """All package prices of a user plus the ready-made prices keyboard, cached per user (LRU, max_entries users).
+    Every discount change goes through set_user_discount()/clear_user_discount(), which drop the user's entry."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries; self.cache = OrderedDict()
+
+    def invalidate(self, user_id): self.cache.pop(str(user_id), None)
+
+    def invalidate_all(self): self.cache.clear()
+
+    def entry(self, user_id) -> dict:
+        user_id = str(user_id); cached = self.cache.get(user_id)
+        if cached: self.cache.move_to_end(user_id); return cached
+        discount_data = load_stats().get("users", {}).get(user_id, {}).get("discounts"); prices = {}; labels = {}
+        for media_type, amounts in PRICES.items():
+            for amount, base_price in amounts.items():
+                package_key = f"{media_type}_{amount}"; label = f"{amount} {media_type.capitalize()}"; discount_price = get_discounted_price(base_price, discount_data, package_key)
+                prices[package_key] = (base_price, base_price if discount_price == -1 else discount_price)
+                labels[package_key] = f"{label} ~{base_price}~{discount_price}€ ✨" if discount_price != -1 else f"{label} {base_price}€"
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(labels[f"{media_type}_{amount}"], callback_data=f"select_package:{media_type}:{amount}") for media_type in ("bilder", "videos")] for amount in (10, 25, 35)] + [[InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]])
+        entry = {"prices": prices, "labels": labels, "keyboard": keyboard}; self.cache[user_id] = entry
+        if len(self.cache) > self.max_entries: self.cache.popitem(last=False)
+        return entry
+
+price_service = PriceService(PRICE_CACHE_SIZE)
+
+def get_user_price(user_id: int, media_type: str, amount: int) -> tuple:
+    """Returns (base_price, final_price) for one package."""
+    return price_service.entry(user_id)["prices"][f"{media_type}_{amount}"]
+
+def set_user_discount(stats: dict, user_id: str, discount: dict):
+    stats["users"][user_id]["discounts"] = discount; price_service.invalidate(user_id)
+
+def clear_user_discount(stats: dict, user_id: str) -> bool:
+    if stats["users"][user_id].pop("discounts", None) is None: return False
+    price_service.invalidate(user_id); return True
 
 async def check_user_status(user_id: int, context: ContextTypes.DEFAULT_TYPE, ref_id: str = None):
     if str(user_id) == ADMIN_USER_ID: return "admin", False, None
@@ -144,44 +1631,176 @@ async def check_user_status(user_id: int, context: ContextTypes.DEFAULT_TYPE, re
             "preview_clicks": 0, "viewed_sisters": [], "payments_initiated": [], "banned": False,
             "referrer_id": ref_id, "referrals": [], "successful_referrals": 0, "reward_triggered_for_referrer": False
         }
-        if ref_id and ref_id in stats["users"]: stats["users"][ref_id].setdefault("referrals", []).append(user_id_str)
-        save_stats(stats); await update_pinned_summary(context); return "new", True, stats["users"][user_id_str]
-    last_start_dt = datetime.fromisoformat(user_data.get("last_start"))
-    if now - last_start_dt > timedelta(hours=24):
-        stats["users"][user_id_str]["last_start"] = now.isoformat(); save_stats(stats); return "returning", True, stats["users"][user_id_str]
-    stats["users"][user_id_str]["last_start"] = now.isoformat(); save_stats(stats); return "active", False, stats["users"][user_id_str]
+        if ref_id and ref_id in stats["users"]: referrer = stats["users"][ref_id]; referrer["referrals"] = referrer.get("referrals", []) + [user_id_str]
+        activity_window.touch(user_id_str, now); inactivity_discounts.push(user_id_str, now); save_stats(stats); request_dashboard_update(); return "new", True, stats["users"][user_id_str]
+    user_data.pop("blocked", None); activity_window.touch(user_id_str, now)
+    last_start_dt = user_time(user_data, "last_start"); set_user_time(user_data, "last_start", now); save_stats(stats)
+    if last_start_dt is None or now - last_start_dt > timedelta(hours=24): return "returning", True, user_data
+    return "active", False, user_data
 
-async def send_or_update_admin_log(context: ContextTypes.DEFAULT_TYPE, user: User, event_text: str = ""):
-    if not NOTIFICATION_GROUP_ID or str(user.id) == ADMIN_USER_ID: return
-    user_id_str = str(user.id); stats = load_stats(); admin_logs = stats.get("admin_logs", {}); user_data = stats.get("users", {}).get(user_id_str, {}); log_message_id = admin_logs.get(user_id_str, {}).get("message_id")
+# --- Inaktivitäts-Rabatt ---
+INACTIVITY_DISCOUNT = {"type": "percent", "value": 20}
+
+def inactivity_discount_open(user_data) -> bool:
+    return bool(user_data) and not user_data.get("discount_sent") and "discounts" not in user_data and not user_data.get("banned")
+
+class InactivityDiscountQueue:
+    """Users that may still get the inactivity discount, as a min-heap of (due time, user id) with due time =
+    first_start + INACTIVITY_DISCOUNT_AFTER. Filled once from the store at startup and by every new user afterwards
+    (in the multi-process mode per worker, with the users it owns), so a tick only pops the users that became due.
+    `due` holds the current entry per user; heap entries that no longer match it are stale and skipped (lazy deletion)."""
+    def __init__(self, delay: timedelta):
+        self.delay = delay; self.heap = []; self.due = {}
+
+    def push(self, user_id: str, first_start: datetime):
+        due = first_start + self.delay
+        if self.due.get(user_id) == due: return
+        self.due[user_id] = due; heapq.heappush(self.heap, (due, user_id))
+
+    def seed(self, candidates: list):
+        self.due = {user_id: first_start + self.delay for user_id, first_start in candidates}
+        self.heap = [(due, user_id) for user_id, due in self.due.items()]; heapq.heapify(self.heap)
+
+    def pop_due(self, now: datetime, limit: int) -> list:
+        user_ids = []
+        while self.heap and self.heap[0][0] <= now and len(user_ids) < limit:
+            due, user_id = heapq.heappop(self.heap)
+            if self.due.get(user_id) == due: del self.due[user_id]; user_ids.append(user_id)
+        return user_ids
+
+    def __len__(self): return len(self.due)
+
+inactivity_discounts = InactivityDiscountQueue(timedelta(hours=INACTIVITY_DISCOUNT_AFTER))
+metrics.gauge("inactivity_discount_queue", "gauge", "Users waiting for the inactivity discount.", lambda: len(inactivity_discounts))
+metrics.describe("inactivity_discounts_granted_total", "counter", "Inactivity discounts granted by the scheduler.")
+
+async def grant_inactivity_discounts(context: ContextTypes.DEFAULT_TYPE):
+    """Job: grants the discount to at most INACTIVITY_DISCOUNT_BATCH due users, with one stats save and one discount
+    backup request per batch. The notifications go through the global send limiter."""
+    now = datetime.now(); due = inactivity_discounts.pop_due(now, INACTIVITY_DISCOUNT_BATCH)
+    if not due: return
+    stats = load_stats(); granted = []
+    for user_id in due:
+        user_data = stats["users"].get(user_id)
+        if not inactivity_discount_open(user_data): continue
+        first_start = user_time(user_data, "first_start")
+        # first_start moved (e.g. the stats were reset and the user started again): not due yet.
+        if first_start is None or first_start + inactivity_discounts.delay > now:
+            if first_start: inactivity_discounts.push(user_id, first_start)
+            continue
+        set_user_discount(stats, user_id, dict(INACTIVITY_DISCOUNT)); user_data["discount_sent"] = True; granted.append(user_id)
+    if not granted: return
+    save_stats(stats); request_discount_backup(); request_dashboard_update(); metrics.inc("inactivity_discounts_granted_total", len(granted))
+    text = ("🎁 DEIN PERSÖNLICHES ANGEBOT! 🎁\n\n" "Wir haben dir gerade einen exklusiven 20% Rabatt auf alle Pakete gutgeschrieben!\n\n" "Klicke hier, um deine neuen, reduzierten Preise zu sehen und direkt zuzuschlagen:")
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("💸 Zu meinen exklusiven Preisen 💸", callback_data="show_price_options")]])
+    await asyncio.gather(*(notify_user(context, user_id, text, reply_markup=keyboard) for user_id in granted))
+    logger.info(f"Inaktivitäts-Rabatt an {len(granted)} Nutzer vergeben ({len(inactivity_discounts)} wartend).")
+    await side_effects.submit(send_permanent_admin_notification, context, f"💸 *20% Rabatt (Inaktivität >{INACTIVITY_DISCOUNT_AFTER:g}h)* an {len(granted)} Nutzer vergeben.")
+
+# --- Admin-Log (gepuffert) ---
+admin_log_pending = {}
+admin_log_sent_hashes = OrderedDict()  # user id -> hash of the last delivered text, the ADMIN_LOG_HASH_CACHE most recent users
+
+def remember_admin_log(user_id_str: str, final_text: str):
+    # A forgotten user only costs one edit that Telegram answers with "message is not modified".
+    admin_log_sent_hashes[user_id_str] = hash(final_text); admin_log_sent_hashes.move_to_end(user_id_str)
+    if len(admin_log_sent_hashes) > ADMIN_LOG_HASH_CACHE: admin_log_sent_hashes.popitem(last=False)
+
+def render_admin_log(user: User, user_data: dict, event_text: str) -> str:
     user_mention = f"[{escape_markdown(user.first_name, version=2)}](tg://user?id={user.id})"; discount_emoji = "💸" if user_data.get("discount_sent") or "discounts" in user_data else ""; banned_emoji = "🚫" if user_data.get("banned") else ""
     first_start_str = "N/A"
-    if user_data.get("first_start"): first_start_str = datetime.fromisoformat(user_data["first_start"]).strftime('%Y-%m-%d %H:%M')
+    first_start_dt = user_time(user_data, "first_start")
+    if first_start_dt: first_start_str = first_start_dt.strftime('%Y-%m-%d %H:%M')
     viewed_sisters_list = user_data.get("viewed_sisters", []); viewed_sisters_str = f"(Gesehen: {', '.join(s.upper() for s in sorted(viewed_sisters_list))})" if viewed_sisters_list else ""; preview_clicks = user_data.get("preview_clicks", 0); payments = user_data.get("payments_initiated", []); payments_str = "\n".join(f"   • {p}" for p in payments) if payments else "   • Keine"
     base_text = (f"👤 *Nutzer-Aktivität* {discount_emoji}{banned_emoji}\n\n" f"*Nutzer:* {user_mention} (`{user.id}`)\n" f"*Erster Start:* `{first_start_str}`\n\n" f"🖼️ *Vorschau-Klicks:* {preview_clicks}/25 {viewed_sisters_str}\n\n" f"💰 *Bezahlversuche*\n{payments_str}")
-    final_text = f"{base_text}\n\n`Letzte Aktion: {event_text}`".strip()
+    return f"{base_text}\n\n`Letzte Aktion: {event_text}`".strip()
+
+async def send_or_update_admin_log(context: ContextTypes.DEFAULT_TYPE, user: User, event_text: str = ""):
+    """Renders the user's activity log and buffers it; flush_admin_logs() delivers only the latest state per user."""
+    if not NOTIFICATION_GROUP_ID or str(user.id) == ADMIN_USER_ID: return
+    user_data = load_stats().get("users", {}).get(str(user.id), {})
+    admin_log_pending[str(user.id)] = render_admin_log(user, user_data, event_text)
+
+async def deliver_admin_log(bot, user_id_str: str, final_text: str):
+    stats = load_stats(); admin_logs = stats.get("admin_logs", {}); log_message_id = admin_logs.get(user_id_str, {}).get("message_id")
+    async def send_new():
+        sent_message = await call_rate_limited(bot.send_message, chat_id=NOTIFICATION_GROUP_ID, text=final_text, parse_mode='Markdown', limiter=admin_group_limiter)
+        admin_logs[user_id_str] = {**admin_logs.get(user_id_str, {}), "message_id": sent_message.message_id}; stats["admin_logs"] = admin_logs; save_stats(stats)
     try:
-        if log_message_id: await context.bot.edit_message_text(chat_id=NOTIFICATION_GROUP_ID, message_id=log_message_id, text=final_text, parse_mode='Markdown')
-        else:
-            sent_message = await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=final_text, parse_mode='Markdown')
-            admin_logs.setdefault(user_id_str, {})["message_id"] = sent_message.message_id; stats["admin_logs"] = admin_logs; save_stats(stats)
+        if log_message_id: await call_rate_limited(bot.edit_message_text, chat_id=NOTIFICATION_GROUP_ID, message_id=log_message_id, text=final_text, parse_mode='Markdown', limiter=admin_group_limiter)
+        else: await send_new()
+        remember_admin_log(user_id_str, final_text)
     except error.BadRequest as e:
         if "message to edit not found" in str(e):
-            logger.warning(f"Admin log for user {user.id} not found (ID: {log_message_id}). Sending a new one.")
-            try:
-                sent_message = await context.bot.send_message(chat_id=NOTIFICATION_GROUP_ID, text=final_text, parse_mode='Markdown')
-                admin_logs.setdefault(user_id_str, {})["message_id"] = sent_message.message_id; stats["admin_logs"] = admin_logs; save_stats(stats)
-            except Exception as e_new: logger.error(f"Failed to send replacement admin log for user {user.id}: {e_new}")
-        else: logger.error(f"BadRequest on admin log for user {user.id}: {e}")
-    except error.TelegramError as e:
-        if 'message is not modified' not in str(e): logger.warning(f"Temporary error updating admin log for user {user.id} (ID: {log_message_id}): {e}")
+            logger.warning(f"Admin log for user {user_id_str} not found (ID: {log_message_id}). Sending a new one.")
+            try: await send_new(); remember_admin_log(user_id_str, final_text)
+            except Exception as e_new: logger.error(f"Failed to send replacement admin log for user {user_id_str}: {e_new}")
+        elif 'message is not modified' in str(e): remember_admin_log(user_id_str, final_text)
+        else: logger.error(f"BadRequest on admin log for user {user_id_str}: {e}")
+    except error.TelegramError as e: logger.warning(f"Temporary error updating admin log for user {user_id_str} (ID: {log_message_id}): {e}")
+
+async def flush_admin_logs(context: ContextTypes.DEFAULT_TYPE):
+    if leader_lease and not leader_lease.held: stats_store.push_admin_logs(admin_log_pending); admin_log_pending.clear(); return
+    for user_id_str, text in stats_store.pop_admin_logs().items(): admin_log_pending.setdefault(user_id_str, text)
+    while admin_log_pending:
+        user_id_str, final_text = next(iter(admin_log_pending.items()))
+        if admin_log_sent_hashes.get(user_id_str) != hash(final_text): await deliver_admin_log(context.bot, user_id_str, final_text)
+        # Removed only once delivered, so a flush cancelled at shutdown keeps it; a newer text stays queued.
+        if admin_log_pending.get(user_id_str) is final_text: del admin_log_pending[user_id_str]
+
+async def flush_admin_logs_on_stop(context: ContextTypes.DEFAULT_TYPE):
+    """At most ADMIN_LOG_SHUTDOWN_TIMEOUT of deliveries (20 per minute); the rest goes to the outbox for the next start."""
+    try: await asyncio.wait_for(flush_admin_logs(context), ADMIN_LOG_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError: logger.warning(f"{len(admin_log_pending)} Admin-Logs beim Beenden nicht zugestellt, werden beim nächsten Start gesendet.")
+    stats_store.push_admin_logs(admin_log_pending); admin_log_pending.clear()
+
+# --- Dashboard ---
+class ActivityWindow:
+    """Users grouped into fixed time buckets by their last_start. Counting the users active within `window`
+    costs O(buckets); buckets that fall out of the window are dropped together with their users."""
+    def __init__(self, window: timedelta, bucket_seconds: int):
+        self.bucket_seconds = bucket_seconds; self.window_buckets = int(window.total_seconds() // bucket_seconds); self.buckets = {}; self.user_bucket = {}
+
+    def _bucket(self, when: datetime) -> int: return int(when.timestamp() // self.bucket_seconds)
+
+    def touch(self, user_id: str, when: datetime):
+        bucket = self._bucket(when); old_bucket = self.user_bucket.get(user_id)
+        if old_bucket is not None and old_bucket >= bucket: return
+        if old_bucket is not None and old_bucket in self.buckets:
+            self.buckets[old_bucket].discard(user_id)
+            if not self.buckets[old_bucket]: del self.buckets[old_bucket]
+        self.buckets.setdefault(bucket, set()).add(user_id); self.user_bucket[user_id] = bucket
+
+    def count(self, now: datetime = None) -> int:
+        oldest = self._bucket(now or datetime.now()) - self.window_buckets
+        for bucket in [b for b in self.buckets if b <= oldest]:
+            for user_id in self.buckets.pop(bucket): self.user_bucket.pop(user_id, None)
+        return sum(len(users) for users in self.buckets.values())
+
+    def reset(self): self.buckets = {}; self.user_bucket = {}
+
+activity_window = ActivityWindow(timedelta(hours=24), ACTIVITY_BUCKET_SECONDS)
+dashboard_dirty = False
+
+def seed_activity_window():
+    activity_window.reset(); since = datetime.now() - timedelta(hours=24)
+    for user_id, last_start in stats_store.users_active_since(since): activity_window.touch(user_id, datetime.fromisoformat(last_start))
+
+def request_dashboard_update():
+    global dashboard_dirty
+    dashboard_dirty = True
+
+async def flush_dashboard(context: ContextTypes.DEFAULT_TYPE):
+    global dashboard_dirty
+    if not dashboard_dirty or not is_leader(): return
+    if reconcile_task and not reconcile_task.done(): return  # don't overwrite the pinned counters before they were read
+    dashboard_dirty = False; await update_pinned_summary(context)
 
 async def update_pinned_summary(context: ContextTypes.DEFAULT_TYPE):
     if not NOTIFICATION_GROUP_ID: return
-    stats = load_stats(); user_count = len(stats.get("users", {})); active_users_24h = 0; now = datetime.now()
-    for user_data in stats.get("users", {}).values():
-        last_start_dt = datetime.fromisoformat(user_data.get("last_start", "1970-01-01T00:00:00"))
-        if now - last_start_dt <= timedelta(hours=24): active_users_24h += 1
+    stats = load_stats(); user_count = len(stats.get("users", {}))
+    # Other workers' users are not in this process's activity window; the leader counts them in the database instead.
+    active_users_24h = activity_window.count() if leader_lease is None else stats_store.count_active_since(datetime.now() - timedelta(hours=24))
     events = stats.get("events", {})
     text = (f"📊 *Bot-Statistik Dashboard*\n" f"🕒 _Letztes Update:_ `{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}`\n\n" f"👥 *Nutzerübersicht*\n" f"   • Gesamt: *{user_count}*\n" f"   • Aktiv (24h): *{active_users_24h}*\n" f"   • Starts: *{events.get('start_command', 0)}*\n\n" f"💰 *Bezahl-Interesse*\n" f"   • PayPal: *{events.get('payment_paypal', 0)}*\n" f"   • Krypto: *{events.get('payment_crypto', 0)}*\n" f"   • Gutschein: *{events.get('payment_voucher', 0)}*\n\n" f"🖱️ *Klick-Verhalten*\n" f"   • Vorschau (KS): *{events.get('preview_ks', 0)}*\n" f"   • Vorschau (GS): *{events.get('preview_gs', 0)}*\n" f"   • Preise (KS): *{events.get('prices_ks', 0)}*\n" f"   • Preise (GS): *{events.get('prices_gs', 0)}*\n" f"   • 'Nächstes Bild': *{events.get('next_preview', 0)}*\n" f"   • Paketauswahl: *{events.get('package_selected', 0)}*")
     pinned_id = stats.get("pinned_message_id")
@@ -196,46 +1815,290 @@ async def update_pinned_summary(context: ContextTypes.DEFAULT_TYPE):
             await context.bot.pin_chat_message(chat_id=NOTIFICATION_GROUP_ID, message_id=sent_message.message_id, disable_notification=True)
         except Exception as e_new: logger.error(f"Konnte Dashboard nicht erstellen/anpinnen: {e_new}")
 
+DASHBOARD_EVENT_PATTERNS = {"start_command": r"Starts:\s*\*(\d+)\*", "payment_paypal": r"PayPal:\s*\*(\d+)\*", "payment_crypto": r"Krypto:\s*\*(\d+)\*", "payment_voucher": r"Gutschein:\s*\*(\d+)\*",
+                            "preview_ks": r"Vorschau \(KS\):\s*\*(\d+)\*", "preview_gs": r"Vorschau \(GS\):\s*\*(\d+)\*", "prices_ks": r"Preise \(KS\):\s*\*(\d+)\*", "prices_gs": r"Preise \(GS\):\s*\*(\d+)\*",
+                            "next_preview": r"'Nächstes Bild':\s*\*(\d+)\*", "package_selected": r"Paketauswahl:\s*\*(\d+)\*"}
+
 async def restore_stats_from_pinned_message(application: Application):
+    """Raises local event counters that are behind the pinned dashboard (e.g. after the stats file was lost). Counters are
+    only ever increased, and users are never invented: anyone missing locally is recreated on their next /start."""
     if not NOTIFICATION_GROUP_ID: logger.info("Keine NOTIFICATION_GROUP_ID gesetzt, Wiederherstellung übersprungen."); return
-    logger.info("Versuche, Statistiken wiederherzustellen...")
     try:
-        chat = await application.bot.get_chat(chat_id=NOTIFICATION_GROUP_ID)
-        if not chat.pinned_message or "Bot-Statistik Dashboard" not in chat.pinned_message.text: logger.warning("Keine passende Dashboard-Nachricht gefunden."); return
-        pinned_text = chat.pinned_message.text; stats = load_stats()
+        chat = await application.bot.get_chat(chat_id=NOTIFICATION_GROUP_ID); pinned_text = chat.pinned_message.text if chat.pinned_message else None
+        if not pinned_text or "Bot-Statistik Dashboard" not in pinned_text: logger.warning("Keine passende Dashboard-Nachricht gefunden."); return
         def extract(p, t): return int(re.search(p, t, re.DOTALL).group(1)) if re.search(p, t, re.DOTALL) else 0
-        user_count = extract(r"Gesamt:\s*\*(\d+)\*", pinned_text)
-        if len(stats.get("users", {})) < user_count:
-            for i in range(user_count - len(stats.get("users", {}))): stats["users"][f"restored_user_{i}"] = {"first_start": "1970-01-01T00:00:00", "last_start": "1970-01-01T00:00:00"}
-        stats['events']['start_command'] = extract(r"Starts:\s*\*(\d+)\*", pinned_text); stats['events']['payment_paypal'] = extract(r"PayPal:\s*\*(\d+)\*", pinned_text); stats['events']['payment_crypto'] = extract(r"Krypto:\s*\*(\d+)\*", pinned_text); stats['events']['payment_voucher'] = extract(r"Gutschein:\s*\*(\d+)\*", pinned_text); stats['events']['preview_ks'] = extract(r"Vorschau \(KS\):\s*\*(\d+)\*", pinned_text); stats['events']['preview_gs'] = extract(r"Vorschau \(GS\):\s*\*(\d+)\*", pinned_text); stats['events']['prices_ks'] = extract(r"Preise \(KS\):\s*\*(\d+)\*", pinned_text); stats['events']['prices_gs'] = extract(r"Preise \(GS\):\s*\*(\d+)\*", pinned_text); stats['events']['next_preview'] = extract(r"'Nächstes Bild':\s*\*(\d+)\*", pinned_text); stats['events']['package_selected'] = extract(r"Paketauswahl:\s*\*(\d+)\*", pinned_text)
-        stats['pinned_message_id'] = chat.pinned_message.message_id; save_stats(stats); logger.info("Statistiken erfolgreich wiederhergestellt.")
+        stats = load_stats(); raised = {}
+        for event_name, pattern in DASHBOARD_EVENT_PATTERNS.items():
+            behind = extract(pattern, pinned_text) - stats["events"].get(event_name, 0)
+            if behind > 0: raised[event_name] = increment_event(event_name, behind)
+        missing_users = extract(r"Gesamt:\s*\*(\d+)\*", pinned_text) - len(stats.get("users", {}))
+        if missing_users > 0: logger.warning(f"Das Dashboard kennt {missing_users} Nutzer mehr als der lokale Speicher; sie werden beim nächsten /start neu angelegt.")
+        if stats.get("pinned_message_id") != chat.pinned_message.message_id: stats["pinned_message_id"] = chat.pinned_message.message_id; save_stats(stats)
+        logger.info(f"Dashboard abgeglichen, angehobene Zähler: {raised or 'keine'}.")
     except Exception as e: logger.error(f"Fehler bei Wiederherstellung: {e}")
 
+async def reconcile_with_telegram(application: Application):
+    """Background part of startup: the bot already serves from the local snapshot while this compares it with the
+    Telegram-side backups (pinned dashboard, discount document)."""
+    started = time.monotonic()
+    await restore_stats_from_pinned_message(application)
+    await load_discounts_from_telegram(application)
+    logger.info(f"Abgleich mit Telegram abgeschlossen ({time.monotonic() - started:.1f}s).")
+
+reconcile_task = None
+
+# --- Medien-Derivate ---
+class MediaDerivatives:
+    """Size- and quality-tuned JPEG copies of MEDIA_DIR. Derivatives are named after the SHA-256 of the source plus the
+    render settings, so an unchanged image is never re-rendered; manifest.json maps each source file to its derivative
+    and is checked by size/mtime first so only changed sources are hashed again."""
+    def __init__(self, out_dir: str, max_side: int, quality: int):
+        self.out_dir = out_dir; self.max_side = max_side; self.quality = quality; self.manifest_path = os.path.join(out_dir, "manifest.json"); self.manifest = None
+
+    def _load_manifest(self) -> dict:
+        if self.manifest is None:
+            try:
+                with open(self.manifest_path, "r") as f: self.manifest = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError): self.manifest = {}
+        return self.manifest
+
+    def _render(self, source: str, target: str) -> bool:
+        from PIL import Image, ImageOps
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB"); image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            fd, tmp_path = tempfile.mkstemp(prefix=".derived.", suffix=".jpg", dir=self.out_dir); os.close(fd)
+            try: image.save(tmp_path, "JPEG", quality=self.quality, optimize=True, progressive=True)
+            except BaseException: os.unlink(tmp_path); raise
+        if os.path.getsize(tmp_path) >= os.path.getsize(source): os.unlink(tmp_path); return False
+        os.replace(tmp_path, target); return True
+
+    def sync(self, media_dir: str, filenames: list) -> dict:
+        """Brings the derivatives in line with `filenames` and returns {"built", "reused", "skipped"} counts."""
+        try: import PIL  # noqa: F401
+        except ImportError: logger.warning("Pillow ist nicht installiert, Bilder werden unverändert hochgeladen."); self.manifest = {}; return {"built": 0, "reused": 0, "skipped": len(filenames)}
+        os.makedirs(self.out_dir, exist_ok=True); old_manifest = self._load_manifest(); manifest = {}; counts = {"built": 0, "reused": 0, "skipped": 0}
+        for filename in filenames:
+            source = os.path.join(media_dir, filename)
+            try: st = os.stat(source)
+            except OSError: continue
+            entry = old_manifest.get(filename)
+            if not entry or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+                with open(source, "rb") as f: entry = {"sha256": hashlib.sha256(f.read()).hexdigest(), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+            settings = f"{entry['sha256'][:20]}_{self.max_side}q{self.quality}.jpg"; target = os.path.join(self.out_dir, settings)
+            if entry.get("settings") == settings and (entry.get("derivative") is None or os.path.exists(target)): counts["reused" if entry.get("derivative") else "skipped"] += 1
+            elif os.path.exists(target): entry = {**entry, "settings": settings, "derivative": settings, "bytes": os.path.getsize(target)}; counts["reused"] += 1
+            else:
+                try: built = self._render(source, target)
+                except (OSError, ValueError) as e: logger.warning(f"Derivat für {filename} konnte nicht erstellt werden: {e}"); built = False
+                entry = {**entry, "settings": settings, "derivative": settings if built else None, "bytes": os.path.getsize(target) if built else st.st_size}
+                counts["built" if built else "skipped"] += 1
+            manifest[filename] = entry
+        if manifest != old_manifest: atomic_write_json(self.manifest_path, manifest, indent=2)
+        referenced = {entry["derivative"] for entry in manifest.values() if entry.get("derivative")} | {"manifest.json"}
+        for filename in os.listdir(self.out_dir):
+            if filename not in referenced and not filename.startswith("."):
+                try: os.unlink(os.path.join(self.out_dir, filename))
+                except OSError: pass
+        self.manifest = manifest; return counts
+
+    def path_for(self, source_filename: str):
+        entry = (self.manifest or {}).get(source_filename)
+        return os.path.join(self.out_dir, entry["derivative"]) if entry and entry.get("derivative") else None
+
+# --- Medien-Katalog & file_id-Cache ---
+class MediaCatalog:
+    """Sorted media lists per (schwester_code, media_type), rebuilt only when MEDIA_DIR changes, plus the
+    Telegram file_id of every image that was already uploaded once (persisted in MEDIA_CACHE_FILE). Uploads use the
+    pre-optimized derivative of an image when there is one; the file_id is keyed by the source file alone, so an
+    image uploaded before its derivative was ready is not uploaded again."""
+    def __init__(self, media_dir: str, cache_file: str, derivatives: MediaDerivatives = None):
+        self.media_dir = media_dir; self.cache_file = cache_file; self.derivatives = derivatives; self._dir_mtime = None; self._listing = []; self._index = {}; self.file_ids = None
+        self._derivative_lock = asyncio.Lock(); self._derivative_tasks = set()
+
+    def _refresh(self):
+        try: mtime = os.stat(self.media_dir).st_mtime_ns
+        except FileNotFoundError: logger.error(f"Media-Verzeichnis '{self.media_dir}' nicht gefunden!"); self._dir_mtime = None; self._listing = []; self._index = {}; return
+        if mtime != self._dir_mtime:
+            filenames = os.listdir(self.media_dir); self._listing = [(filename.lower().lstrip('•-_ ').replace(' ', '_'), filename) for filename in filenames]; self._index = {}; self._dir_mtime = mtime
+            if self.derivatives: self._sync_derivatives([filename for filename in filenames if filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))])
+
+    def _sync_derivatives(self, filenames: list):
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: self._log_derivatives(self.derivatives.sync(self.media_dir, filenames)); return
+        # Rendering takes seconds; uploads use the originals until the derivatives are ready.
+        task = loop.create_task(self._sync_derivatives_async(filenames)); self._derivative_tasks.add(task); task.add_done_callback(self._derivative_tasks.discard)
+
+    async def _sync_derivatives_async(self, filenames: list):
+        try:
+            async with self._derivative_lock: self._log_derivatives(await asyncio.to_thread(self.derivatives.sync, self.media_dir, filenames))
+        except Exception as e: logger.error(f"Medien-Derivate konnten nicht erstellt werden: {e}")
+
+    @staticmethod
+    def _log_derivatives(counts: dict):
+        if counts["built"]: logger.info(f"Medien-Derivate aktualisiert: {counts}")
+
+    def refresh(self):
+        self._dir_mtime = None; self._refresh()
+
+    def upload_path(self, path: str) -> str:
+        """The file that is actually sent to Telegram for `path`: its derivative if one exists, else the original."""
+        derived = self.derivatives.path_for(os.path.basename(path)) if self.derivatives else None
+        return derived if derived and os.path.exists(derived) else path
+
+    def files(self, schwester_code: str, media_type: str) -> list:
+        self._refresh(); key = (schwester_code.lower(), media_type.lower())
+        if key not in self._index:
+            target_prefix = f"{key[0]}_{key[1]}"
+            self._index[key] = sorted(os.path.join(self.media_dir, filename) for normalized, filename in self._listing if normalized.startswith(target_prefix))
+        return self._index[key]
+
+    def _cache_key(self, path: str) -> str:
+        st = os.stat(path); return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+    def _load_file_ids(self) -> dict:
+        if self.file_ids is None:
+            try:
+                with open(self.cache_file, "r") as f: self.file_ids = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError): self.file_ids = {}
+            # Older caches keyed derivative uploads as "<source>:<derivative>"; move them to the source key.
+            for key in [key for key in self.file_ids if key.count(":") == 1]:
+                file_id = self.file_ids.pop(key)
+                try: self.file_ids.setdefault(self._cache_key(os.path.join(self.media_dir, key.split(":")[0])), file_id)
+                except OSError: pass
+        return self.file_ids
+
+    def file_id(self, path: str):
+        try: return self._load_file_ids().get(self._cache_key(path))
+        except OSError: return None
+
+    def remember(self, path: str, file_id: str):
+        file_ids = self._load_file_ids()
+        for key in [k for k in file_ids if k.split(":")[0] == os.path.basename(path)]: del file_ids[key]
+        file_ids[self._cache_key(path)] = file_id
+        try: atomic_write_json(self.cache_file, file_ids, indent=2)
+        except OSError as e: logger.warning(f"Konnte {self.cache_file} nicht schreiben: {e}")
+
+    def forget(self, path: str):
+        if self._load_file_ids().pop(self._cache_key(path), None) is not None: atomic_write_json(self.cache_file, self.file_ids, indent=2)
+
+media_catalog = MediaCatalog(MEDIA_DIR, MEDIA_CACHE_FILE, MediaDerivatives(MEDIA_DERIVED_DIR, MEDIA_MAX_SIDE, MEDIA_JPEG_QUALITY))
+
 def get_media_files(schwester_code: str, media_type: str) -> list:
-    matching_files = []; target_prefix = f"{schwester_code.lower()}_{media_type.lower()}"
-    if not os.path.isdir(MEDIA_DIR): logger.error(f"Media-Verzeichnis '{MEDIA_DIR}' nicht gefunden!"); return []
-    for filename in os.listdir(MEDIA_DIR):
-        normalized_filename = filename.lower().lstrip('•-_ ').replace(' ', '_')
-        if normalized_filename.startswith(target_prefix): matching_files.append(os.path.join(MEDIA_DIR, filename))
-    return matching_files
-
-async def cleanup_previous_messages(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    if "messages_to_delete" in context.user_data:
-        for msg_id in context.user_data["messages_to_delete"]:
-            try: await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except error.TelegramError: pass
-        context.user_data["messages_to_delete"] = []
+    return list(media_catalog.files(schwester_code, media_type))
+
+# --- Vorschau-Prefetch ---
+class PreviewPrefetcher:
+    """Warms the image a preview session will show next while the user still looks at the current one. With
+    PREVIEW_CACHE_CHAT_ID the image is uploaded there once so the next click is an edit by file_id; otherwise its bytes
+    are preloaded into a bounded LRU cache and the click only pays the upload."""
+    def __init__(self, cache_chat_id, max_entries: int):
+        self.cache_chat_id = cache_chat_id; self.max_entries = max_entries; self._bytes = OrderedDict(); self._inflight = {}; self.warmed = 0; self.hits = 0
+
+    def schedule(self, context: ContextTypes.DEFAULT_TYPE, image_paths: list, current_index: int):
+        if len(image_paths) < 2: return
+        path = image_paths[(current_index + 1) % len(image_paths)]
+        if path in self._inflight or path in self._bytes or media_catalog.file_id(path): return
+        side_effects.try_submit(self.warm, context.bot, path)
+
+    async def warm(self, bot, path: str):
+        if path in self._inflight or media_catalog.file_id(path): return
+        done = self._inflight[path] = asyncio.get_running_loop().create_future()
+        try:
+            data = await asyncio.to_thread(self._read, media_catalog.upload_path(path))
+            if self.cache_chat_id:
+                message = await call_rate_limited(bot.send_photo, chat_id=self.cache_chat_id, photo=data, disable_notification=True)
+                if message.photo: media_catalog.remember(path, message.photo[-1].file_id)
+            else:
+                self._bytes[path] = data; self._bytes.move_to_end(path)
+                while len(self._bytes) > self.max_entries: self._bytes.popitem(last=False)
+            self.warmed += 1
+        except (OSError, error.TelegramError) as e: logger.warning(f"Prefetch von {path} fehlgeschlagen: {e}")
+        finally: del self._inflight[path]; done.set_result(None)
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as f: return f.read()
+
+    async def wait(self, path: str):
+        """Lets a click that races its own prefetch reuse that upload instead of starting a second one."""
+        done = self._inflight.get(path)
+        if done:
+            try: await asyncio.wait_for(asyncio.shield(done), PREVIEW_PREFETCH_WAIT)
+            except asyncio.TimeoutError: pass
+
+    def take_bytes(self, path: str):
+        data = self._bytes.pop(path, None)
+        if data is not None: self.hits += 1
+        return data
+
+preview_prefetcher = PreviewPrefetcher(PREVIEW_CACHE_CHAT_ID, PREVIEW_PREFETCH_CACHE_SIZE)
+metrics.gauge("preview_prefetch", "gauge", "Preview prefetches warmed and used from the byte cache.", lambda: {(("stat", "warmed"),): preview_prefetcher.warmed, (("stat", "hits"),): preview_prefetcher.hits, (("stat", "cached"),): len(preview_prefetcher._bytes)})
+
+async def send_media_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, path: str, **kwargs):
+    await preview_prefetcher.wait(path); file_id = media_catalog.file_id(path)
+    if file_id:
+        try: return await context.bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except error.BadRequest as e: logger.warning(f"file_id für {path} ungültig, lade neu hoch: {e}"); media_catalog.forget(path)
+    data = preview_prefetcher.take_bytes(path)
+    if data is not None: message = await context.bot.send_photo(chat_id=chat_id, photo=data, **kwargs)
+    else:
+        with open(media_catalog.upload_path(path), 'rb') as photo_file: message = await context.bot.send_photo(chat_id=chat_id, photo=photo_file, **kwargs)
+    if message.photo: media_catalog.remember(path, message.photo[-1].file_id)
+    return message
+
+async def edit_media_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, path: str):
+    await preview_prefetcher.wait(path); file_id = media_catalog.file_id(path)
+    if file_id:
+        try: return await context.bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=InputMediaPhoto(file_id))
+        except error.BadRequest as e:
+            if "not modified" in str(e): raise
+            logger.warning(f"file_id für {path} ungültig, lade neu hoch: {e}"); media_catalog.forget(path)
+    data = preview_prefetcher.take_bytes(path)
+    if data is not None: message = await context.bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=InputMediaPhoto(data))
+    else:
+        with open(media_catalog.upload_path(path), 'rb') as photo_file: message = await context.bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=InputMediaPhoto(photo_file))
+    if isinstance(message, Message) and message.photo: media_catalog.remember(path, message.photo[-1].file_id)
+    return message
+
+# --- Nachrichten aufräumen ---
+def take_messages_to_delete(context: ContextTypes.DEFAULT_TYPE, *extra_ids) -> list:
+    message_ids = context.user_data.get("messages_to_delete", []) + [msg_id for msg_id in extra_ids if msg_id]; context.user_data["messages_to_delete"] = []
+    return list(dict.fromkeys(message_ids))
+
+async def delete_messages_bulk(bot, chat_id: int, message_ids: list):
+    # deleteMessages takes up to 100 IDs per call; if it is rejected, fall back to bounded parallel single deletes.
+    for offset in range(0, len(message_ids), 100):
+        chunk = message_ids[offset:offset + 100]
+        try: await bot.delete_messages(chat_id=chat_id, message_ids=chunk); continue
+        except error.TelegramError: pass
+        semaphore = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+        async def delete_one(msg_id):
+            async with semaphore:
+                try: await bot.delete_message(chat_id=chat_id, message_id=msg_id)
+                except error.TelegramError: pass
+        await asyncio.gather(*(delete_one(msg_id) for msg_id in chunk))
+
+async def cleanup_previous_messages(chat_id: int, context: ContextTypes.DEFAULT_TYPE, message_ids: list = None):
+    """Deletes the given (default: all tracked) messages in the background. Callers take the IDs before sending
+    the next screen and call this afterwards, so navigation only waits for the new screen."""
+    if message_ids is None: message_ids = take_messages_to_delete(context)
+    if message_ids: await side_effects.submit(delete_messages_bulk, context.bot, chat_id, message_ids)
 
 async def send_preview_message(update: Update, context: ContextTypes.DEFAULT_TYPE, schwester_code: str):
-    await cleanup_previous_messages(update.effective_chat.id, context); chat_id = update.effective_chat.id; image_paths = get_media_files(schwester_code, "vorschau"); image_paths.sort()
+    chat_id = update.effective_chat.id; stale_ids = take_messages_to_delete(context)
+    try: await _send_preview_message(context, chat_id, schwester_code)
+    finally: await cleanup_previous_messages(chat_id, context, stale_ids)
+
+async def _send_preview_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, schwester_code: str):
+    image_paths = get_media_files(schwester_code, "vorschau")
     if not image_paths: await context.bot.send_message(chat_id=chat_id, text="Ups! Ich konnte gerade keine passenden Inhalte finden...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="main_menu")]])); return
     context.user_data[f'preview_index_{schwester_code}'] = 0; image_to_show_path = image_paths[0]
-    with open(image_to_show_path, 'rb') as photo_file: photo_message = await context.bot.send_photo(chat_id=chat_id, photo=photo_file, protect_content=True)
+    photo_message = await send_media_photo(context, chat_id, image_to_show_path, protect_content=True)
     if schwester_code == 'gs': caption = f"Heyy ich bin Lara, ich bin {AGE_ANNA} Jahre alt und mache mit meiner Schwester zusammen 🌶️ videos und Bilder falls du lust hast speziele videos zu bekommen schreib mir 😏 @lara_groner"
     else: caption = f"Heyy, mein name ist Luna ich bin {AGE_LUNA} Jahre alt und mache 🌶️ videos und Bilder. wenn du Spezielle wünsche hast schreib meiner Schwester für mehr.\nMeine Schwester: @lara_groner"
     keyboard_buttons = [[InlineKeyboardButton("🛍️ Zu den Preisen", callback_data=f"select_schwester:{schwester_code}:prices")], [InlineKeyboardButton("🖼️ Nächstes Bild", callback_data=f"next_preview:{schwester_code}")], [InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]]
     text_message = await context.bot.send_message(chat_id=chat_id, text=caption, reply_markup=InlineKeyboardMarkup(keyboard_buttons))
-    context.user_data["messages_to_delete"] = [photo_message.message_id, text_message.message_id]
+    context.user_data["messages_to_delete"] = [photo_message.message_id, text_message.message_id]; preview_prefetcher.schedule(context, image_paths, 0)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user; chat_id = update.effective_chat.id
@@ -251,19 +2114,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         status, should_notify, user_data = await check_user_status(user.id, context, ref_id)
         await track_event("start_command", context, user.id)
-        is_eligible_for_discount = False
-        if user_data and not user_data.get("discount_sent") and "discounts" not in user_data:
-            first_start_dt = datetime.fromisoformat(user_data.get("first_start"))
-            if datetime.now() - first_start_dt > timedelta(hours=2):
-                is_eligible_for_discount = True; stats = load_stats()
-                stats["users"][str(user.id)]["discounts"] = {"type": "percent", "value": 20}
-                stats["users"][str(user.id)]["discount_sent"] = True
-                save_stats(stats); await save_discounts_to_telegram(context)
-                await send_or_update_admin_log(context, user, event_text="20% Rabatt (Inaktivität >2h)")
-        if is_eligible_for_discount:
-            discount_notification_text = ("🎁 DEIN PERSÖNLICHES ANGEBOT! 🎁\n\n" "Wir haben dir gerade einen exklusiven 20% Rabatt auf alle Pakete gutgeschrieben!\n\n" "Klicke hier, um deine neuen, reduzierten Preise zu sehen und direkt zuzuschlagen:")
-            discount_notification_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("💸 Zu meinen exklusiven Preisen 💸", callback_data="show_price_options")]])
-            await context.bot.send_message(chat_id=chat_id, text=discount_notification_text, reply_markup=discount_notification_keyboard)
         if should_notify:
             event_text = "Bot gestartet (neuer Nutzer)" if status == "new" else "Bot erneut gestartet"
             if status == "new" and ref_id: event_text += f" (geworben von {ref_id})"
@@ -276,162 +2126,311 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             else: await update.message.reply_text(error_message)
         except Exception as e_reply: logger.error(f"Could not even send error reply to user {user.id}: {e_reply}")
     
-    await cleanup_previous_messages(chat_id, context)
+    stale_ids = take_messages_to_delete(context)
     welcome_text = ( "Herzlich Willkommen! ✨\n\n" "Hier kannst du eine Vorschau meiner Inhalte sehen oder direkt ein Paket auswählen. " "Die gesamte Bedienung erfolgt über die Buttons.")
     keyboard = [[InlineKeyboardButton(" Vorschau", callback_data="show_preview_options"), InlineKeyboardButton(" Preise & Pakete", callback_data="show_price_options")], [InlineKeyboardButton("🤝 Freunde einladen", callback_data="referral_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if update.callback_query:
         query = update.callback_query; await query.answer()
-        try: await query.edit_message_text(welcome_text, reply_markup=reply_markup)
+        try:
+            await query.edit_message_text(welcome_text, reply_markup=reply_markup)
+            if query.message: stale_ids = [msg_id for msg_id in stale_ids if msg_id != query.message.message_id]; context.user_data["messages_to_delete"] = [query.message.message_id]
         except error.TelegramError:
             try: await query.delete_message()
             except Exception: pass
             msg = await context.bot.send_message(chat_id=chat_id, text=welcome_text, reply_markup=reply_markup); context.user_data["messages_to_delete"] = [msg.message_id]
-    else:
-        if update.message is None: return
+    elif update.message is not None:
         msg = await update.message.reply_text(welcome_text, reply_markup=reply_markup); context.user_data["messages_to_delete"] = [msg.message_id]
+    await cleanup_previous_messages(chat_id, context, stale_ids)
 
-async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query; await query.answer(); data = query.data; chat_id = update.effective_chat.id; user = update.effective_user
-    if is_user_banned(user.id): await query.answer("Du bist von der Nutzung dieses Bots ausgeschlossen.", show_alert=True); return
-    if data == "main_menu": await start(update, context); return
-    if data.startswith("admin_"):
-        if str(user.id) != ADMIN_USER_ID: await query.answer("⛔️ Keine Berechtigung.", show_alert=True); return
-        if not data.startswith(("admin_discount", "admin_delete_", "admin_preview_")):
-            for key in list(context.user_data.keys()):
-                if key.startswith(('rabatt_', 'awaiting_')): del context.user_data[key]
-        if data == "admin_main_menu": await show_admin_menu(update, context)
-        elif data == "admin_show_vouchers": await show_vouchers_panel(update, context)
-        elif data == "admin_stats_users":
-            stats = load_stats(); user_count = len(stats.get("users", {})); text = f"📊 *Nutzer-Statistiken*\n\nGesamtzahl der Nutzer: *{user_count}*"; keyboard = [[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        elif data == "admin_stats_clicks":
-            stats = load_stats(); events = stats.get("events", {}); text = "🖱️ *Klick-Statistiken*\n\n"
-            if not events: text += "Noch keine Klicks erfasst."
-            else:
-                for event, count in sorted(events.items()): text += f"- `{event}`: *{count}* Klicks\n"
-            keyboard = [[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        elif data == "admin_reset_stats":
-            text = "⚠️ *Bist du sicher?*\n\nAlle Statistiken werden unwiderruflich auf Null zurückgesetzt."; keyboard = [[InlineKeyboardButton("✅ Ja, zurücksetzen", callback_data="admin_reset_stats_confirm")], [InlineKeyboardButton("❌ Nein, abbrechen", callback_data="admin_main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        elif data == "admin_reset_stats_confirm":
-            stats = load_stats(); stats["users"] = {}; stats["admin_logs"] = {}; stats["events"] = {key: 0 for key in stats["events"]}; save_stats(stats); await update_pinned_summary(context); await query.edit_message_text("✅ Alle Statistiken wurden zurückgesetzt.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]))
-        elif data == "admin_discount_start": text = "💸 *Rabatt-Manager: Typ wählen*\n\nWelche Art von Rabatt möchtest du vergeben?"; keyboard = [[InlineKeyboardButton("Euro (€) Rabatt", callback_data="admin_discount_set_type_euro"), InlineKeyboardButton("Prozent (%) Rabatt", callback_data="admin_discount_set_type_percent")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data in ["admin_discount_set_type_euro", "admin_discount_set_type_percent"]:
-            context.user_data['rabatt_in_progress'] = True; context.user_data['rabatt_data'] = {"packages": {}}; context.user_data['rabatt_type'] = "euro" if data.endswith("euro") else "percent"
-            text = "💸 *Rabatt-Manager: Zielgruppe*\n\nAn wen soll der Rabatt gesendet werden?"; keyboard = [[InlineKeyboardButton("Alle Nutzer", callback_data="admin_discount_target_all")], [InlineKeyboardButton("Bestimmter Nutzer", callback_data="admin_discount_target_specific")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data == "admin_discount_target_all": context.user_data['rabatt_target_type'] = 'all'; await prompt_for_discount_value(update, context)
-        elif data == "admin_discount_target_specific": context.user_data['rabatt_target_type'] = 'specific'; context.user_data['awaiting_user_id_for_discount'] = True; text = "Bitte sende mir jetzt die numerische ID des Nutzers, der den Rabatt erhalten soll."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data.startswith("admin_discount_select_package:"):
-            package_key = data.split(":")[1]; context.user_data['rabatt_data']["packages"][package_key] = context.user_data.get('rabatt_value'); await show_discount_package_menu(update, context)
-        elif data == "admin_discount_percent_apply_all": await apply_all_packages_and_finalize(update, context)
-        elif data == "admin_discount_finalize": await finalize_discount_action(update, context)
-        elif data == "admin_user_manage": await show_user_management_menu(update, context)
-        elif data in ["admin_user_ban_start", "admin_user_unban_start"]:
-            action = "sperren" if data == "admin_user_ban_start" else "entsperren"; context.user_data[f'awaiting_user_id_for_{action}'] = True; text = f"Bitte sende mir die numerische Nutzer-ID des Nutzers, den du *{action}* möchtest."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_user_manage")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        elif data == "admin_manage_discounts": await show_manage_discounts_menu(update, context)
-        elif data == "admin_delete_all_discounts_confirm": text = "⚠️ *Bist du sicher?*\n\nDiese Aktion löscht *alle* aktiven, vom Admin vergebenen Rabatte für *alle* Nutzer unwiderruflich."; keyboard = [[InlineKeyboardButton("✅ Ja, alle Rabatte löschen", callback_data="admin_delete_all_discounts_execute")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_manage_discounts")]]; await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data == "admin_delete_all_discounts_execute": await execute_delete_all_discounts(update, context)
-        elif data == "admin_delete_user_discount_start": context.user_data['awaiting_user_id_for_discount_deletion'] = True; text = "👤 *Rabatt für Nutzer löschen*\n\nBitte sende mir die numerische ID des Nutzers, dessen Rabatte du löschen möchtest."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_manage_discounts")]]; await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data.startswith("admin_delete_user_discount_execute:"): user_id_to_clear = data.split(":")[1]; await execute_delete_user_discount(update, context, user_id_to_clear)
-        elif data == "admin_preview_limit_start": context.user_data['awaiting_user_id_for_preview_limit'] = True; text = "🖼️ *Vorschau-Limit anpassen*\n\nBitte sende die ID des Nutzers, dessen Vorschau-Limit du anpassen möchtest."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_user_manage")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        elif data.startswith("admin_preview_reset:"): user_id_to_manage = data.split(":")[1]; await execute_manage_preview_limit(update, context, user_id_to_manage, 'reset')
-        elif data.startswith("admin_preview_increase:"): user_id_to_manage = data.split(":")[1]; await execute_manage_preview_limit(update, context, user_id_to_manage, 'increase')
-        return
+# --- Callback-Router ---
+def choice(*values):
+    """Argument converter that only accepts the given strings."""
+    def convert(value: str) -> str:
+        if value not in values: raise ValueError(f"{value!r} nicht in {values}")
+        return value
+    convert.__name__ = "|".join(values); return convert
 
-    elif data == "referral_menu":
-        stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {})
-        referral_count = len(user_data.get("referrals", [])); successful_referrals = user_data.get("successful_referrals", 0)
-        bot_username = (await context.bot.get_me()).username; ref_link = f"https://t.me/{bot_username}?start=ref_{user.id}"
-        text = ("🤝 *Freunde einladen & Belohnung erhalten*\n\n" "Teile deinen persönlichen Link mit Freunden. Wenn sich ein neuer Nutzer über deinen Link anmeldet *und einen Kauf tätigt*, erhältst du eine Belohnung!\n\n" f"🔗 *Dein persönlicher Link:*\n`{ref_link}`\n\n" "💡 *So funktioniert's:*\n" f"Dein Link hat das Format `https://t.me/VIPANNA2008BOT?start=ref_{user.id}`. Jeder, der darauf klickt und den Bot startet, wird dir zugeordnet.\n\n" "📈 *Dein Status:*\n" f"   - Geworbene Freunde: *{referral_count}*\n" f"   - Erfolgreiche Käufe: *{successful_referrals}*")
-        keyboard = [[InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', disable_web_page_preview=True); return
-        
-    if data == "download_vouchers_pdf":
-        await query.answer("PDF wird erstellt..."); vouchers = load_vouchers(); pdf = FPDF(); pdf.add_page(); pdf.set_font("Arial", size=16); pdf.cell(0, 10, "Gutschein Report", ln=True, align='C'); pdf.ln(10); pdf.set_font("Arial", 'B', size=14); pdf.cell(0, 10, "Amazon Gutscheine", ln=True); pdf.set_font("Arial", size=12)
-        if vouchers.get("amazon", []):
-            for code in vouchers["amazon"]: pdf.cell(0, 8, f"- {code.encode('latin-1', 'ignore').decode('latin-1')}", ln=True)
-        else: pdf.cell(0, 8, "Keine vorhanden.", ln=True)
-        pdf.ln(5); pdf.set_font("Arial", 'B', size=14); pdf.cell(0, 10, "Paysafe Gutscheine", ln=True); pdf.set_font("Arial", size=12)
-        if vouchers.get("paysafe", []):
-            for code in vouchers["paysafe"]: pdf.cell(0, 8, f"- {code.encode('latin-1', 'ignore').decode('latin-1')}", ln=True)
-        else: pdf.cell(0, 8, "Keine vorhanden.", ln=True)
-        pdf_buffer = BytesIO(pdf.output(dest='S').encode('latin-1')); pdf_buffer.seek(0); today_str = datetime.now().strftime("%Y-%m-%d"); await context.bot.send_document(chat_id=chat_id, document=pdf_buffer, filename=f"Gutschein-Report_{today_str}.pdf", caption="Hier ist dein aktueller Gutschein-Report."); return
-
-    if data in ["show_preview_options", "show_price_options"]:
-        action = "preview" if "preview" in data else "prices"; text = "Für wen interessierst du dich?"; keyboard = [[InlineKeyboardButton("Kleine Schwester", callback_data=f"select_schwester:ks:{action}"), InlineKeyboardButton("Große Schwester", callback_data=f"select_schwester:gs:{action}")], [InlineKeyboardButton("« Zurück", callback_data="main_menu")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("select_schwester:"):
-        await cleanup_previous_messages(chat_id, context)
-        try: await query.message.delete()
-        except error.TelegramError: pass
-        _, schwester_code, action = data.split(":"); stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {}); preview_clicks = user_data.get("preview_clicks", 0); viewed_sisters = user_data.get("viewed_sisters", [])
-        if action == "preview" and preview_clicks >= 25 and schwester_code in viewed_sisters:
-            await query.answer("Du hast dein Vorschau-Limit von 25 Klicks bereits erreicht.", show_alert=True)
-            msg = await context.bot.send_message(chat_id, "Du hast dein Vorschau-Limit von 25 Klicks bereits erreicht.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]])); context.user_data["messages_to_delete"] = [msg.message_id]; return
-        if schwester_code not in viewed_sisters:
-            viewed_sisters.append(schwester_code); user_data["viewed_sisters"] = viewed_sisters; stats["users"][str(user.id)] = user_data; save_stats(stats)
-        await track_event(f"{action}_{schwester_code}", context, user.id); await send_or_update_admin_log(context, user, event_text=f"Schaut sich {action} von {schwester_code.upper()} an")
-        if action == "preview": await send_preview_message(update, context, schwester_code)
-        elif action == "prices":
-            image_paths = get_media_files(schwester_code, "preis"); image_paths.sort()
-            if not image_paths: await context.bot.send_message(chat_id=chat_id, text="Ups! Ich konnte gerade keine passenden Inhalte finden...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="main_menu")]])); return
-            random_image_path = random.choice(image_paths)
-            with open(random_image_path, 'rb') as photo_file: photo_message = await context.bot.send_photo(chat_id=chat_id, photo=photo_file, protect_content=True)
-            caption = "Wähle dein gewünschtes Paket:"
-            keyboard_buttons = [
-                [InlineKeyboardButton(get_package_button_text("bilder", 10, user.id), callback_data="select_package:bilder:10"), InlineKeyboardButton(get_package_button_text("videos", 10, user.id), callback_data="select_package:videos:10")],
-                [InlineKeyboardButton(get_package_button_text("bilder", 25, user.id), callback_data="select_package:bilder:25"), InlineKeyboardButton(get_package_button_text("videos", 25, user.id), callback_data="select_package:videos:25")],
-                [InlineKeyboardButton(get_package_button_text("bilder", 35, user.id), callback_data="select_package:bilder:35"), InlineKeyboardButton(get_package_button_text("videos", 35, user.id), callback_data="select_package:videos:35")],
-                [InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]]
-            text_message = await context.bot.send_message(chat_id=chat_id, text=caption, reply_markup=InlineKeyboardMarkup(keyboard_buttons))
-            context.user_data["messages_to_delete"] = [photo_message.message_id, text_message.message_id]
-
-    elif data.startswith("next_preview:"):
-        stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {}); preview_clicks = user_data.get("preview_clicks", 0)
-        if preview_clicks >= 25:
-            await query.answer("Vorschau-Limit erreicht!", show_alert=True); await cleanup_previous_messages(chat_id, context); _, schwester_code = data.split(":")
-            limit_text = "Du hast dein Vorschau-Limit von 25 Klicks erreicht. Sieh dir jetzt die Preise an, um mehr zu sehen!"
-            limit_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(f"🛍️ Preise für {schwester_code.upper()} ansehen", callback_data=f"select_schwester:{schwester_code}:prices")], [InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]])
-            msg = await context.bot.send_message(chat_id, text=limit_text, reply_markup=limit_keyboard); context.user_data["messages_to_delete"] = [msg.message_id]; return
-        user_data["preview_clicks"] = preview_clicks + 1; stats["users"][str(user.id)] = user_data; save_stats(stats); await track_event("next_preview", context, user.id); _, schwester_code = data.split(":"); await send_or_update_admin_log(context, user, event_text=f"Nächstes Bild ({schwester_code.upper()})"); image_paths = get_media_files(schwester_code, "vorschau"); image_paths.sort(); index_key = f'preview_index_{schwester_code}'; current_index = context.user_data.get(index_key, 0); next_index = (current_index + 1) % len(image_paths) if image_paths else 0; context.user_data[index_key] = next_index;
-        if not image_paths: return
-        image_to_show_path = image_paths[next_index]; photo_message_id = context.user_data.get("messages_to_delete", [None])[0]
-        if photo_message_id:
-            try:
-                with open(image_to_show_path, 'rb') as photo_file: media = InputMediaPhoto(photo_file); await context.bot.edit_message_media(chat_id=chat_id, message_id=photo_message_id, media=media)
-            except error.TelegramError as e: logger.warning(f"Konnte Bild nicht bearbeiten, sende neu: {e}"); await send_preview_message(update, context, schwester_code)
+class CallbackRoute:
+    def __init__(self, name: str, handler, schema: tuple):
+        self.name = name; self.handler = handler; self.schema = schema
 
-    elif data.startswith("select_package:"):
-        await cleanup_previous_messages(chat_id, context);
-        try: await query.message.delete()
-        except error.TelegramError: pass
-        await track_event("package_selected", context, user.id); _, media_type, amount_str = data.split(":"); amount = int(amount_str); base_price = PRICES[media_type][amount];
-        stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {}); package_key = f"{media_type}_{amount}"
-        price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-        if price == -1: price = base_price
-        price_str = f"~{base_price}€~ *{price}€* (Rabatt)" if price != base_price else f"*{price}€*"
-        text = f"Du hast das Paket **{amount} {media_type.capitalize()}** für {price_str} ausgewählt.\n\nWie möchtest du bezahlen?"; keyboard = [[InlineKeyboardButton(" PayPal", callback_data=f"pay_paypal:{media_type}:{amount}")], [InlineKeyboardButton(" Gutschein", callback_data=f"pay_voucher:{media_type}:{amount}")], [InlineKeyboardButton("🪙 Krypto", callback_data=f"pay_crypto:{media_type}:{amount}")], [InlineKeyboardButton("« Zurück zu den Preisen", callback_data="show_price_options")]]; msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'); context.user_data["messages_to_delete"] = [msg.message_id]
-
-    elif data.startswith(("pay_paypal:", "pay_voucher:", "pay_crypto:", "show_wallet:", "voucher_provider:")):
-        parts = data.split(":"); media_type = parts[1]; amount_str = parts[2]; amount = int(amount_str); base_price = PRICES[media_type][amount]
-        stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {}); package_key = f"{media_type}_{amount}"
-        price = get_discounted_price(base_price, user_data.get("discounts"), package_key)
-        if price == -1: price = base_price
-        async def update_payment_log(payment_method: str, price_val: int):
-            stats_log = load_stats(); user_data_log = stats_log.get("users", {}).get(str(user.id))
-            if user_data_log:
-                payment_info = f"{payment_method}: {price_val}€"
-                if payment_info not in user_data_log.get("payments_initiated", []):
-                    user_data_log.setdefault("payments_initiated", []).append(payment_info); save_stats(stats_log)
-            await send_or_update_admin_log(context, user, event_text=f"Bezahlmethode '{payment_method}' für {price_val}€ gewählt")
-        if data.startswith("pay_paypal:"):
-            await track_event("payment_paypal", context, user.id); await update_payment_log("PayPal", price); paypal_link = f"https://paypal.me/{PAYPAL_USER}/{price}"; text = (f"Super! Klicke auf den Link, um die Zahlung für **{amount} {media_type.capitalize()}** in Höhe von **{price}€** abzuschließen.\n\nGib als Verwendungszweck bitte deinen Telegram-Namen an.\n\n➡️ [Hier sicher bezahlen]({paypal_link})"); keyboard = [[InlineKeyboardButton("« Zurück zur Bezahlwahl", callback_data=f"select_package:{media_type}:{amount}")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', disable_web_page_preview=True)
-        elif data.startswith("pay_voucher:"):
-            await track_event("payment_voucher", context, user.id); await update_payment_log("Gutschein", price); text = "Welchen Gutschein möchtest du einlösen?"; keyboard = [[InlineKeyboardButton("Amazon", callback_data=f"voucher_provider:amazon:{media_type}:{amount}"), InlineKeyboardButton("Paysafe", callback_data=f"voucher_provider:paysafe:{media_type}:{amount}")], [InlineKeyboardButton("« Zurück zur Bezahlwahl", callback_data=f"select_package:{media_type}:{amount}")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data.startswith("pay_crypto:"):
-            await track_event("payment_crypto", context, user.id); await update_payment_log("Krypto", price); text = "Bitte wähle die gewünschte Kryptowährung:"; keyboard = [[InlineKeyboardButton("Bitcoin (BTC)", callback_data=f"show_wallet:btc:{media_type}:{amount}"), InlineKeyboardButton("Ethereum (ETH)", callback_data=f"show_wallet:eth:{media_type}:{amount}")], [InlineKeyboardButton("« Zurück zur Bezahlwahl", callback_data=f"select_package:{media_type}:{amount}")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data.startswith("show_wallet:"):
-            _, crypto_type, _, _ = parts; wallet_address = BTC_WALLET if crypto_type == "btc" else ETH_WALLET; crypto_name = "Bitcoin (BTC)" if crypto_type == "btc" else "Ethereum (ETH)"; text = (f"Zahlung mit **{crypto_name}** für **{price}€**.\n\nBitte sende den Betrag an die folgende Adresse und bestätige es hier, sobald du fertig bist:\n\n`{wallet_address}`"); keyboard = [[InlineKeyboardButton("« Zurück zur Krypto-Wahl", callback_data=f"pay_crypto:{media_type}:{amount}")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        elif data.startswith("voucher_provider:"):
-            _, provider, _, _ = parts; context.user_data["awaiting_voucher"] = provider; text = f"Bitte sende mir jetzt deinen {provider.capitalize()}-Gutschein-Code als einzelne Nachricht."; keyboard = [[InlineKeyboardButton("Abbrechen", callback_data=f"pay_voucher:{media_type}:{amount_str}")]]; await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    def parse(self, raw: str) -> tuple:
+        """Converts the ':'-separated arguments after the route name; raises ValueError if they do not fit the schema."""
+        parts = raw.split(":") if raw else []
+        if len(parts) != len(self.schema): raise ValueError(f"{self.name} erwartet {len(self.schema)} Argumente, bekam {len(parts)}")
+        return tuple(convert(part) for convert, part in zip(self.schema, parts))
+
+class CallbackRouter:
+    """Dispatches callback_data by dict lookup instead of a startswith chain. A route is a name plus an argument schema:
+    without arguments the callback_data must equal the name, with arguments it is `name:arg1:arg2` and every argument is
+    converted by its schema entry (int, str, choice(...)). Middleware wraps the handler once at registration; the
+    default middleware (timing, answering the query, ban check) runs for every route."""
+    def __init__(self, default_middleware: tuple = ()):
+        self.default_middleware = default_middleware; self.exact = {}; self.prefixed = {}
+
+    def route(self, name: str, *schema, middleware: tuple = ()):
+        def register(handler):
+            table = self.prefixed if schema else self.exact
+            if name in table: raise ValueError(f"Callback-Route {name} doppelt registriert")
+            wrapped = handler
+            for layer in reversed((*self.default_middleware, *middleware)): wrapped = layer(wrapped, name)
+            table[name] = CallbackRoute(name, wrapped, schema); return handler
+        return register
+
+    def resolve(self, data: str):
+        """(route, args) for callback_data, or (None, ()) if no route matches or the arguments are invalid."""
+        route = self.exact.get(data)
+        if route is not None: return route, ()
+        name, _, raw = data.partition(":"); route = self.prefixed.get(name)
+        if route is None: return None, ()
+        try: return route, route.parse(raw)
+        except ValueError as e: logger.warning(f"Ungültige callback_data {data!r}: {e}"); return None, ()
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        route, args = self.resolve(update.callback_query.data or "")
+        if route is None: metrics.inc("bot_callback_unmatched_total"); await update.callback_query.answer(); return
+        await route.handler(update, context, *args)
+
+def answer_query(handler, name: str):
+    """Acknowledges the button press before the route runs, so the client stops its loading spinner."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        await update.callback_query.answer(); return await handler(update, context, *args)
+    return wrapper
+
+def reject_banned(handler, name: str):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        if is_user_banned(update.effective_user.id): await update.callback_query.answer("Du bist von der Nutzung dieses Bots ausgeschlossen.", show_alert=True); return
+        return await handler(update, context, *args)
+    return wrapper
+
+def require_admin(handler, name: str):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        if str(update.effective_user.id) != ADMIN_USER_ID: await update.callback_query.answer("⛔️ Keine Berechtigung.", show_alert=True); return
+        return await handler(update, context, *args)
+    return wrapper
+
+def clear_admin_input(handler, name: str):
+    """Leaving a multi-step admin flow through the menu drops its half-entered state (discount draft, awaited IDs)."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        for key in list(context.user_data.keys()):
+            if key.startswith(('rabatt_', 'awaiting_')): del context.user_data[key]
+        return await handler(update, context, *args)
+    return wrapper
+
+ADMIN = (require_admin, clear_admin_input)  # admin menu screens
+ADMIN_FLOW = (require_admin,)  # steps inside a discount / deletion / preview-limit flow keep their state
+callback_router = CallbackRouter(default_middleware=(timed_handler, answer_query, reject_banned))
+MEDIA_TYPE = choice(*PRICES)
+handle_callback_query = callback_router.dispatch
+
+@callback_router.route("main_menu")
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE): await start(update, context)
+
+@callback_router.route("admin_main_menu", middleware=ADMIN)
+async def route_admin_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE): await show_admin_menu(update, context)
+
+@callback_router.route("admin_show_vouchers", middleware=ADMIN)
+async def route_vouchers_panel(update: Update, context: ContextTypes.DEFAULT_TYPE): await show_vouchers_panel(update, context)
+
+@callback_router.route("admin_show_vouchers", int, middleware=ADMIN)
+async def route_vouchers_page(update: Update, context: ContextTypes.DEFAULT_TYPE, before: int): await show_vouchers_panel(update, context, before=before)
+
+@callback_router.route("admin_stats_users", middleware=ADMIN)
+async def show_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = load_stats(); user_count = len(stats.get("users", {})); text = f"📊 *Nutzer-Statistiken*\n\nGesamtzahl der Nutzer: *{user_count}*"; keyboard = [[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+def format_funnel(sources: list, window: timedelta, now: float) -> str:
+    lines = []
+    for label, count, conversion in event_history.funnel(sources, window, now): lines.append(f"- {label}: *{count}*" + (f" ({conversion:.0%})" if conversion is not None else ""))
+    return "\n".join(lines)
+
+@callback_router.route("admin_stats_clicks", middleware=ADMIN)
+async def show_click_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = load_stats(); events = stats.get("events", {}); sources = analytics_sources(stats); now = time.time(); text = "🖱️ *Klick-Statistiken*\n\n"
+    if not events: text += "Noch keine Klicks erfasst."
+    else:
+        for title, window in (("letzte 24h", timedelta(hours=24)), ("letzte 7 Tage", timedelta(days=7))): text += f"📈 *Funnel {title}*\n{format_funnel(sources, window, now)}\n\n"
+        sisters = sorted(event[len("preview_"):] for event in event_history.events(sources) if event.startswith("preview_"))
+        if sisters:
+            text += "👀 *Vorschau → Preise (7 Tage)*\n"
+            for code in sisters:
+                previews = event_history.count(sources, f"preview_{code}", timedelta(days=7), now); prices = event_history.count(sources, f"prices_{code}", timedelta(days=7), now)
+                text += f"- {code.upper()}: {previews} → {prices}" + (f" ({prices / previews:.0%})" if previews else "") + "\n"
+            text += "\n"
+        text += "*Gesamt*\n"
+        for event, count in sorted(events.items()): text += f"- `{event}`: *{count}* Klicks\n"
+    snapshots = stats.get("stats_snapshots") or []
+    if snapshots: text += f"\n_Letzter Reset: {datetime.fromisoformat(snapshots[-1]['reset_at']).strftime('%d.%m.%Y %H:%M')} ({len(snapshots)} Snapshots gespeichert)_"
+    keyboard = [[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+@callback_router.route("admin_reset_stats", middleware=ADMIN)
+async def confirm_reset_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = "⚠️ *Bist du sicher?*\n\nNutzer und Klick-Zähler werden auf Null zurückgesetzt. Der bisherige Klick-Verlauf wird als Snapshot aufbewahrt."; keyboard = [[InlineKeyboardButton("✅ Ja, zurücksetzen", callback_data="admin_reset_stats_confirm")], [InlineKeyboardButton("❌ Nein, abbrechen", callback_data="admin_main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+@callback_router.route("admin_reset_stats_confirm", middleware=ADMIN)
+async def reset_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = load_stats(); snapshot_and_reset_stats(stats); save_stats(stats); price_service.invalidate_all(); await update_pinned_summary(context); await update.callback_query.edit_message_text("✅ Alle Statistiken wurden zurückgesetzt.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]))
+
+@callback_router.route("admin_discount_start", middleware=ADMIN_FLOW)
+async def choose_discount_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = "💸 *Rabatt-Manager: Typ wählen*\n\nWelche Art von Rabatt möchtest du vergeben?"; keyboard = [[InlineKeyboardButton("Euro (€) Rabatt", callback_data="admin_discount_set_type_euro"), InlineKeyboardButton("Prozent (%) Rabatt", callback_data="admin_discount_set_type_percent")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("admin_discount_set_type_euro", middleware=ADMIN_FLOW)
+@callback_router.route("admin_discount_set_type_percent", middleware=ADMIN_FLOW)
+async def choose_discount_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['rabatt_in_progress'] = True; context.user_data['rabatt_data'] = {"packages": {}}; context.user_data['rabatt_type'] = "euro" if update.callback_query.data.endswith("euro") else "percent"
+    text = "💸 *Rabatt-Manager: Zielgruppe*\n\nAn wen soll der Rabatt gesendet werden?"; keyboard = [[InlineKeyboardButton("Alle Nutzer", callback_data="admin_discount_target_all")], [InlineKeyboardButton("Bestimmter Nutzer", callback_data="admin_discount_target_specific")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("admin_discount_target_all", middleware=ADMIN_FLOW)
+async def target_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE): context.user_data['rabatt_target_type'] = 'all'; await prompt_for_discount_value(update, context)
+
+@callback_router.route("admin_discount_target_specific", middleware=ADMIN_FLOW)
+async def target_specific_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['rabatt_target_type'] = 'specific'; context.user_data['awaiting_user_id_for_discount'] = True; text = "Bitte sende mir jetzt die numerische ID des Nutzers, der den Rabatt erhalten soll."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("admin_discount_select_package", str, middleware=ADMIN_FLOW)
+async def select_discount_package(update: Update, context: ContextTypes.DEFAULT_TYPE, package_key: str):
+    context.user_data['rabatt_data']["packages"][package_key] = context.user_data.get('rabatt_value'); await show_discount_package_menu(update, context)
+
+@callback_router.route("admin_discount_percent_apply_all", middleware=ADMIN_FLOW)
+async def route_apply_all_packages(update: Update, context: ContextTypes.DEFAULT_TYPE): await apply_all_packages_and_finalize(update, context)
+
+@callback_router.route("admin_discount_finalize", middleware=ADMIN_FLOW)
+async def route_finalize_discount(update: Update, context: ContextTypes.DEFAULT_TYPE): await finalize_discount_action(update, context)
+
+@callback_router.route("admin_user_manage", middleware=ADMIN)
+async def route_user_management(update: Update, context: ContextTypes.DEFAULT_TYPE): await show_user_management_menu(update, context)
+
+@callback_router.route("admin_user_ban_start", middleware=ADMIN)
+@callback_router.route("admin_user_unban_start", middleware=ADMIN)
+async def ask_user_to_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = "sperren" if update.callback_query.data == "admin_user_ban_start" else "entsperren"; context.user_data[f'awaiting_user_id_for_{action}'] = True; text = f"Bitte sende mir die numerische Nutzer-ID des Nutzers, den du *{action}* möchtest."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_user_manage")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+@callback_router.route("admin_manage_discounts", middleware=ADMIN)
+async def route_manage_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE): await show_manage_discounts_menu(update, context)
+
+@callback_router.route("admin_delete_all_discounts_confirm", middleware=ADMIN_FLOW)
+async def confirm_delete_all_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = "⚠️ *Bist du sicher?*\n\nDiese Aktion löscht *alle* aktiven, vom Admin vergebenen Rabatte für *alle* Nutzer unwiderruflich."; keyboard = [[InlineKeyboardButton("✅ Ja, alle Rabatte löschen", callback_data="admin_delete_all_discounts_execute")], [InlineKeyboardButton("❌ Abbrechen", callback_data="admin_manage_discounts")]]; await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("admin_delete_all_discounts_execute", middleware=ADMIN_FLOW)
+async def route_delete_all_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE): await execute_delete_all_discounts(update, context)
+
+@callback_router.route("admin_delete_user_discount_start", middleware=ADMIN_FLOW)
+async def ask_user_discount_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['awaiting_user_id_for_discount_deletion'] = True; text = "👤 *Rabatt für Nutzer löschen*\n\nBitte sende mir die numerische ID des Nutzers, dessen Rabatte du löschen möchtest."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_manage_discounts")]]; await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("admin_delete_user_discount_execute", str, middleware=ADMIN_FLOW)
+async def route_delete_user_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_to_clear: str): await execute_delete_user_discount(update, context, user_id_to_clear)
+
+@callback_router.route("admin_preview_limit_start", middleware=ADMIN_FLOW)
+async def ask_preview_limit_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data['awaiting_user_id_for_preview_limit'] = True; text = "🖼️ *Vorschau-Limit anpassen*\n\nBitte sende die ID des Nutzers, dessen Vorschau-Limit du anpassen möchtest."; keyboard = [[InlineKeyboardButton("❌ Abbrechen", callback_data="admin_user_manage")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+@callback_router.route("admin_preview_reset", str, middleware=ADMIN_FLOW)
+async def route_preview_reset(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str): await execute_manage_preview_limit(update, context, user_id, 'reset')
+
+@callback_router.route("admin_preview_increase", str, middleware=ADMIN_FLOW)
+async def route_preview_increase(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str): await execute_manage_preview_limit(update, context, user_id, 'increase')
+
+@callback_router.route("download_vouchers_pdf", middleware=ADMIN_FLOW)
+@callback_router.route("download_vouchers_csv", middleware=ADMIN_FLOW)
+async def download_voucher_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; chat_id = update.effective_chat.id
+    fmt = query.data.rsplit("_", 1)[1]; await query.answer(f"{fmt.upper()} wird erstellt...")
+    try: await voucher_reports.send(context.bot, chat_id, fmt)
+    except Exception as e: logger.error(f"Gutschein-Report ({fmt}) fehlgeschlagen: {e}"); await context.bot.send_message(chat_id=chat_id, text="❌ Der Gutschein-Report konnte nicht erstellt werden.")
+
+@callback_router.route("referral_menu")
+async def show_referral_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user; stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {})
+    referral_count = len(user_data.get("referrals", [])); successful_referrals = user_data.get("successful_referrals", 0)
+    bot_username = (await context.bot.get_me()).username; ref_link = f"https://t.me/{bot_username}?start=ref_{user.id}"
+    text = ("🤝 *Freunde einladen & Belohnung erhalten*\n\n" "Teile deinen persönlichen Link mit Freunden. Wenn sich ein neuer Nutzer über deinen Link anmeldet *und einen Kauf tätigt*, erhältst du eine Belohnung!\n\n" f"🔗 *Dein persönlicher Link:*\n`{ref_link}`\n\n" "💡 *So funktioniert's:*\n" f"Dein Link hat das Format `https://t.me/VIPANNA2008BOT?start=ref_{user.id}`. Jeder, der darauf klickt und den Bot startet, wird dir zugeordnet.\n\n" "📈 *Dein Status:*\n" f"   - Geworbene Freunde: *{referral_count}*\n" f"   - Erfolgreiche Käufe: *{successful_referrals}*")
+    keyboard = [[InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', disable_web_page_preview=True)
+
+@callback_router.route("show_preview_options")
+@callback_router.route("show_price_options")
+async def choose_schwester(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = "preview" if "preview" in update.callback_query.data else "prices"; text = "Für wen interessierst du dich?"; keyboard = [[InlineKeyboardButton("Kleine Schwester", callback_data=f"select_schwester:ks:{action}"), InlineKeyboardButton("Große Schwester", callback_data=f"select_schwester:gs:{action}")], [InlineKeyboardButton("« Zurück", callback_data="main_menu")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("select_schwester", str, choice("preview", "prices"))
+async def select_schwester(update: Update, context: ContextTypes.DEFAULT_TYPE, schwester_code: str, action: str):
+    query = update.callback_query; stale_ids = take_messages_to_delete(context, query.message and query.message.message_id)
+    try: await show_schwester_screen(update, context, schwester_code, action)
+    finally: await cleanup_previous_messages(update.effective_chat.id, context, stale_ids)
+
+@callback_router.route("next_preview", str)
+async def next_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, schwester_code: str):
+    query = update.callback_query; chat_id = update.effective_chat.id; user = update.effective_user
+    stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {}); preview_clicks = user_data.get("preview_clicks", 0)
+    if preview_clicks >= 25:
+        await query.answer("Vorschau-Limit erreicht!", show_alert=True); stale_ids = take_messages_to_delete(context)
+        limit_text = "Du hast dein Vorschau-Limit von 25 Klicks erreicht. Sieh dir jetzt die Preise an, um mehr zu sehen!"
+        limit_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(f"🛍️ Preise für {schwester_code.upper()} ansehen", callback_data=f"select_schwester:{schwester_code}:prices")], [InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]])
+        msg = await context.bot.send_message(chat_id, text=limit_text, reply_markup=limit_keyboard); context.user_data["messages_to_delete"] = [msg.message_id]; await cleanup_previous_messages(chat_id, context, stale_ids); return
+    increment_user_counter(user.id, "preview_clicks"); await track_event("next_preview", context, user.id); await send_or_update_admin_log(context, user, event_text=f"Nächstes Bild ({schwester_code.upper()})"); image_paths = get_media_files(schwester_code, "vorschau"); index_key = f'preview_index_{schwester_code}'; current_index = context.user_data.get(index_key, 0); next_index = (current_index + 1) % len(image_paths) if image_paths else 0; context.user_data[index_key] = next_index;
+    if not image_paths: return
+    image_to_show_path = image_paths[next_index]; photo_message_id = context.user_data.get("messages_to_delete", [None])[0]
+    if photo_message_id:
+        try: await edit_media_photo(context, chat_id, photo_message_id, image_to_show_path); preview_prefetcher.schedule(context, image_paths, next_index)
+        except error.TelegramError as e: logger.warning(f"Konnte Bild nicht bearbeiten, sende neu: {e}"); await send_preview_message(update, context, schwester_code)
+
+@callback_router.route("select_package", MEDIA_TYPE, int)
+async def select_package(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str, amount: int):
+    query = update.callback_query; chat_id = update.effective_chat.id; user = update.effective_user
+    stale_ids = take_messages_to_delete(context, query.message and query.message.message_id)
+    await track_event("package_selected", context, user.id); base_price, price = get_user_price(user.id, media_type, amount)
+    price_str = f"~{base_price}€~ *{price}€* (Rabatt)" if price != base_price else f"*{price}€*"
+    text = f"Du hast das Paket **{amount} {media_type.capitalize()}** für {price_str} ausgewählt.\n\nWie möchtest du bezahlen?"; keyboard = [[InlineKeyboardButton(" PayPal", callback_data=f"pay_paypal:{media_type}:{amount}")], [InlineKeyboardButton(" Gutschein", callback_data=f"pay_voucher:{media_type}:{amount}")], [InlineKeyboardButton("🪙 Krypto", callback_data=f"pay_crypto:{media_type}:{amount}")], [InlineKeyboardButton("« Zurück zu den Preisen", callback_data="show_price_options")]]; msg = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'); context.user_data["messages_to_delete"] = [msg.message_id]
+    await cleanup_previous_messages(chat_id, context, stale_ids)
+
+async def log_payment_choice(context: ContextTypes.DEFAULT_TYPE, user, payment_method: str, price: int):
+    if str(user.id) in load_stats().get("users", {}): add_to_user_list(user.id, "payments_initiated", f"{payment_method}: {price}€", limit=PAYMENT_HISTORY)
+    await send_or_update_admin_log(context, user, event_text=f"Bezahlmethode '{payment_method}' für {price}€ gewählt")
+
+@callback_router.route("pay_paypal", MEDIA_TYPE, int)
+async def pay_paypal(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str, amount: int):
+    user = update.effective_user; _, price = get_user_price(user.id, media_type, amount)
+    await track_event("payment_paypal", context, user.id); await log_payment_choice(context, user, "PayPal", price); paypal_link = f"https://paypal.me/{PAYPAL_USER}/{price}"; text = (f"Super! Klicke auf den Link, um die Zahlung für **{amount} {media_type.capitalize()}** in Höhe von **{price}€** abzuschließen.\n\nGib als Verwendungszweck bitte deinen Telegram-Namen an.\n\n➡️ [Hier sicher bezahlen]({paypal_link})"); keyboard = [[InlineKeyboardButton("« Zurück zur Bezahlwahl", callback_data=f"select_package:{media_type}:{amount}")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', disable_web_page_preview=True)
+
+@callback_router.route("pay_voucher", MEDIA_TYPE, int)
+async def pay_voucher(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str, amount: int):
+    user = update.effective_user; _, price = get_user_price(user.id, media_type, amount)
+    await track_event("payment_voucher", context, user.id); await log_payment_choice(context, user, "Gutschein", price); text = "Welchen Gutschein möchtest du einlösen?"; keyboard = [[InlineKeyboardButton("Amazon", callback_data=f"voucher_provider:amazon:{media_type}:{amount}"), InlineKeyboardButton("Paysafe", callback_data=f"voucher_provider:paysafe:{media_type}:{amount}")], [InlineKeyboardButton("« Zurück zur Bezahlwahl", callback_data=f"select_package:{media_type}:{amount}")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("pay_crypto", MEDIA_TYPE, int)
+async def pay_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str, amount: int):
+    user = update.effective_user; _, price = get_user_price(user.id, media_type, amount)
+    await track_event("payment_crypto", context, user.id); await log_payment_choice(context, user, "Krypto", price); text = "Bitte wähle die gewünschte Kryptowährung:"; keyboard = [[InlineKeyboardButton("Bitcoin (BTC)", callback_data=f"show_wallet:btc:{media_type}:{amount}"), InlineKeyboardButton("Ethereum (ETH)", callback_data=f"show_wallet:eth:{media_type}:{amount}")], [InlineKeyboardButton("« Zurück zur Bezahlwahl", callback_data=f"select_package:{media_type}:{amount}")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback_router.route("show_wallet", choice("btc", "eth"), MEDIA_TYPE, int)
+async def show_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, crypto_type: str, media_type: str, amount: int):
+    _, price = get_user_price(update.effective_user.id, media_type, amount)
+    wallet_address = BTC_WALLET if crypto_type == "btc" else ETH_WALLET; crypto_name = "Bitcoin (BTC)" if crypto_type == "btc" else "Ethereum (ETH)"; text = (f"Zahlung mit **{crypto_name}** für **{price}€**.\n\nBitte sende den Betrag an die folgende Adresse und bestätige es hier, sobald du fertig bist:\n\n`{wallet_address}`"); keyboard = [[InlineKeyboardButton("« Zurück zur Krypto-Wahl", callback_data=f"pay_crypto:{media_type}:{amount}")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+@callback_router.route("voucher_provider", choice("amazon", "paysafe"), MEDIA_TYPE, int)
+async def ask_voucher_code(update: Update, context: ContextTypes.DEFAULT_TYPE, provider: str, media_type: str, amount: int):
+    context.user_data["awaiting_voucher"] = provider; text = f"Bitte sende mir jetzt deinen {provider.capitalize()}-Gutschein-Code als einzelne Nachricht."; keyboard = [[InlineKeyboardButton("Abbrechen", callback_data=f"pay_voucher:{media_type}:{amount}")]]; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def show_schwester_screen(update: Update, context: ContextTypes.DEFAULT_TYPE, schwester_code: str, action: str):
+    query = update.callback_query; chat_id = update.effective_chat.id; user = update.effective_user
+    stats = load_stats(); user_data = stats.get("users", {}).get(str(user.id), {}); preview_clicks = user_data.get("preview_clicks", 0); viewed_sisters = user_data.get("viewed_sisters", [])
+    if action == "preview" and preview_clicks >= 25 and schwester_code in viewed_sisters:
+        await query.answer("Du hast dein Vorschau-Limit von 25 Klicks bereits erreicht.", show_alert=True)
+        msg = await context.bot.send_message(chat_id, "Du hast dein Vorschau-Limit von 25 Klicks bereits erreicht.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück zum Hauptmenü", callback_data="main_menu")]])); context.user_data["messages_to_delete"] = [msg.message_id]; return
+    mark_sister_viewed(user.id, schwester_code)
+    await track_event(f"{action}_{schwester_code}", context, user.id); await send_or_update_admin_log(context, user, event_text=f"Schaut sich {action} von {schwester_code.upper()} an")
+    if action == "preview": await send_preview_message(update, context, schwester_code)
+    elif action == "prices":
+        image_paths = get_media_files(schwester_code, "preis")
+        if not image_paths: await context.bot.send_message(chat_id=chat_id, text="Ups! Ich konnte gerade keine passenden Inhalte finden...", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="main_menu")]])); return
+        random_image_path = random.choice(image_paths)
+        photo_message = await send_media_photo(context, chat_id, random_image_path, protect_content=True)
+        caption = "Wähle dein gewünschtes Paket:"
+        text_message = await context.bot.send_message(chat_id=chat_id, text=caption, reply_markup=price_service.entry(user.id)["keyboard"])
+        context.user_data["messages_to_delete"] = [photo_message.message_id, text_message.message_id]
 
 async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = "🔒 *Admin-Menü*\n\nWähle eine Option:"
@@ -445,10 +2444,19 @@ async def show_user_management_menu(update: Update, context: ContextTypes.DEFAUL
     keyboard = [[InlineKeyboardButton("🚫 Nutzer sperren", callback_data="admin_user_ban_start")], [InlineKeyboardButton("✅ Nutzer entsperren", callback_data="admin_user_unban_start")], [InlineKeyboardButton("🖼️ Vorschau-Limit anpassen", callback_data="admin_preview_limit_start")], [InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]]
     await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def show_vouchers_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    vouchers = load_vouchers(); amazon_codes = "\n".join([f"- `{code}`" for code in vouchers.get("amazon", [])]) or "Keine"; paysafe_codes = "\n".join([f"- `{code}`" for code in vouchers.get("paysafe", [])]) or "Keine"
-    text = (f"*Eingelöste Gutscheine*\n\n*Amazon:*\n{amazon_codes}\n\n*Paysafe:*\n{paysafe_codes}"); keyboard = [[InlineKeyboardButton("📄 Vouchers als PDF laden", callback_data="download_vouchers_pdf")], [InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]; reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+async def show_vouchers_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, before: int = None):
+    records, next_cursor = voucher_ledger.page(before, VOUCHER_PAGE_SIZE); total = len(voucher_ledger)
+    lines = []
+    for record in records:
+        submitted = datetime.fromtimestamp(record["ts"]).strftime("%d.%m.%Y %H:%M") if record.get("ts") else "unbekannt"; submitter = f"`{record['user_id']}`" if record.get("user_id") else "unbekannt"
+        lines.append(f"#{record['id'] + 1} {record['provider'].capitalize()} – `{record['code'].replace('`', '')}`\n    {submitter} · {submitted} · {record.get('status', 'offen')}")
+    shown = f"{records[-1]['id'] + 1}–{records[0]['id'] + 1} von {total}" if records else "0 von 0"
+    text = f"*Eingelöste Gutscheine* ({shown})\n\n" + ("\n".join(lines) or "Keine")
+    nav = []
+    if before is not None and before < total: nav.append(InlineKeyboardButton("« Neuere", callback_data=f"admin_show_vouchers:{min(total, before + VOUCHER_PAGE_SIZE)}"))
+    if next_cursor is not None: nav.append(InlineKeyboardButton("Ältere »", callback_data=f"admin_show_vouchers:{next_cursor}"))
+    keyboard = ([nav] if nav else []) + [[InlineKeyboardButton("📄 Vouchers als PDF laden", callback_data="download_vouchers_pdf"), InlineKeyboardButton("📊 Als CSV laden", callback_data="download_vouchers_csv")], [InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]
+    await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user; text_input = update.message.text
@@ -460,9 +2468,12 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         if context.user_data.get('awaiting_user_id_for_preview_limit'): await handle_admin_preview_limit_input(update, context); return
 
     if context.user_data.get("awaiting_voucher"):
-        provider = context.user_data.pop("awaiting_voucher"); code = text_input; vouchers = load_vouchers(); vouchers[provider].append(code); save_vouchers(vouchers)
+        provider = context.user_data["awaiting_voucher"]; code = text_input.strip()
+        if await voucher_ledger.add(provider, code, user_id=user.id, user_name=user.first_name) is None:
+            await update.message.reply_text("⚠️ Dieser Gutschein-Code wurde bereits eingereicht. Bitte sende einen anderen Code."); await send_or_update_admin_log(context, user, event_text=f"Doppelter Gutschein '{provider}' abgelehnt"); return
+        context.user_data.pop("awaiting_voucher", None)
         notification_text = (f"📬 *Neuer Gutschein erhalten!*\n\n*Anbieter:* {provider.capitalize()}\n*Code:* `{code}`\n*Von Nutzer:* {escape_markdown(user.first_name, version=2)} (`{user.id}`)")
-        await send_permanent_admin_notification(context, notification_text); await send_or_update_admin_log(context, user, event_text=f"Gutschein '{provider}' eingereicht")
+        await side_effects.submit(send_permanent_admin_notification, context, notification_text); await send_or_update_admin_log(context, user, event_text=f"Gutschein '{provider}' eingereicht")
         await process_referral_reward(user.id, context)
         await update.message.reply_text("Vielen Dank! Dein Gutschein wurde übermittelt und wird nun geprüft. Ich melde mich bei dir."); await asyncio.sleep(2); await start(update, context)
 
@@ -512,37 +2523,38 @@ async def apply_all_packages_and_finalize(update: Update, context: ContextTypes.
 async def finalize_discount_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query; rabatt_data = context.user_data.get('rabatt_data', {})
     if not rabatt_data.get("packages"): await query.answer("Es wurden keine Pakete ausgewählt.", show_alert=True); return
+    if active_broadcast: await query.answer("Es läuft bereits eine Rabatt-Aktion. Bitte warte, bis sie abgeschlossen ist.", show_alert=True); return
     stats = load_stats(); target_ids = []
     target_type = context.user_data.get('rabatt_target_type')
-    if target_type == 'all': target_ids = list(stats["users"].keys())
+    if target_type == 'all': target_ids = None  # all users that are neither blocked nor banned, set in one statement below
     elif target_type == 'specific':
         target_id = context.user_data.get('rabatt_target_id')
         if target_id: target_ids.append(target_id)
-    if not target_ids: await query.edit_message_text("Fehler: Kein Ziel für den Rabatt gefunden.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]])); return
+    if target_ids == [] or (target_ids is None and not len(stats["users"])): await query.edit_message_text("Fehler: Kein Ziel für den Rabatt gefunden.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_main_menu")]])); return
     
     discount_type = context.user_data.get('rabatt_type')
     final_discount_obj = {"type": f"{discount_type}_packages", "packages": rabatt_data["packages"]}
     
-    success_count = 0; fail_count = 0
-    discount_notification_text = ("🎁 DEIN PERSÖNLICHES ANGEBOT! 🎁\n\n" "Wir haben dir gerade einen exklusiven Rabatt auf ausgewählte Pakete gutgeschrieben!\n\n" "Klicke hier, um deine neuen, reduzierten Preise zu sehen und direkt zuzuschlagen:")
-    discount_notification_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("💸 Zu meinen exklusiven Preisen 💸", callback_data="show_price_options")]])
-    for user_id in target_ids:
-        if user_id in stats["users"] and not stats["users"][user_id].get("banned", False):
-            stats["users"][user_id]["discounts"] = final_discount_obj
-            try: await context.bot.send_message(chat_id=user_id, text=discount_notification_text, reply_markup=discount_notification_keyboard); success_count += 1
-            except (error.Forbidden, error.BadRequest): fail_count += 1
-    save_stats(stats); await save_discounts_to_telegram(context)
+    if target_ids is None: recipients = stats_store.grant_discount_to_all(final_discount_obj); price_service.invalidate_all()
+    else:
+        recipients = []
+        for user_id in target_ids:
+            if user_id in stats["users"] and not stats["users"][user_id].get("banned", False):
+                set_user_discount(stats, user_id, final_discount_obj); recipients.append(user_id)
+    save_stats(stats); request_discount_backup()
     for key in list(context.user_data.keys()):
         if key.startswith('rabatt_'): del context.user_data[key]
-    final_text = f"✅ Rabatt-Aktion abgeschlossen!\n\n- Erfolgreich gesendet an: *{success_count} Nutzer*\n- Fehlgeschlagen/Blockiert: *{fail_count} Nutzer*"
-    await query.edit_message_text(final_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück zum Admin-Menü", callback_data="admin_main_menu")]]), parse_mode='Markdown')
+    discount_notification_text = ("🎁 DEIN PERSÖNLICHES ANGEBOT! 🎁\n\n" "Wir haben dir gerade einen exklusiven Rabatt auf ausgewählte Pakete gutgeschrieben!\n\n" "Klicke hier, um deine neuen, reduzierten Preise zu sehen und direkt zuzuschlagen:")
+    discount_notification_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("💸 Zu meinen exklusiven Preisen 💸", callback_data="show_price_options")]])
+    await query.edit_message_text(f"📢 *Rabatt-Aktion gestartet...*\n\nDer Rabatt wurde {len(recipients)} Nutzern gutgeschrieben, die Benachrichtigungen werden jetzt im Hintergrund versendet.", parse_mode='Markdown')
+    start_broadcast(context.application, Broadcast.create(context.application, recipients, discount_notification_text, discount_notification_keyboard, query.message.chat_id, query.message.message_id))
 
 async def handle_admin_user_management_input(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
     user_id_to_manage = update.message.text; context.user_data[f'awaiting_user_id_for_{action}'] = False
     if not user_id_to_manage.isdigit(): await update.message.reply_text("⚠️ Ungültige ID. Bitte gib eine numerische Nutzer-ID ein."); return
     stats = load_stats()
     if user_id_to_manage not in stats["users"]: await update.message.reply_text(f"⚠️ Nutzer mit der ID `{user_id_to_manage}` nicht gefunden."); return
-    stats["users"][user_id_to_manage]["banned"] = True if action == "sperren" else False; save_stats(stats)
+    set_user_field(user_id_to_manage, "banned", action == "sperren")
     verb = "gesperrt" if action == "sperren" else "entsperrt"; await update.message.reply_text(f"✅ Nutzer `{user_id_to_manage}` wurde erfolgreich *{verb}*."); await show_admin_menu(update, context)
 
 async def show_manage_discounts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -551,11 +2563,7 @@ async def show_manage_discounts_menu(update: Update, context: ContextTypes.DEFAU
     await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def execute_delete_all_discounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    stats = load_stats(); cleared_count = 0
-    for user_id in stats["users"]:
-        if "discounts" in stats["users"][user_id]:
-            del stats["users"][user_id]["discounts"]; cleared_count += 1
-    save_stats(stats); await save_discounts_to_telegram(context) # Sync
+    cleared_count = len(stats_store.clear_all_discounts()); price_service.invalidate_all(); save_stats(load_stats()); request_discount_backup()
     text = f"✅ Erfolgreich!\n\nAlle Rabatte von *{cleared_count}* Nutzern wurden entfernt."; await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_manage_discounts")]]))
 
 async def handle_admin_delete_user_discount_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -569,7 +2577,7 @@ async def handle_admin_delete_user_discount_input(update: Update, context: Conte
 async def execute_delete_user_discount(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_to_clear: str):
     stats = load_stats()
     if user_id_to_clear in stats["users"] and "discounts" in stats["users"][user_id_to_clear]:
-        del stats["users"][user_id_to_clear]["discounts"]; save_stats(stats); await save_discounts_to_telegram(context) # Sync
+        clear_user_discount(stats, user_id_to_clear); save_stats(stats); request_discount_backup()
         text = f"✅ Rabatte für Nutzer `{user_id_to_clear}` wurden erfolgreich entfernt."; await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_manage_discounts")]]))
     else: await update.callback_query.edit_message_text(f"ℹ️ Fehler: Nutzer `{user_id_to_clear}` hat keine Rabatte (mehr).", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_manage_discounts")]]))
 
@@ -590,7 +2598,7 @@ async def execute_manage_preview_limit(update: Update, context: ContextTypes.DEF
     current_clicks = user_data.get('preview_clicks', 0)
     if action == 'reset': new_clicks = 0; verb = "zurückgesetzt"
     else: new_clicks = current_clicks + 25; verb = "erhöht"
-    stats["users"][user_id]['preview_clicks'] = new_clicks; save_stats(stats)
+    set_user_field(user_id, 'preview_clicks', new_clicks)
     text = f"✅ Vorschau-Limit für Nutzer `{user_id}` wurde auf *{new_clicks}* {verb}."
     await update.callback_query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« Zurück", callback_data="admin_user_manage")]]))
 
@@ -604,28 +2612,94 @@ async def process_referral_reward(user_id: int, context: ContextTypes.DEFAULT_TY
         
         reward_discount = {"type": "percent", "value": 60} 
         
-        stats["users"][referrer_id]["discounts"] = reward_discount
-        save_stats(stats); await save_discounts_to_telegram(context)
+        set_user_discount(stats, referrer_id, reward_discount)
+        save_stats(stats); request_discount_backup()
         
         reward_text = ("🎉 *Belohnung erhalten!*\n\n" "Ein von dir geworbener Freund hat gerade seinen ersten Kauf getätigt. Als Dankeschön haben wir dir einen exklusiven *60% Rabatt auf ALLES* gutgeschrieben!")
-        try: await context.bot.send_message(chat_id=referrer_id, text=reward_text, parse_mode='Markdown')
-        except (error.Forbidden, error.BadRequest): logger.warning(f"Could not send referral reward notification to user {referrer_id}")
+        await side_effects.submit(notify_user, context, referrer_id, reward_text, parse_mode='Markdown')
 
 async def post_init(application: Application):
-    await restore_stats_from_pinned_message(application)
-    await load_discounts_from_telegram(application)
+    global reconcile_task, metrics_server
+    load_stats(); seed_activity_window(); inactivity_discounts.seed(stats_store.inactivity_candidates()); side_effects.start(application); media_catalog.refresh()
+    if METRICS_PORT:
+        from cluster import serve_http
+        # In the multi-process mode every worker gets its own port after METRICS_PORT; the front serves /metrics itself.
+        port = METRICS_PORT + 1 + WORKER_INDEX if WORKER_COUNT > 1 else METRICS_PORT
+        metrics_server = await serve_http(handle_metrics_request, METRICS_HOST, port); logger.info(f"Metriken unter http://{METRICS_HOST}:{port}/metrics")
+    if leader_lease: leader_lease.renew()
+    if application.job_queue:
+        if leader_lease: application.job_queue.run_repeating(sync_shared_state, interval=STATS_SYNC_INTERVAL, first=STATS_SYNC_INTERVAL, name="sync_shared_state")
+        application.job_queue.run_repeating(flush_dashboard, interval=DASHBOARD_INTERVAL, first=DASHBOARD_INTERVAL, name="dashboard")
+        application.job_queue.run_repeating(flush_admin_logs, interval=ADMIN_LOG_INTERVAL, first=ADMIN_LOG_INTERVAL, name="admin_logs")
+        application.job_queue.run_repeating(save_discounts_to_telegram, interval=DISCOUNT_BACKUP_INTERVAL, first=DISCOUNT_BACKUP_INTERVAL, name="discount_backup")
+        application.job_queue.run_repeating(grant_inactivity_discounts, interval=INACTIVITY_DISCOUNT_INTERVAL, first=INACTIVITY_DISCOUNT_INTERVAL, name="inactivity_discounts")
+    else: logger.warning("Keine JobQueue verfügbar, Dashboard, Admin-Logs und Inaktivitäts-Rabatte werden nicht automatisch bearbeitet.")
+    if not is_leader(): return
+    reconcile_task = asyncio.get_running_loop().create_task(reconcile_with_telegram(application), name="reconcile_with_telegram")
+    broadcast = Broadcast.resume(application)
+    if broadcast: start_broadcast(application, broadcast)
 
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("admin", admin))
+async def post_stop(application: Application):
+    context = CallbackContext(application)
+    if reconcile_task and not reconcile_task.done(): reconcile_task.cancel()
+    await side_effects.drain(SIDE_EFFECT_DRAIN_TIMEOUT); await flush_admin_logs_on_stop(context); await flush_dashboard(context); await save_discounts_to_telegram(context)
+
+async def post_shutdown(application: Application):
+    stats_store.flush(); logger.info("Statistiken gespeichert.")
+    if metrics_server: metrics_server.close(); await metrics_server.wait_closed()
+    if leader_lease: leader_lease.release()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently but the updates of one user strictly in order."""
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates); self._locks = {}
+
+    async def process_update(self, update: object, coroutine) -> None:  # type: ignore[misc]
+        """Waits for the user's earlier updates before taking one of the concurrency slots, so a slow user only
+        holds up their own updates and never the slots of everyone else."""
+        key = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+        if key is None:
+            async with self._semaphore: await self.do_process_update(update, coroutine)
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0]); entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._semaphore: await self.do_process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine) -> None: await coroutine
+
+    async def initialize(self) -> None: pass
+
+    async def shutdown(self) -> None: pass
+
+def build_application(request=None) -> Application:
+    """Builds the bot with all handlers. `request` replaces the HTTP transport lanes (used by bench.py)."""
+    global transport_lanes
+    builder = Application.builder().token(BOT_TOKEN).persistence(StatsSessionPersistence(SESSION_UPDATE_INTERVAL)).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if CONCURRENT_UPDATES > 1: builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    if request is not None: builder = builder.request(InstrumentedRequest(request)).get_updates_request(request)
+    else: transport_lanes = LaneRequest.from_env(); builder = builder.request(InstrumentedRequest(transport_lanes))
+    if TELEGRAM_API_BASE_URL: builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
+    application.add_handler(CommandHandler("start", timed_handler(start, "cmd_start")))
+    application.add_handler(CommandHandler("admin", timed_handler(admin, "cmd_admin")))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(handle_text_message, "text")))
+    return application
 
+def main() -> None:
+    if WEBHOOK_URL and WEBHOOK_WORKERS > 1:
+        import cluster
+        cluster.run(WEBHOOK_WORKERS, port=int(os.environ.get("PORT", 8443))); return
+    application = build_application()
     if WEBHOOK_URL:
         port = int(os.environ.get("PORT", 8443)); application.run_webhook(listen="0.0.0.0", port=port, url_path=BOT_TOKEN, webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}")
     else:
         logger.info("Starte Bot im Polling-Modus"); application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
+    if "--build-media" in sys.argv[1:]: media_catalog.refresh(); print(json.dumps(media_catalog.derivatives.manifest, indent=2))
+    else: main()
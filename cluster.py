@@ -0,0 +1,142 @@
+"""Multi-process webhook deployment.
+
+The front process receives Telegram's webhook POSTs and routes every update by user id (bot.worker_for_user) to one
+of WEBHOOK_WORKERS worker processes. Each worker runs the normal Application with all handlers. The workers share the
+SQLite stats store (STATS_BACKEND=sqlite) and elect one leader for the notification-group jobs (dashboard, admin logs,
+discount backup) through bot.LeaderLease.
+
+    WEBHOOK_URL=https://example.org WEBHOOK_WORKERS=4 python bot.py
+
+/metrics on the front reports the routing counters; with METRICS_PORT every worker serves its own metrics on
+METRICS_PORT + 1 + worker index.
+
+TELEGRAM_API_BASE_URL points the workers at another Bot API server, e.g. the fake one `python bench.py --workers N` runs.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+logger = logging.getLogger("cluster")
+WORKER_BACKLOG = int(os.getenv("WORKER_BACKLOG", "4"))
+
+
+def update_user_id(payload: dict):
+    """User id of a raw update (the `from`/`user` of its single content object), falling back to the chat id."""
+    for key, value in payload.items():
+        if key == "update_id" or not isinstance(value, dict): continue
+        user = value.get("from") or value.get("user")
+        if user: return user.get("id")
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat: return chat.get("id")
+    return None
+
+
+async def serve_http(handler, host: str, port: int) -> asyncio.AbstractServer:
+    """Minimal HTTP/1.1 server (keep-alive, Content-Length bodies) for the webhook front end and local test endpoints.
+    `handler(method, path, headers, body)` returns (status, body, content_type)."""
+    async def connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2); headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                try: status, payload, content_type = await handler(method, path, headers, body)
+                except Exception as e: logger.exception(f"HTTP-Handler fehlgeschlagen: {e}"); status, payload, content_type = 500, b"", "text/plain"
+                writer.write(f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close": break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError): pass
+        finally: writer.close()
+    return await asyncio.start_server(connection, host, port)
+
+
+# --- Worker ---
+def worker_main(index: int, count: int, inbox, processed, ready):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the front process owns shutdown
+    os.environ["WORKER_INDEX"] = str(index); os.environ["WORKER_COUNT"] = str(count)
+    import bot
+    asyncio.run(_run_worker(bot, index, inbox, processed, ready))
+
+
+async def _run_worker(bot, index: int, inbox, processed, ready):
+    from telegram import Update
+    application = bot.build_application(); loop = asyncio.get_running_loop(); pending = set()
+    await application.initialize(); await bot.post_init(application); await application.start()
+    ready[index] = 1; logger.info(f"Worker {index} bereit (pid {os.getpid()}).")
+
+    def done(task: asyncio.Task):
+        pending.discard(task)
+        with processed.get_lock(): processed[index] += 1
+
+    while True:
+        raw = await loop.run_in_executor(None, inbox.get)
+        if raw is None: break
+        try: update = Update.de_json(json.loads(raw), application.bot)
+        except (ValueError, TypeError) as e: logger.warning(f"Ungültiges Update verworfen: {e}"); done(None); continue
+        task = loop.create_task(application.update_processor.process_update(update, application.process_update(update))); pending.add(task); task.add_done_callback(done)
+        if len(pending) >= application.update_processor.max_concurrent_updates * WORKER_BACKLOG: await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+    if pending: await asyncio.wait(set(pending))
+    await application.stop(); await bot.post_stop(application); await application.shutdown(); await bot.post_shutdown(application)
+    logger.info(f"Worker {index} beendet.")
+
+
+# --- Front ---
+class Front:
+    def __init__(self, bot, queues: list, processed, ready):
+        self.bot = bot; self.queues = queues; self.processed = processed; self.ready = ready; self.received = 0; self.routed = [0] * len(queues); self.started = time.time()
+
+    async def handle(self, method: str, path: str, headers: dict, body: bytes):
+        if method == "POST" and path == f"/{self.bot.BOT_TOKEN}":
+            try: payload = json.loads(body)
+            except ValueError: return 400, b"", "text/plain"
+            user_id = update_user_id(payload); worker = self.bot.worker_for_user(user_id, len(self.queues)) if user_id is not None else 0
+            self.queues[worker].put(body); self.received += 1; self.routed[worker] += 1
+            return 200, b"", "text/plain"
+        if method == "GET" and path == "/cluster/stats":
+            stats = {"workers": len(self.queues), "ready": sum(self.ready), "received": self.received, "routed": self.routed, "processed": list(self.processed),
+                     "backlog": [routed - processed for routed, processed in zip(self.routed, self.processed)], "uptime_s": round(time.time() - self.started, 1)}
+            return 200, json.dumps(stats).encode(), "application/json"
+        if method == "GET" and path == "/metrics":
+            lines = ["# HELP cluster_updates_total Webhook updates routed to each worker.", "# TYPE cluster_updates_total counter"]
+            lines += [f'cluster_updates_total{{worker="{index}"}} {routed}' for index, routed in enumerate(self.routed)]
+            lines += ["# HELP cluster_processed_total Updates finished by each worker.", "# TYPE cluster_processed_total counter"]
+            lines += [f'cluster_processed_total{{worker="{index}"}} {processed}' for index, processed in enumerate(self.processed)]
+            lines += ["# HELP cluster_workers_ready Workers that finished startup.", "# TYPE cluster_workers_ready gauge", f"cluster_workers_ready {sum(self.ready)}"]
+            return 200, ("\n".join(lines) + "\n").encode(), "text/plain; version=0.0.4; charset=utf-8"
+        return 404, b"", "text/plain"
+
+
+async def _serve_front(front: Front, port: int):
+    bot = front.bot; stop = asyncio.Event(); loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+    server = await serve_http(front.handle, "0.0.0.0", port); logger.info(f"Webhook-Front lauscht auf Port {port} ({len(front.queues)} Worker).")
+    if bot.WEBHOOK_URL:
+        from telegram import Bot, Update
+        api = {"base_url": f"{bot.TELEGRAM_API_BASE_URL}/bot", "base_file_url": f"{bot.TELEGRAM_API_BASE_URL}/file/bot"} if bot.TELEGRAM_API_BASE_URL else {}
+        async with Bot(bot.BOT_TOKEN, **api) as telegram_bot: await telegram_bot.set_webhook(url=f"{bot.WEBHOOK_URL}/{bot.BOT_TOKEN}", allowed_updates=Update.ALL_TYPES)
+    await stop.wait()
+    server.close(); await server.wait_closed()
+
+
+def run(workers: int, port: int):
+    import bot
+    if bot.STATS_BACKEND != "sqlite": raise SystemExit("WEBHOOK_WORKERS > 1 braucht STATS_BACKEND=sqlite (gemeinsamer Speicher der Worker).")
+    # One-time work before the workers start: JSON->SQLite migration and the image derivatives.
+    bot.stats_store.connect(); bot.stats_store.db.close(); bot.stats_store.db = None; bot.media_catalog.refresh()
+    context = multiprocessing.get_context("spawn"); queues = [context.Queue() for _ in range(workers)]
+    processed = context.Array("q", workers); ready = context.Array("b", workers)
+    processes = [context.Process(target=worker_main, args=(index, workers, queues[index], processed, ready), name=f"bot-worker-{index}") for index in range(workers)]
+    for process in processes: process.start()
+    try: asyncio.run(_serve_front(Front(bot, queues, processed, ready), port))
+    finally:
+        for queue in queues: queue.put(None)
+        for process in processes: process.join(timeout=bot.SIDE_EFFECT_DRAIN_TIMEOUT + 30)
+        for process in processes:
+            if process.is_alive(): logger.warning(f"{process.name} reagiert nicht, wird beendet."); process.terminate()